@@ -4,23 +4,30 @@ Permite execução sob demanda e consulta de dados
 """
 
 from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel, Field
 from datetime import date, datetime, timedelta
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Literal
 import os
 import json
 from dotenv import load_dotenv
 
 # Importar a classe principal da automação
-from automacao_carteirinhas import AutomacaoCarteirinhas, DatabaseManager
-from automacao_webscraping_real import SGUCARD
+from automacao_carteirinhas import AutomacaoCarteirinhas, get_db_pool, close_db_pool, get_supabase_client
+from async_database import (
+    AsyncDatabaseManager, open_async_db_pool, close_async_db_pool, async_driver_supported, use_selector_event_loop
+)
+from automacao_webscraping_real import SGUCARD, get_session_pool
+from query_metrics import get_query_metrics
 import schedule
 import threading
 import time
 
 # Carregar variáveis de ambiente
 load_dotenv()
+# psycopg assíncrono exige SelectorEventLoop no Windows (vale para loops criados após o import)
+use_selector_event_loop()
 
 # Configurar FastAPI
 app = FastAPI(
@@ -89,23 +96,49 @@ class JobCreateRequest(BaseModel):
     carteirinha: str = Field(..., description="Carteirinha alvo do job")
     carteira: Optional[str] = Field(default=None, description="Carteira (se diferente da carteirinha)")
     id_paciente: Optional[str] = Field(default=None, description="ID do paciente (opcional)")
+    force: bool = Field(default=False, description="Executa mesmo com sucesso recente (ignora o intervalo de recheck)")
+
+class JobBatchRequest(BaseModel):
+    type: Optional[str] = Field(default="sgucard", description="Tipo dos jobs")
+    carteirinhas: List[str] = Field(..., description="Carteirinhas a enfileirar (duplicatas e vazias são ignoradas)")
+    # Lotes são varreduras em massa: por padrão não competem com os pedidos interativos (adhoc)
+    category: Literal["adhoc", "scheduled_daily", "scheduled_weekly"] = Field(
+        default="scheduled_weekly",
+        description="Lane dos jobs: scheduled_weekly (prioridade 9, padrão), scheduled_daily (5) ou adhoc (1, só para pedidos interativos)"
+    )
+    scheduled_bucket: Optional[str] = Field(default=None, description="Bucket da rodada (ex.: 2025-10-12); torna o lote idempotente")
+    skip_open: bool = Field(default=True, description="Pular carteirinhas com job pending/processing")
+    skip_recent_hours: int = Field(default=0, description="Pular carteirinhas com sucesso nas últimas N horas (0 desativa)")
+    force: bool = Field(default=False, description="Executa mesmo com sucesso recente (ignora o intervalo de recheck)")
+    min_recheck_interval_hours: Optional[int] = Field(default=6, description="No claim, resolve sem scrape se houve sucesso há menos de N horas (null desativa)")
+
+# AutomacaoCarteirinhas compartilhada pelos endpoints (criada sob demanda, ver get_automacao)
+automacao: Optional[AutomacaoCarteirinhas] = None
+_automacao_lock = threading.Lock()
 
 def get_automacao():
-    """Inicializa AutomacaoCarteirinhas sob demanda para evitar conexão ao DB no import."""
+    """Inicializa AutomacaoCarteirinhas sob demanda para evitar conexão ao DB no import.
+    Os scrapes rodam em paralelo no threadpool: o DatabaseManager dela é per_thread, com conexões
+    emprestadas do pool por operação (executar_automacao)."""
     global automacao
-    # Evitar NameError se a variável global ainda não existir
-    try:
-        _ = automacao
-    except NameError:
-        automacao = None
     if automacao is None:
-        try:
-            automacao = AutomacaoCarteirinhas()
-        except Exception as e:
-            # Evitar derrubar o servidor por falha de banco no startup
-            raise RuntimeError(f"Falha ao inicializar automação: {e}")
+        with _automacao_lock:
+            if automacao is None:
+                try:
+                    automacao = AutomacaoCarteirinhas(per_thread=True)
+                except Exception as e:
+                    # Evitar derrubar o servidor por falha de banco no startup
+                    raise RuntimeError(f"Falha ao inicializar automação: {e}")
     return automacao
 
+def executar_automacao(metodo, *args, **kwargs):
+    """Executa um método da automação compartilhada e devolve ao pool a conexão que a thread
+    usou: as threads do threadpool não ficam segurando conexões entre requisições."""
+    try:
+        return metodo(*args, **kwargs)
+    finally:
+        get_automacao().db_manager.release_thread_connection()
+
 @app.get("/", tags=["Info"])
 async def root():
     """Endpoint raiz com informações da API"""
@@ -113,6 +146,8 @@ async def root():
         "message": "API de Automação de Carteirinhas",
         "version": "1.0.0",
         "status": "ativo",
+        # Quantos jobs simultâneos esta instância aceita (uma sessão de Chrome por job)
+        "capacity": get_session_pool().capacity,
         "endpoints": {
             "verificar_carteirinha": "POST /verificar_carteirinha",
             "atualizar_intervalo": "POST /atualizar_intervalo",
@@ -121,6 +156,7 @@ async def root():
             "sgucard_intervalo": "POST /sgucard/intervalo",
             "executar_diario": "POST /executar_diario",
             "executar_semanal": "POST /executar_semanal",
+            "abortar": "POST /abortar",
             "consultar_guias": "GET /guias/{carteirinha}",
             "consultar_logs": "GET /logs"
         }
@@ -133,19 +169,16 @@ async def verificar_carteirinha_endpoint(
 ):
     """Verifica uma carteirinha específica conforme prompt.yaml"""
     try:
-        # Usar função vasculhar_carteirinhas para carteirinha específica
+        # Usar função vasculhar_carteirinhas para carteirinha específica;
+        # roda fora do event loop para permitir várias sessões simultâneas
         automacao = get_automacao()
-        resultado = automacao.vasculhar_carteirinhas(
+        resultado = await run_in_threadpool(
+            executar_automacao,
+            automacao.vasculhar_carteirinhas,
             modo_execucao="manual",
             carteirinha=request.carteirinha
         )
-        # Se houve sucesso na verificação, marcar o job como success imediatamente
-        try:
-            if resultado.get('status') == 'sucesso' and request.carteirinha:
-                automacao.db_manager.mark_job_success_by_carteirinha(request.carteirinha)
-        except Exception as e:
-            logger.warning(f"Falha ao marcar success por carteirinha {request.carteirinha}: {e}")
-        
+        # Não grava o job aqui: o worker conclui via complete_jobs (duração, carteiras_state, lease)
         return {
             "status": "sucesso" if resultado.get('status') == 'sucesso' else "erro",
             "carteirinha": request.carteirinha,
@@ -159,6 +192,20 @@ async def verificar_carteirinha_endpoint(
             detail=f"Erro interno: {str(e)}"
         )
 
+@app.post("/abortar", tags=["Automação"])
+async def abortar_endpoint(
+    request: CarteirinhaRequest,
+    token: str = Depends(verify_token)
+):
+    """Aborta a execução em andamento da carteirinha (usado pelo worker quando o deadline do job estoura)"""
+    sessoes = get_session_pool().abort(request.carteirinha)
+    return {
+        "status": "abortado" if sessoes else "nao_encontrado",
+        "carteirinha": request.carteirinha,
+        "sessoes_abortadas": sessoes,
+        "timestamp": datetime.now().isoformat()
+    }
+
 @app.post("/atualizar_intervalo")
 async def atualizar_intervalo_endpoint(
     request: AtualizarIntervaloRequest,
@@ -263,6 +310,25 @@ async def _startup_schedule():
     schedule.every().saturday.at("19:00").do(_job_todos)
     threading.Thread(target=_schedule_loop, daemon=True).start()
 
+@app.on_event("startup")
+async def _startup_db_pool():
+    # Pool único do processo: os endpoints emprestam conexões em vez de abrir uma por requisição
+    try:
+        if async_driver_supported():
+            await open_async_db_pool()
+        else:
+            # ProactorEventLoop (Windows): AsyncDatabaseManager roda o DatabaseManager em threads
+            print("Event loop sem suporte ao psycopg assíncrono; usando pool síncrono em threads")
+            await run_in_threadpool(get_db_pool)
+    except Exception as e:
+        # Sem pool os endpoints abrem conexão própria (comportamento anterior)
+        print(f"Falha ao abrir pool de conexões: {e}")
+
+@app.on_event("shutdown")
+async def _shutdown_db_pool():
+    await close_async_db_pool()
+    await run_in_threadpool(close_db_pool)
+
 @app.post("/executar_webscraping_real", response_model=ExecutionResponse, tags=["Automação"])
 async def executar_webscraping_real(
     request: AtualizarIntervaloRequest = None,
@@ -280,7 +346,9 @@ async def executar_webscraping_real(
             data_final = request.data_final
         
         # Executar automação real
-        resultado = get_automacao().vasculhar_carteirinhas(
+        resultado = await run_in_threadpool(
+            executar_automacao,
+            get_automacao().vasculhar_carteirinhas,
             modo_execucao="manual" if carteirinha else "intervalo",
             carteirinha=carteirinha,
             data_inicial=data_inicial,
@@ -302,8 +370,9 @@ async def consultar_guias(
     token: str = Depends(verify_token)
 ):
     """Consulta guias de uma carteirinha específica"""
+    db_manager = None
     try:
-        db_manager = DatabaseManager()
+        db_manager = await AsyncDatabaseManager().open()
         
         query = """
             SELECT id, carteirinha, paciente, guia, data_autorizacao, 
@@ -313,7 +382,7 @@ async def consultar_guias(
             ORDER BY data_autorizacao DESC
         """
         
-        result = db_manager.execute_query(query, (carteirinha,), fetch=True)
+        result = await db_manager.execute_query(query, (carteirinha,), fetch=True, op='guias')
         
         guias = []
         for row in result:
@@ -328,7 +397,6 @@ async def consultar_guias(
                 sessoes_autorizadas=row[7]
             ))
         
-        db_manager.close()
         return guias
         
     except Exception as e:
@@ -336,6 +404,9 @@ async def consultar_guias(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Erro ao consultar guias: {str(e)}"
         )
+    finally:
+        if db_manager is not None:
+            await db_manager.close()
 
 @app.get("/logs", response_model=List[LogEntry], tags=["Consultas"])
 async def consultar_logs(
@@ -343,8 +414,9 @@ async def consultar_logs(
     token: str = Depends(verify_token)
 ):
     """Consulta logs de execução"""
+    db_manager = None
     try:
-        db_manager = DatabaseManager()
+        db_manager = await AsyncDatabaseManager().open()
         
         query = """
             SELECT id, timestamp, tipo_execucao, status, carteirinhas_processadas,
@@ -354,7 +426,7 @@ async def consultar_logs(
             LIMIT %s
         """
         
-        result = db_manager.execute_query(query, (limit,), fetch=True)
+        result = await db_manager.execute_query(query, (limit,), fetch=True, op='logs')
         
         logs = []
         for row in result:
@@ -369,7 +441,6 @@ async def consultar_logs(
                 mensagem=row[7]
             ))
         
-        db_manager.close()
         return logs
         
     except Exception as e:
@@ -377,21 +448,22 @@ async def consultar_logs(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Erro ao consultar logs: {str(e)}"
         )
+    finally:
+        if db_manager is not None:
+            await db_manager.close()
 
 @app.get("/status", tags=["Info"])
 async def status_sistema(token: str = Depends(verify_token)):
     """Retorna status do sistema"""
+    db_manager = None
     try:
-        db_manager = DatabaseManager()
-        
-        # Contar registros nas tabelas principais
-        stats = {}
+        db_manager = await AsyncDatabaseManager().open()
         
+        # Contar registros nas tabelas principais (uma única ida ao banco)
         tables = ['carteirinhas', 'agendamentos', 'baseguias', 'logs']
-        for table in tables:
-            query = f"SELECT COUNT(*) FROM {table}"
-            result = db_manager.execute_query(query, fetch=True)
-            stats[table] = result[0][0] if result else 0
+        query = "SELECT " + ", ".join(f"(SELECT COUNT(*) FROM {table})" for table in tables)
+        result = await db_manager.execute_query(query, fetch=True, op='status')
+        stats = dict(zip(tables, result[0])) if result else {table: 0 for table in tables}
         
         # Último log de execução
         query = """
@@ -400,7 +472,7 @@ async def status_sistema(token: str = Depends(verify_token)):
             ORDER BY timestamp DESC 
             LIMIT 1
         """
-        result = db_manager.execute_query(query, fetch=True)
+        result = await db_manager.execute_query(query, fetch=True, op='status')
         
         ultima_execucao = None
         if result:
@@ -411,8 +483,6 @@ async def status_sistema(token: str = Depends(verify_token)):
                 'carteirinhas_processadas': result[0][3]
             }
         
-        db_manager.close()
-        
         return {
             'status': 'ativo',
             'timestamp': datetime.now().isoformat(),
@@ -425,12 +495,29 @@ async def status_sistema(token: str = Depends(verify_token)):
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Erro ao obter status: {str(e)}"
         )
+    finally:
+        if db_manager is not None:
+            await db_manager.close()
+
+def _supabase_counts(stats: Dict):
+    supabase = get_supabase_client()
+    if not supabase:
+        return
+    res = supabase.table("carteirinhas").select("id", count="exact").execute()
+    stats["total_carteirinhas"] = res.count or stats["total_carteirinhas"]
+    res = supabase.table("pagamentos").select("id", count="exact").execute()
+    stats["total_pagamentos"] = res.count or stats["total_pagamentos"]
+    res = supabase.table("agendamentos").select("id_atendimento", count="exact").execute()
+    stats["total_agendamentos"] = res.count or stats["total_agendamentos"]
+    res = supabase.table("baseguias").select("id", count="exact").execute()
+    stats["total_guias"] = res.count or stats["total_guias"]
 
 @app.get("/estatisticas", tags=["Info"])
 async def estatisticas_sistema():
     """Retorna estatísticas gerais do sistema (sem autenticação)"""
+    db_manager = None
     try:
-        db_manager = DatabaseManager()
+        db_manager = await AsyncDatabaseManager().open()
         
         # Buscar estatísticas básicas
         stats = {
@@ -449,28 +536,16 @@ async def estatisticas_sistema():
             ("total_pagamentos", "pagamentos"),
         ]:
             try:
-                result = db_manager.execute_query(f"SELECT COUNT(*) FROM {table}", fetch=True)
+                result = await db_manager.execute_query(f"SELECT COUNT(*) FROM {table}", fetch=True, op='stats')
                 stats[alias] = result[0][0] if result else stats[alias]
             except Exception:
                 pass
         
-        # Se habilitado, sobrepor contagens via cliente Supabase
+        # Se habilitado, sobrepor contagens via cliente Supabase (síncrono: roda em thread)
         try:
             use_supabase_stats = os.getenv("USE_SUPABASE_STATS", "false").lower() == "true"
-            if use_supabase_stats and getattr(db_manager, "supabase", None):
-                res = db_manager.supabase.table("carteirinhas").select("id", count="exact").execute()
-                stats["total_carteirinhas"] = res.count or stats["total_carteirinhas"]
-                res = db_manager.supabase.table("pagamentos").select("id", count="exact").execute()
-                stats["total_pagamentos"] = res.count or stats["total_pagamentos"]
-                res = db_manager.supabase.table("agendamentos").select("id_atendimento", count="exact").execute()
-                stats["total_agendamentos"] = res.count or stats["total_agendamentos"]
-                res = db_manager.supabase.table("baseguias").select("id", count="exact").execute()
-                stats["total_guias"] = res.count or stats["total_guias"]
-        except Exception:
-            pass
-        
-        try:
-            db_manager.close()
+            if use_supabase_stats:
+                await run_in_threadpool(_supabase_counts, stats)
         except Exception:
             pass
         
@@ -481,14 +556,18 @@ async def estatisticas_sistema():
             "error": f"Erro ao obter estatísticas: {str(e)}",
             "timestamp": datetime.now().isoformat()
         }
+    finally:
+        if db_manager is not None:
+            await db_manager.close()
 
 @app.get("/health", tags=["Info"])
 async def health_check():
     """Verifica a saúde do sistema"""
+    db_manager = None
     try:
         # Testar conexão com banco
-        db_manager = DatabaseManager()
-        test_result = db_manager.get_sample_carteirinha()
+        db_manager = await AsyncDatabaseManager().open()
+        test_result = await db_manager.get_sample_carteirinha()
         
         return {
             "status": "healthy",
@@ -503,6 +582,9 @@ async def health_check():
             "database": "error",
             "message": f"Erro: {str(e)}"
         }
+    finally:
+        if db_manager is not None:
+            await db_manager.close()
 
 if __name__ == "__main__":
     import uvicorn
@@ -525,13 +607,15 @@ if __name__ == "__main__":
 # Endpoint para criar job de carteirinha
 @app.post("/jobs", tags=["Jobs"])
 async def criar_job(request: JobCreateRequest, token: str = Depends(verify_token)):
+    db_manager = None
     try:
-        db_manager = DatabaseManager()
-        result = db_manager.insert_job_carteirinha(
+        db_manager = await AsyncDatabaseManager().open()
+        result = await db_manager.insert_job_carteirinha(
             type=request.type,
             carteirinha=request.carteirinha,
             carteira=request.carteira or request.carteirinha,
-            id_paciente=request.id_paciente
+            id_paciente=request.id_paciente,
+            force=request.force
         )
         return {
             "status": "created",
@@ -542,4 +626,105 @@ async def criar_job(request: JobCreateRequest, token: str = Depends(verify_token
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Erro ao criar job: {str(e)}"
-        )
\ No newline at end of file
+        )
+    finally:
+        if db_manager is not None:
+            await db_manager.close()
+
+# Endpoint para enfileirar carteirinhas em lote (RPC enqueue_jobs)
+@app.post("/jobs/batch", tags=["Jobs"])
+async def criar_jobs_lote(request: JobBatchRequest, token: str = Depends(verify_token)):
+    max_items = int(os.getenv("JOBS_BATCH_MAX_ITEMS", "10000"))
+    if len(request.carteirinhas) > max_items:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Lote com {len(request.carteirinhas)} carteirinhas excede o máximo de {max_items}"
+        )
+    db_manager = None
+    try:
+        db_manager = await AsyncDatabaseManager().open()
+        result = await db_manager.enqueue_jobs(
+            request.carteirinhas,
+            category=request.category,
+            scheduled_bucket=request.scheduled_bucket,
+            job_type=request.type,
+            skip_open=request.skip_open,
+            skip_recent_hours=request.skip_recent_hours,
+            force=request.force,
+            min_recheck_hours=request.min_recheck_interval_hours,
+        )
+        return {
+            "status": "accepted",
+            **result,
+            "timestamp": datetime.now().isoformat()
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Erro ao enfileirar jobs: {str(e)}"
+        )
+    finally:
+        if db_manager is not None:
+            await db_manager.close()
+
+# Latência e backlog por lane de prioridade
+@app.get("/jobs/lanes", tags=["Jobs"])
+async def latencia_lanes(window_hours: int = 24, type: str = "sgucard", token: str = Depends(verify_token)):
+    db_manager = None
+    try:
+        db_manager = await AsyncDatabaseManager().open()
+        lanes = await db_manager.lane_latency_stats(type, window_hours)
+        return {
+            "window_hours": window_hours,
+            "lanes": lanes,
+            "timestamp": datetime.now().isoformat()
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Erro ao consultar latência das lanes: {str(e)}"
+        )
+    finally:
+        if db_manager is not None:
+            await db_manager.close()
+
+# Estatísticas da fila para dashboards/autoscaling (RPC queue_stats, com cache curto)
+_queue_stats_cache: Dict[Optional[str], tuple] = {}
+_queue_stats_lock = threading.Lock()
+
+@app.get("/jobs/stats", tags=["Jobs"])
+async def estatisticas_fila(type: Optional[str] = None, token: str = Depends(verify_token)):
+    ttl = float(os.getenv("QUEUE_STATS_CACHE_SECONDS", "2"))
+    with _queue_stats_lock:
+        cached = _queue_stats_cache.get(type)
+    if cached and time.monotonic() - cached[0] < ttl:
+        return cached[1]
+    db_manager = None
+    try:
+        db_manager = await AsyncDatabaseManager().open()
+        stats = await db_manager.queue_stats(type)
+        response = {**stats, "timestamp": datetime.now().isoformat()}
+        with _queue_stats_lock:
+            _queue_stats_cache[type] = (time.monotonic(), response)
+        return response
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Erro ao obter estatísticas da fila: {str(e)}"
+        )
+    finally:
+        if db_manager is not None:
+            await db_manager.close()
+
+# Métricas de consulta do processo da API (query_metrics): histograma de latência por operação
+@app.get("/metrics/queries", tags=["Info"])
+async def metricas_consultas(reset: bool = False, token: str = Depends(verify_token)):
+    metrics = get_query_metrics()
+    snapshot = metrics.snapshot()
+    if reset:
+        metrics.reset()
+    return {
+        "slow_query_ms": metrics.slow_ms,
+        "backends": snapshot,
+        "timestamp": datetime.now().isoformat()
+    }
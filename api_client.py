@@ -0,0 +1,105 @@
+"""
+Cliente HTTP compartilhado para chamadas à API de carteirinhas.
+- Um requests.Session por servidor (scheme://host:porta), com pool keep-alive
+- Tamanho do pool configurável via API_POOL_MAXSIZE
+- Métricas de tempo por servidor e caminho (contagem, erros, média, máximo)
+"""
+
+import os
+import time
+import logging
+import threading
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+_api_client = None
+_api_client_lock = threading.Lock()
+
+
+class ApiClient:
+    """Pool de sessões HTTP keep-alive, uma por servidor, com métricas por requisição."""
+
+    def __init__(self, pool_maxsize: Optional[int] = None):
+        self.pool_maxsize = pool_maxsize or int(os.getenv("API_POOL_MAXSIZE", "10") or "10")
+        self._sessions: Dict[str, requests.Session] = {}
+        self._metrics: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _origin(url: str) -> str:
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def session_for(self, url: str) -> requests.Session:
+        """Retorna (criando se necessário) a sessão keep-alive do servidor da URL."""
+        origin = self._origin(url)
+        with self._lock:
+            session = self._sessions.get(origin)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._sessions[origin] = session
+                logger.info(f"[api_client] Pool criado para {origin} (maxsize={self.pool_maxsize})")
+            return session
+
+    def _record(self, url: str, elapsed_ms: float, ok: bool):
+        parts = urlsplit(url)
+        key = f"{parts.scheme}://{parts.netloc}{parts.path}"
+        with self._lock:
+            m = self._metrics.setdefault(key, {"count": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0, "last_ms": 0.0})
+            m["count"] += 1
+            if not ok:
+                m["errors"] += 1
+            m["total_ms"] += elapsed_ms
+            m["max_ms"] = max(m["max_ms"], elapsed_ms)
+            m["last_ms"] = elapsed_ms
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        session = self.session_for(url)
+        start = time.perf_counter()
+        ok = False
+        try:
+            resp = session.request(method, url, **kwargs)
+            ok = resp.status_code < 500
+            return resp
+        finally:
+            self._record(url, (time.perf_counter() - start) * 1000.0, ok)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def metrics(self) -> Dict[str, Dict]:
+        """Snapshot das métricas por endpoint, com média calculada em ms."""
+        with self._lock:
+            snapshot = {}
+            for key, m in self._metrics.items():
+                snapshot[key] = dict(m, avg_ms=round(m["total_ms"] / m["count"], 2) if m["count"] else 0.0)
+            return snapshot
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                try:
+                    session.close()
+                except Exception:
+                    pass
+            self._sessions.clear()
+
+
+def get_api_client() -> ApiClient:
+    global _api_client
+    if _api_client is None:
+        with _api_client_lock:
+            if _api_client is None:
+                _api_client = ApiClient()
+    return _api_client
@@ -3,8 +3,8 @@ import psycopg2
 from dotenv import load_dotenv
 
 """
-Aplica o arquivo SQL de RPCs (sql_jobs_rpcs.sql) no banco do Supabase.
-Também valida a criação listando as funções instaladas.
+Aplica o arquivo SQL de RPCs (sql_jobs_rpcs.sql) e os índices da fila (sql_job_indexes.sql)
+no banco do Supabase. Também valida a criação listando as funções e índices instalados.
 """
 
 def get_connection():
@@ -33,6 +33,38 @@ def apply_sql(conn, sql_path: str):
     cur.close()
 
 
+def apply_sql_statements(conn, sql_path: str):
+    """Aplica um comando por vez em autocommit (CREATE INDEX CONCURRENTLY não roda em transação)."""
+    with open(sql_path, 'r', encoding='utf-8') as f:
+        lines = [line for line in f.read().splitlines() if not line.strip().startswith('--')]
+    statements = [stmt.strip() for stmt in '\n'.join(lines).split(';') if stmt.strip()]
+    previous = conn.autocommit
+    conn.autocommit = True
+    try:
+        cur = conn.cursor()
+        for stmt in statements:
+            cur.execute(stmt)
+        cur.close()
+    finally:
+        conn.autocommit = previous
+
+
+def list_installed_indexes(conn):
+    cur = conn.cursor()
+    cur.execute(
+        """
+        SELECT c.relname, i.indisvalid
+          FROM pg_index i
+          JOIN pg_class c ON c.oid = i.indexrelid
+         WHERE i.indrelid = 'public.job_carteirinhas'::regclass
+         ORDER BY c.relname;
+        """
+    )
+    rows = cur.fetchall()
+    cur.close()
+    return [name if valid else f"{name} (INVALID)" for name, valid in rows]
+
+
 def list_installed_rpcs(conn):
     cur = conn.cursor()
     cur.execute(
@@ -43,10 +75,21 @@ def list_installed_rpcs(conn):
            AND routine_name IN (
                 'claim_jobs',
                 'complete_job',
+                'complete_jobs',
                 'fail_job',
+                'fail_jobs',
                 'heartbeat_job',
+                'heartbeat_jobs',
                 'release_job',
-                'purge_stale_processing'
+                'release_jobs',
+                'purge_stale_processing',
+                'janitor_sweep',
+                'archive_finished_jobs',
+                'enqueue_jobs',
+                'age_job_priorities',
+                'lane_latency_stats',
+                'queue_stats',
+                'take_portal_tokens'
            )
          ORDER BY routine_name;
         """
@@ -59,12 +102,15 @@ def list_installed_rpcs(conn):
 
 def main():
     sql_path = os.path.join(os.path.dirname(__file__), 'sql_jobs_rpcs.sql')
-    print({"sql_path": sql_path})
+    indexes_path = os.path.join(os.path.dirname(__file__), 'sql_job_indexes.sql')
+    print({"sql_path": sql_path, "indexes_path": indexes_path})
     conn = get_connection()
     try:
         apply_sql(conn, sql_path)
         rpcs = list_installed_rpcs(conn)
         print("RPCs instaladas:", rpcs)
+        apply_sql_statements(conn, indexes_path)
+        print("Índices de job_carteirinhas:", list_installed_indexes(conn))
     finally:
         conn.close()
         print("Conexão encerrada.")
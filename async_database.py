@@ -0,0 +1,229 @@
+"""
+Acesso assíncrono ao Postgres para os endpoints da API.
+- Pool assíncrono do processo (psycopg_pool.AsyncConnectionPool), aberto no startup da API,
+  com os mesmos DB_POOL_* do pool síncrono
+- AsyncDatabaseManager: variante asyncio das leituras e dos métodos de jobs do DatabaseManager;
+  uma consulta lenta só suspende a própria requisição, não o event loop
+- O driver assíncrono do psycopg não roda no ProactorEventLoop (padrão do Windows): a API usa a
+  policy de SelectorEventLoop e, se o loop ainda assim for Proactor, o AsyncDatabaseManager
+  delega ao DatabaseManager síncrono em uma thread
+- Os cursores são TrackedAsyncCursor: cada consulta entra nas métricas de query_metrics
+"""
+
+import sys
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+from psycopg import AsyncConnection
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+
+from automacao_carteirinhas import DatabaseManager, db_pool_enabled, db_pool_settings
+from query_metrics import TrackedAsyncCursor, operation, current_operation
+
+logger = logging.getLogger(__name__)
+
+_async_db_pool: Optional[AsyncConnectionPool] = None
+
+
+def use_selector_event_loop():
+    """No Windows, troca a policy para SelectorEventLoop (exigido pelo psycopg assíncrono).
+    Só vale para loops criados depois da chamada."""
+    if sys.platform == 'win32':
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+
+
+def async_driver_supported() -> bool:
+    """False quando o loop em execução é o ProactorEventLoop do Windows."""
+    if sys.platform != 'win32':
+        return True
+    return not isinstance(asyncio.get_running_loop(), asyncio.ProactorEventLoop)
+
+
+async def open_async_db_pool() -> Optional[AsyncConnectionPool]:
+    """Abre (uma vez) o pool assíncrono. Retorna None se desativado ou sem suporte no loop atual."""
+    global _async_db_pool
+    if not db_pool_enabled() or not async_driver_supported():
+        return None
+    # Chamado no startup, dentro do event loop: não há concorrência entre threads aqui
+    if _async_db_pool is None:
+        load_dotenv()
+        pool = AsyncConnectionPool(
+            kwargs=DatabaseManager._connection_params(),
+            **db_pool_settings(),
+            check=AsyncConnectionPool.check_connection,
+            name='carteirinhas-async',
+            open=False,
+        )
+        await pool.open()
+        _async_db_pool = pool
+        logger.info(f"Pool assíncrono aberto (min={pool.min_size}, max={pool.max_size})")
+    return _async_db_pool
+
+
+async def close_async_db_pool():
+    """Fecha o pool assíncrono (shutdown da API)."""
+    global _async_db_pool
+    if _async_db_pool is not None:
+        pool, _async_db_pool = _async_db_pool, None
+        await pool.close()
+        logger.info("Pool assíncrono fechado")
+
+
+class AsyncDatabaseManager:
+    """Leituras e operações de jobs para os endpoints, sem bloquear o event loop.
+
+    Uso: `db = await AsyncDatabaseManager().open()` ... `await db.close()` (em finally).
+    """
+
+    def __init__(self):
+        self.connection: Optional[AsyncConnection] = None
+        self._pool: Optional[AsyncConnectionPool] = _async_db_pool
+        # Fallback para loops sem suporte ao driver assíncrono
+        self._sync: Optional[DatabaseManager] = None
+
+    async def open(self) -> 'AsyncDatabaseManager':
+        """Empresta uma conexão do pool assíncrono (ou abre uma, sem pool)."""
+        try:
+            if self._pool is not None:
+                self.connection = await self._pool.getconn()
+            elif async_driver_supported():
+                self.connection = await AsyncConnection.connect(**DatabaseManager._connection_params())
+            else:
+                self._sync = await asyncio.to_thread(DatabaseManager)
+            if self.connection is not None:
+                self.connection.cursor_factory = TrackedAsyncCursor
+        except Exception as e:
+            logger.error(f"Erro ao conectar com banco (async): {e}")
+            raise
+        return self
+
+    async def close(self):
+        """Devolve a conexão ao pool (ou a fecha)."""
+        if self._sync is not None:
+            sync_db, self._sync = self._sync, None
+            await asyncio.to_thread(sync_db.close)
+        if self.connection is None:
+            return
+        conn, self.connection = self.connection, None
+        if self._pool is not None:
+            await self._pool.putconn(conn)
+        else:
+            await conn.close()
+
+    @asynccontextmanager
+    async def _cursor(self, row_factory=None):
+        """Cursor de uma operação: commit ao sair, rollback em erro, sem deixar transação aberta."""
+        conn = self.connection
+        cursor = conn.cursor(row_factory=row_factory)
+        try:
+            yield cursor
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+        finally:
+            await cursor.close()
+
+    async def execute_query(self, query: str, params: tuple = None, fetch: bool = False, op: Optional[str] = None):
+        """Executa uma query no banco de dados (uma transação por chamada); `op` marca a operação nas métricas"""
+        if self._sync is not None:
+            return await asyncio.to_thread(self._sync.execute_query, query, params, fetch, op)
+        try:
+            with operation(op or current_operation()):
+                async with self._cursor() as cursor:
+                    await cursor.execute(query, params)
+                    return await cursor.fetchall() if fetch else True
+        except Exception as e:
+            logger.error(f"Erro ao executar query: {e}")
+            raise
+
+    async def get_sample_carteirinha(self) -> Optional[Dict]:
+        """Retorna uma carteirinha de exemplo"""
+        if self._sync is not None:
+            return await asyncio.to_thread(self._sync.get_sample_carteirinha)
+        try:
+            with operation('health'):
+                async with self._cursor() as cursor:
+                    await cursor.execute("SELECT carteiras, paciente FROM carteirinhas LIMIT 1")
+                    result = await cursor.fetchone()
+            if result:
+                return {'carteirinha': result[0], 'nome': result[1]}
+            return None
+        except Exception as e:
+            logger.error(f"Erro ao buscar carteirinha de exemplo: {str(e)}")
+            return None
+
+    async def _rpc_json(self, query: str, params: tuple, op: str) -> Dict:
+        """Chama um RPC que devolve jsonb; levanta em falha."""
+        with operation(op):
+            async with self._cursor() as cursor:
+                await cursor.execute(query, params)
+                row = await cursor.fetchone()
+        return row[0] if row and isinstance(row[0], dict) else {}
+
+    # Métodos de Jobs (mesmos RPCs do DatabaseManager, chamados direto pelo pool)
+    async def insert_job_carteirinha(self, type: str, carteirinha: str, carteira: Optional[str] = None,
+                                     id_paciente: Optional[str] = None, force: bool = False,
+                                     category: str = 'adhoc') -> Dict:
+        if self._sync is not None:
+            return await asyncio.to_thread(
+                self._sync.insert_job_carteirinha, type, carteirinha, carteira, id_paciente, force, category
+            )
+        try:
+            with operation('enqueue'):
+                async with self._cursor(row_factory=dict_row) as cursor:
+                    await cursor.execute(
+                        "INSERT INTO job_carteirinhas (type, carteirinha, carteira, id_paciente, force, category) "
+                        "VALUES (%s, %s, %s, %s, %s, %s) RETURNING *",
+                        (type, carteirinha, carteira or carteirinha, id_paciente, force, category)
+                    )
+                    job = await cursor.fetchone()
+            return {'status': 'created', 'job': job}
+        except Exception as e:
+            logger.error(f"Erro ao inserir job_carteirinha: {e}")
+            raise
+
+    async def enqueue_jobs(self, carteirinhas: List[str], category: str = 'adhoc',
+                           scheduled_bucket: Optional[str] = None, job_type: str = 'sgucard',
+                           skip_open: bool = True, skip_recent_hours: int = 0, force: bool = False,
+                           min_recheck_hours: Optional[int] = 6) -> Dict:
+        """Enfileira carteirinhas em lote (RPC enqueue_jobs); levanta em falha."""
+        if self._sync is not None:
+            return await asyncio.to_thread(
+                self._sync.enqueue_jobs, carteirinhas, category, scheduled_bucket, job_type,
+                skip_open, skip_recent_hours, force, min_recheck_hours
+            )
+        try:
+            return await self._rpc_json(
+                "SELECT public.enqueue_jobs(%s::text[], %s, %s, %s, %s, %s, %s, %s)",
+                (list(carteirinhas), category, scheduled_bucket, job_type, skip_open, skip_recent_hours,
+                 force, min_recheck_hours),
+                'enqueue'
+            )
+        except Exception as e:
+            logger.error(f"Erro em enqueue_jobs: {e}")
+            raise
+
+    async def lane_latency_stats(self, job_type: str = 'sgucard', window_hours: int = 24) -> Dict:
+        """Latência e backlog por lane (RPC lane_latency_stats)."""
+        if self._sync is not None:
+            return await asyncio.to_thread(self._sync.lane_latency_stats, job_type, window_hours)
+        try:
+            return await self._rpc_json("SELECT public.lane_latency_stats(%s, %s)", (job_type, window_hours), 'stats')
+        except Exception as e:
+            logger.error(f"Falha em lane_latency_stats: {e}")
+            return {}
+
+    async def queue_stats(self, job_type: Optional[str] = None) -> Dict:
+        """Painel da fila em uma consulta (RPC queue_stats)."""
+        if self._sync is not None:
+            return await asyncio.to_thread(self._sync.queue_stats, job_type)
+        try:
+            return await self._rpc_json("SELECT public.queue_stats(%s)", (job_type,), 'stats')
+        except Exception as e:
+            logger.error(f"Falha em queue_stats: {e}")
+            return {}
@@ -1,15 +1,21 @@
 import os
 import psycopg
+from psycopg import sql
+from psycopg_pool import ConnectionPool
 import schedule
 import time
 import logging
+import threading
 from datetime import datetime, timedelta, date
 from dotenv import load_dotenv
 from typing import List, Dict, Optional, Union
 import json
 import hashlib
+from contextlib import contextmanager
 import win32com.client as win32
 from supabase import create_client, Client
+from job_storage import JobStorage, SqlJobBackend, RestJobBackend
+from query_metrics import TrackedCursor, tagged, operation, current_operation
 
 # Configurar logging
 logging.basicConfig(
@@ -19,94 +25,274 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Pool de conexões e cliente Supabase compartilhados pelo processo (ver get_db_pool)
+_db_pool: Optional[ConnectionPool] = None
+_db_pool_lock = threading.Lock()
+_supabase_client = None
+_supabase_client_lock = threading.Lock()
+
+
+def db_pool_enabled() -> bool:
+    return os.getenv('DB_POOL_ENABLED', 'true').lower() in ('1', 'true', 'yes', 'on')
+
+
+def db_pool_settings() -> Dict:
+    """Tamanho, reciclagem e timeout dos pools (síncrono e assíncrono), via DB_POOL_*."""
+    return {
+        'min_size': int(os.getenv('DB_POOL_MIN_SIZE', '1')),
+        'max_size': int(os.getenv('DB_POOL_MAX_SIZE', '10')),
+        'max_lifetime': float(os.getenv('DB_POOL_MAX_LIFETIME_SECONDS', '1800')),
+        'max_idle': float(os.getenv('DB_POOL_MAX_IDLE_SECONDS', '300')),
+        'timeout': float(os.getenv('DB_POOL_TIMEOUT_SECONDS', '10')),
+    }
+
+
+def get_db_pool() -> Optional[ConnectionPool]:
+    """Cria (uma vez) o pool de conexões do processo. Retorna None se DB_POOL_ENABLED=false."""
+    global _db_pool
+    if not db_pool_enabled():
+        return None
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                load_dotenv()
+                _db_pool = ConnectionPool(
+                    kwargs=DatabaseManager._connection_params(),
+                    **db_pool_settings(),
+                    # Testa a conexão (SELECT 1 implícito) antes de entregá-la: descarta conexões quebradas
+                    check=ConnectionPool.check_connection,
+                    name='carteirinhas',
+                    open=True,
+                )
+                logger.info(f"Pool de conexões aberto (min={_db_pool.min_size}, max={_db_pool.max_size})")
+    return _db_pool
+
+
+def close_db_pool():
+    """Fecha o pool do processo (shutdown da API)."""
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is not None:
+            _db_pool.close()
+            _db_pool = None
+            logger.info("Pool de conexões fechado")
+
+
+def get_supabase_client():
+    """Cliente Supabase compartilhado pelo processo (None sem credenciais)."""
+    global _supabase_client
+    if _supabase_client is None:
+        with _supabase_client_lock:
+            if _supabase_client is None:
+                supabase_url = os.getenv('SUPABASE_URL')
+                supabase_key = os.getenv('SUPABASE_SERVICE_ROLE_KEY')
+                if not (supabase_url and supabase_key):
+                    logger.warning("Credenciais Supabase não encontradas - cliente não inicializado")
+                    return None
+                _supabase_client = create_client(supabase_url, supabase_key)
+                logger.info("Cliente Supabase inicializado com sucesso")
+    return _supabase_client
+
+
 class DatabaseManager:
     """Gerenciador de conexão e operações com o banco de dados Supabase"""
     
-    def __init__(self):
+    def __init__(self, pooled: bool = True, per_thread: bool = False):
+        """
+        pooled=True empresta a conexão do pool do processo, se ele já foi aberto (get_db_pool,
+        feito no startup da API); close() a devolve. Instâncias de vida longa ou que dependem
+        de estado de sessão (advisory locks) devem usar pooled=False: conexão própria.
+
+        per_thread=True dá a cada thread que usa a instância sua própria conexão (aberta no
+        primeiro uso), para chamadas concorrentes não dividirem transação. A conexão aberta
+        aqui fica com a thread criadora e guarda o estado de sessão (advisory locks); as das
+        demais threads podem ser devolvidas ao fim de cada operação (release_thread_connection).
+        """
         load_dotenv()
-        self.connection = None
+        self._pool: Optional[ConnectionPool] = _db_pool if pooled else None
+        self._per_thread = per_thread
+        self._local = threading.local()
+        self._thread_connections = []
+        self._thread_connections_lock = threading.Lock()
+        self._connection = None
         self._connect()
-        # Inicializar cliente Supabase
+        # Cliente Supabase é compartilhado: create_client por instância custa um handshake HTTP
         try:
-            supabase_url = os.getenv('SUPABASE_URL')
-            supabase_key = os.getenv('SUPABASE_SERVICE_ROLE_KEY')
-            if supabase_url and supabase_key:
-                self.supabase: Client = create_client(supabase_url, supabase_key)
-                logger.info("Cliente Supabase inicializado com sucesso")
-            else:
-                logger.warning("Credenciais Supabase não encontradas - cliente não inicializado")
-                self.supabase = None
+            self.supabase: Client = get_supabase_client()
         except Exception as e:
             logger.error(f"Erro ao inicializar cliente Supabase: {e}")
             self.supabase = None
+        # Operações da fila roteadas entre SQL direto e Supabase REST conforme a saúde de cada um
+        self.storage = JobStorage(SqlJobBackend(self), RestJobBackend(self.supabase) if self.supabase else None)
     
+    @staticmethod
+    def _connection_params() -> Dict:
+        """Parâmetros de conexão direta ao Postgres do Supabase"""
+        supabase_url = os.getenv('SUPABASE_URL')
+        project_id = supabase_url.replace('https://', '').replace('.supabase.co', '')
+        return {
+            'host': f'db.{project_id}.supabase.co',
+            'dbname': 'postgres',
+            'user': 'postgres',
+            'password': os.getenv('SUPABASE_PASSWORD'),
+            'port': '5432',
+            'sslmode': 'require'
+        }
+
+    def _open_connection(self):
+        """Abre uma conexão (emprestada do pool, quando houver)"""
+        if self._pool is not None:
+            conn = self._pool.getconn()
+        else:
+            conn = psycopg.connect(**self._connection_params())
+            logger.info("Conexão com banco de dados estabelecida")
+        # Todo execute desta conexão alimenta as métricas de consulta (query_metrics)
+        conn.cursor_factory = TrackedCursor
+        return conn
+
+    def _release_connection(self, conn):
+        if self._pool is not None:
+            # O pool faz rollback de transação pendente e descarta conexões quebradas
+            self._pool.putconn(conn)
+        else:
+            conn.close()
+
     def _connect(self):
         """Estabelece conexão com o banco de dados"""
         try:
-            supabase_url = os.getenv('SUPABASE_URL')
-            project_id = supabase_url.replace('https://', '').replace('.supabase.co', '')
-            
-            self.connection = psycopg.connect(
-                host=f'db.{project_id}.supabase.co',
-                dbname='postgres',
-                user='postgres',
-                password=os.getenv('SUPABASE_PASSWORD'),
-                port='5432',
-                sslmode='require'
-            )
-            logger.info("Conexão com banco de dados estabelecida")
+            self._connection = self._open_connection()
+            self._local.conn = self._connection
         except Exception as e:
             logger.error(f"Erro ao conectar com banco: {e}")
             raise
+
+    @property
+    def connection(self):
+        """Conexão da thread atual (per_thread) ou a conexão única da instância."""
+        if not self._per_thread or self._connection is None:
+            return self._connection
+        conn = getattr(self._local, 'conn', None)
+        # A conexão da thread criadora não é trocada: perdê-la significa perder os advisory locks
+        if conn is None or (conn.closed and conn is not self._connection):
+            new_conn = self._open_connection()
+            with self._thread_connections_lock:
+                if conn is not None and conn in self._thread_connections:
+                    self._thread_connections.remove(conn)
+                self._thread_connections.append(new_conn)
+            self._local.conn = conn = new_conn
+        return conn
+
+    def release_thread_connection(self):
+        """Devolve ao pool (ou fecha) a conexão per_thread da thread atual; o próximo uso abre outra.
+        A conexão da thread criadora é mantida."""
+        conn = getattr(self._local, 'conn', None)
+        if not self._per_thread or conn is None or conn is self._connection:
+            return
+        self._local.conn = None
+        with self._thread_connections_lock:
+            if conn not in self._thread_connections:
+                # close() já liberou
+                return
+            self._thread_connections.remove(conn)
+        try:
+            self._release_connection(conn)
+        except Exception as e:
+            logger.warning(f"Erro ao liberar conexão da thread: {e}")
+
+    @contextmanager
+    def _cursor(self):
+        """Cursor de uma operação: commit ao sair, rollback em erro, sem deixar transação aberta."""
+        conn = self.connection
+        cursor = conn.cursor()
+        try:
+            yield cursor
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    def open_listener(self, channel: str):
+        """Abre uma conexão dedicada (autocommit) já inscrita via LISTEN no canal informado."""
+        conn = psycopg.connect(**self._connection_params(), autocommit=True)
+        conn.execute(sql.SQL("LISTEN {}").format(sql.Identifier(channel)))
+        return conn
     
-    def execute_query(self, query: str, params: tuple = None, fetch: bool = False):
-        """Executa uma query no banco de dados"""
+    def execute_query(self, query: str, params: tuple = None, fetch: bool = False, op: Optional[str] = None):
+        """Executa uma query no banco de dados (uma transação por chamada); `op` marca a operação nas métricas"""
         try:
-            cursor = self.connection.cursor()
-            cursor.execute(query, params)
-            
-            if fetch:
-                result = cursor.fetchall()
-                cursor.close()
-                return result
-            else:
-                self.connection.commit()
-                cursor.close()
-                return True
+            with operation(op or current_operation()), self._cursor() as cursor:
+                cursor.execute(query, params)
+                return cursor.fetchall() if fetch else True
         except Exception as e:
-            self.connection.rollback()
             logger.error(f"Erro ao executar query: {e}")
             raise
 
-    def acquire_worker_lock(self, worker_id: str) -> bool:
-        """Tenta adquirir um advisory lock exclusivo para o worker."""
+    @staticmethod
+    def _advisory_key(name: str) -> int:
+        """Key estável (bigint) para advisory locks a partir de um nome."""
+        key_src = name.encode("utf-8")
+        return int(hashlib.sha1(key_src).hexdigest()[:16], 16) % (2**63 - 1)
+
+    @tagged('lock')
+    def try_advisory_lock(self, name: str) -> bool:
+        """Tenta adquirir um advisory lock de sessão (liberado também quando a conexão cai)."""
         try:
-            # Key estável baseada no worker_id
-            key_src = f"sgucard_worker:{worker_id}".encode("utf-8")
-            key = int(hashlib.sha1(key_src).hexdigest()[:16], 16) % (2**63 - 1)
-            cursor = self.connection.cursor()
-            cursor.execute("SELECT pg_try_advisory_lock(%s)", (key,))
-            row = cursor.fetchone()
-            cursor.close()
+            # O lock é de sessão: sobrevive ao commit, que só encerra a transação do SELECT
+            with self._cursor() as cursor:
+                cursor.execute("SELECT pg_try_advisory_lock(%s)", (self._advisory_key(name),))
+                row = cursor.fetchone()
             return bool(row and row[0])
         except Exception as e:
-            logger.error(f"Falha ao adquirir worker lock: {e}")
+            logger.error(f"Falha ao adquirir advisory lock {name}: {e}")
             return False
 
-    def release_worker_lock(self, worker_id: str) -> bool:
-        """Libera o advisory lock exclusivo do worker, se detido."""
+    @tagged('lock')
+    def advisory_unlock(self, name: str) -> bool:
+        """Libera um advisory lock de sessão, se detido."""
         try:
-            key_src = f"sgucard_worker:{worker_id}".encode("utf-8")
-            key = int(hashlib.sha1(key_src).hexdigest()[:16], 16) % (2**63 - 1)
-            cursor = self.connection.cursor()
-            cursor.execute("SELECT pg_advisory_unlock(%s)", (key,))
-            row = cursor.fetchone()
-            cursor.close()
+            # O lock é de sessão: sobrevive ao commit, que só encerra a transação do SELECT
+            with self._cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", (self._advisory_key(name),))
+                row = cursor.fetchone()
+            return bool(row and row[0])
+        except Exception as e:
+            logger.error(f"Falha ao liberar advisory lock {name}: {e}")
+            return False
+
+    @tagged('lock')
+    def holds_advisory_lock(self, name: str) -> bool:
+        """Confere, na própria sessão, que o advisory lock continua detido (falha de conexão → False)."""
+        key = self._advisory_key(name)
+        try:
+            # pg_advisory_lock(bigint) aparece em pg_locks como classid = 32 bits altos, objid = 32 baixos
+            with self._cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT EXISTS (
+                      SELECT 1 FROM pg_locks
+                       WHERE locktype = 'advisory' AND pid = pg_backend_pid() AND granted
+                         AND classid = %s::oid AND objid = %s::oid AND objsubid = 1
+                    )
+                    """,
+                    (key >> 32, key & 0xFFFFFFFF)
+                )
+                row = cursor.fetchone()
             return bool(row and row[0])
         except Exception as e:
-            logger.error(f"Falha ao liberar worker lock: {e}")
+            logger.error(f"Falha ao verificar advisory lock {name}: {e}")
             return False
+
+    def acquire_worker_lock(self, worker_id: str) -> bool:
+        """Tenta adquirir um advisory lock exclusivo para o worker."""
+        return self.try_advisory_lock(f"sgucard_worker:{worker_id}")
+
+    def release_worker_lock(self, worker_id: str) -> bool:
+        """Libera o advisory lock exclusivo do worker, se detido."""
+        return self.advisory_unlock(f"sgucard_worker:{worker_id}")
     
+    @tagged('carteirinhas')
     def get_carteirinhas_for_processing(self, modo: str, carteirinha_especifica: str = None, 
                                       data_inicial: date = None, data_final: date = None) -> List[Dict]:
         """Busca carteirinhas para processamento baseado no modo de execução"""
@@ -156,6 +342,7 @@ class DatabaseManager:
             logger.error(f"Erro ao buscar carteirinhas: {e}")
             return []
     
+    @tagged('guia_upsert')
     def save_guia_data(self, guia_data: Dict) -> bool:
         """Salva ou atualiza dados de guia na tabela BaseGuias"""
         try:
@@ -219,6 +406,7 @@ class DatabaseManager:
             logger.error(f"Erro ao salvar dados da guia: {e}")
             return False
     
+    @tagged('log')
     def log_execution(self, tipo_execucao: str, status: str, tempo_execucao: timedelta,
                      carteirinhas_processadas: int, guias_inseridas: int, 
                      guias_atualizadas: int, mensagem: str = None, erro: str = None):
@@ -238,6 +426,7 @@ class DatabaseManager:
         except Exception as e:
             logger.error(f"Erro ao registrar log: {e}")
     
+    @tagged('carteirinhas')
     def get_carteirinhas_ativas(self) -> List[Dict]:
         """Busca todas as carteirinhas ativas"""
         try:
@@ -257,6 +446,7 @@ class DatabaseManager:
             logger.error(f"Erro ao buscar carteirinhas ativas: {e}")
             return []
     
+    @tagged('carteirinhas')
     def get_carteirinhas_por_periodo(self, data_inicial: str, data_final: str) -> List[Dict]:
         """Busca carteirinhas com agendamentos em um período específico"""
         try:
@@ -282,6 +472,7 @@ class DatabaseManager:
             logger.error(f"Erro ao buscar carteirinhas por período: {e}")
             return []
     
+    @tagged('guia_upsert')
     def inserir_ou_atualizar_guia(self, guia_data: Dict) -> str:
         """Insere nova guia ou atualiza existente"""
         try:
@@ -343,30 +534,30 @@ class DatabaseManager:
             logger.error(f"Erro ao inserir/atualizar guia: {e}")
             return "erro"
     
+    @tagged('health')
     def test_connection(self):
         """Testa conexão com banco de dados"""
         try:
-            cursor = self.connection.cursor()
-            cursor.execute("SELECT 1")
-            cursor.fetchone()
-            cursor.close()
+            with self._cursor() as cursor:
+                cursor.execute("SELECT 1")
+                cursor.fetchone()
             return True
         except Exception as e:
             logger.error(f"Erro ao testar conexão: {str(e)}")
             return False
     
+    @tagged('stats')
     def get_database_stats(self):
         """Retorna estatísticas do banco de dados"""
         stats = {}
         tables = ['pagamentos', 'carteirinhas', 'agendamentos', 'baseguias', 'logs']
         
         try:
-            cursor = self.connection.cursor()
-            for table in tables:
-                cursor.execute(f"SELECT COUNT(*) FROM {table}")
-                count = cursor.fetchone()[0]
-                stats[table] = count
-            cursor.close()
+            with self._cursor() as cursor:
+                for table in tables:
+                    cursor.execute(f"SELECT COUNT(*) FROM {table}")
+                    count = cursor.fetchone()[0]
+                    stats[table] = count
         except Exception as e:
             logger.error(f"Erro ao obter estatísticas: {str(e)}")
             for table in tables:
@@ -374,13 +565,13 @@ class DatabaseManager:
         
         return stats
     
+    @tagged('health')
     def get_sample_carteirinha(self):
         """Retorna uma carteirinha de exemplo"""
         try:
-            cursor = self.connection.cursor()
-            cursor.execute("SELECT carteiras, paciente FROM carteirinhas LIMIT 1")
-            result = cursor.fetchone()
-            cursor.close()
+            with self._cursor() as cursor:
+                cursor.execute("SELECT carteiras, paciente FROM carteirinhas LIMIT 1")
+                result = cursor.fetchone()
             
             if result:
                 return {'carteirinha': result[0], 'nome': result[1]}
@@ -390,155 +581,188 @@ class DatabaseManager:
             return None
 
     # Métodos de Jobs (RPC Supabase)
-    def claim_jobs(self, worker_id: str, claim_limit: int = 1) -> List[Dict]:
-        """Reivindica jobs pendentes via RPC no Supabase."""
+    def claim_jobs(self, worker_id: str, claim_limit: int = 1, job_type: str = 'sgucard') -> List[Dict]:
+        """Reivindica jobs elegíveis (prioridade, agendamento, backoff e tentativas) via RPC claim_jobs."""
+        vt = int(os.getenv("VISIBILITY_TIMEOUT_SECONDS", "90"))
         try:
-            if not getattr(self, 'supabase', None):
-                logger.warning("Supabase não inicializado; claim_jobs retorna vazio")
-                return []
-            vt = int(os.getenv("VISIBILITY_TIMEOUT_SECONDS", "900"))
-            res = self.supabase.rpc('claim_jobs', {
+            return self.storage.rpc('claim_jobs', {
                 'worker_id': worker_id,
                 'claim_limit': claim_limit,
                 'p_visibility_timeout_seconds': vt,
-                'job_type': 'sgucard'
-            }).execute()
-            data = getattr(res, 'data', None)
-            if data is None:
-                logger.info("Nenhum job retornado pelo RPC claim_jobs")
-                return []
-            return data
+                'job_type': job_type
+            }) or []
         except Exception as e:
             logger.error(f"Erro ao reivindicar jobs: {e}")
             return []
 
     def complete_job(self, job_id: str, worker_id: str, result: Dict) -> bool:
-        """Marca job como concluído via RPC no Supabase."""
+        """Marca job como concluído via RPC complete_job."""
         try:
-            if not getattr(self, 'supabase', None):
-                logger.warning("Supabase não inicializado; complete_job ignorado")
-                return False
-            res = self.supabase.rpc('complete_job', {
+            return bool(self.storage.rpc('complete_job', {
                 'job_id': job_id,
                 'worker_id': worker_id,
                 'result': result
-            }).execute()
-            data = getattr(res, 'data', None)
-            return bool(data)
+            }))
         except Exception as e:
             logger.error(f"Erro ao completar job {job_id}: {e}")
             return False
 
+    @staticmethod
+    def _retry_backoff() -> tuple:
+        """(base, teto) em segundos do backoff exponencial entre tentativas de um job."""
+        base = int(os.getenv("JOB_RETRY_BACKOFF_SECONDS", "60"))
+        cap = int(os.getenv("JOB_RETRY_BACKOFF_MAX_SECONDS", "3600"))
+        return base, cap
+
     def fail_job(self, job_id: str, worker_id: str, error: str) -> bool:
-        """Marca job como falho e libera o lock; funciona com Supabase ou SQL."""
+        """Marca job como falho (com backoff exponencial) e libera o lock, se pertencer ao worker."""
+        base, cap = self._retry_backoff()
         try:
-            if getattr(self, 'supabase', None):
-                try:
-                    res = self.supabase.rpc('fail_job', {
-                        'job_id': job_id,
-                        'worker_id': worker_id,
-                        'error': error
-                    }).execute()
-                    data = getattr(res, 'data', None)
-                    if bool(data):
-                        return True
-                except Exception as e:
-                    logger.warning(f"Supabase RPC fail_job falhou: {e}")
-            # Fallback SQL: atualiza somente se o lock pertencer ao worker
-            try:
-                cursor = self.connection.cursor()
-                cursor.execute(
-                    """
-                    UPDATE job_carteirinhas
-                       SET status='error',
-                           error=%s,
-                           locked_by=NULL,
-                           locked_at=NULL,
-                           locked_until=NULL,
-                           updated_at=NOW()
-                     WHERE id=%s AND locked_by=%s AND status='processing'
-                    """,
-                    (error, job_id, worker_id)
-                )
-                self.connection.commit()
-                rows = cursor.rowcount
-                cursor.close()
-                return rows > 0
-            except Exception as e:
-                logger.error(f"Erro SQL fallback fail_job para job {job_id}: {e}")
-                return False
+            return bool(self.storage.rpc('fail_job', {
+                'job_id': job_id,
+                'worker_id': worker_id,
+                'p_error': error,
+                'p_backoff_base_seconds': base,
+                'p_backoff_max_seconds': cap,
+            }))
         except Exception as e:
             logger.error(f"Erro ao marcar falha no job {job_id}: {e}")
             return False
 
+    def heartbeat_job(self, job_id: str, worker_id: str, visibility_timeout_seconds: int = 90) -> bool:
+        """Renova o lease (locked_until) de um job em processing do worker."""
+        try:
+            return bool(self.storage.rpc('heartbeat_job', {
+                'job_id': job_id,
+                'worker_id': worker_id,
+                'p_visibility_timeout_seconds': visibility_timeout_seconds,
+            }))
+        except Exception as e:
+            logger.error(f"Erro no heartbeat do job {job_id}: {e}")
+            return False
+
+    def heartbeat_jobs(self, job_ids: List[str], worker_id: str, visibility_timeout_seconds: int = 90) -> int:
+        """Renova o lease de vários jobs do worker em um único UPDATE; devolve quantos foram renovados."""
+        if not job_ids:
+            return 0
+        try:
+            return int(self.storage.rpc('heartbeat_jobs', {
+                'p_job_ids': list(job_ids),
+                'p_worker_id': worker_id,
+                'p_visibility_timeout_seconds': visibility_timeout_seconds,
+            }) or 0)
+        except Exception as e:
+            logger.error(f"Erro no heartbeat de jobs: {e}")
+            return 0
+
+    def complete_jobs(self, job_ids: List[str], worker_id: str,
+                      durations: Optional[List[Optional[float]]] = None) -> Optional[int]:
+        """Marca vários jobs como success em um único UPDATE (RPC complete_jobs); devolve quantos foram atualizados
+        ou None se a gravação falhou (o chamador deve tentar de novo). `durations` (s, alinhado com job_ids)
+        é a duração medida do scrape; sem ela o RPC usa o tempo desde o claim."""
+        if not job_ids:
+            return 0
+        try:
+            return int(self.storage.rpc('complete_jobs', {
+                'p_job_ids': list(job_ids),
+                'p_worker_id': worker_id,
+                'p_durations': list(durations) if durations is not None else None,
+            }) or 0)
+        except Exception as e:
+            logger.error(f"Erro ao concluir jobs em lote: {e}")
+            return None
+
+    def fail_jobs(self, job_ids: List[str], errors: List[str], worker_id: str) -> Optional[int]:
+        """Marca vários jobs como error em um único UPDATE (RPC fail_jobs); errors alinhado com job_ids.
+        Devolve None se a gravação falhou."""
+        if not job_ids:
+            return 0
+        base, cap = self._retry_backoff()
+        try:
+            return int(self.storage.rpc('fail_jobs', {
+                'p_job_ids': list(job_ids),
+                'p_errors': list(errors),
+                'p_worker_id': worker_id,
+                'p_backoff_base_seconds': base,
+                'p_backoff_max_seconds': cap,
+            }) or 0)
+        except Exception as e:
+            logger.error(f"Erro ao marcar jobs com erro em lote: {e}")
+            return None
+
     def release_job(self, job_id: str, worker_id: str) -> bool:
-        """Libera job em processing para voltar a pending; tenta RPC e faz fallback SQL."""
+        """Libera job em processing para voltar a pending."""
         try:
-            if getattr(self, 'supabase', None):
-                try:
-                    res = self.supabase.rpc('release_job', {
-                        'job_id': job_id,
-                        'worker_id': worker_id,
-                    }).execute()
-                    data = getattr(res, 'data', None)
-                    if bool(data):
-                        return True
-                except Exception as e:
-                    logger.warning(f"Supabase RPC release_job falhou: {e}")
-            # Fallback SQL direto
-            try:
-                cursor = self.connection.cursor()
-                cursor.execute(
-                    """
-                    UPDATE job_carteirinhas
-                       SET status='pending',
-                           locked_by=NULL,
-                           locked_at=NULL,
-                           locked_until=NULL,
-                           updated_at=NOW()
-                     WHERE id=%s AND locked_by=%s AND status='processing'
-                    """,
-                    (job_id, worker_id)
-                )
-                self.connection.commit()
-                rows = cursor.rowcount
-                cursor.close()
-                return rows > 0
-            except Exception as e:
-                logger.error(f"Erro SQL fallback release_job para job {job_id}: {e}")
-                return False
+            return bool(self.storage.rpc('release_job', {
+                'job_id': job_id,
+                'worker_id': worker_id,
+            }))
         except Exception as e:
             logger.error(f"Erro ao liberar job {job_id}: {e}")
             return False
 
-    # Fallback simples baseado em tabela job_carteirinhas
-    def insert_job_carteirinha(self, type: str, carteirinha: str, carteira: Optional[str] = None, id_paciente: Optional[str] = None) -> Dict:
+    def recent_job_durations(self, job_type: str = 'sgucard', limit: int = 200) -> List[float]:
+        """Durações (s) dos últimos jobs concluídos com sucesso, para semear o deadline do worker."""
         try:
+            return self.storage.call('recent_job_durations', job_type, limit)
+        except Exception as e:
+            logger.error(f"Falha em recent_job_durations: {e}")
+            return []
+
+    def release_jobs(self, job_ids: List[str], worker_id: str) -> int:
+        """Devolve vários jobs em processing do worker para pending em um único UPDATE; devolve quantos foram liberados."""
+        if not job_ids:
+            return 0
+        try:
+            return int(self.storage.rpc('release_jobs', {
+                'p_job_ids': list(job_ids),
+                'p_worker_id': worker_id,
+            }) or 0)
+        except Exception as e:
+            logger.error(f"Erro ao liberar jobs em lote: {e}")
+            return 0
+
+    # O trigger trg_job_carteirinhas_enqueued emite NOTIFY job_carteirinhas_enqueued a cada insert
+    def insert_job_carteirinha(self, type: str, carteirinha: str, carteira: Optional[str] = None, id_paciente: Optional[str] = None,
+                               force: bool = False, category: str = 'adhoc') -> Dict:
+        try:
+            # force=True ignora o intervalo de recheck (min_recheck_interval_hours) no claim;
+            # jobs avulsos entram na lane 'adhoc' (prioridade definida pelo trigger trg_job_carteirinhas_lane)
             payload = {
                 'type': type,
                 'carteirinha': carteirinha,
                 'carteira': carteira or carteirinha,
-                'id_paciente': id_paciente
+                'id_paciente': id_paciente,
+                'force': force,
+                'category': category
             }
-            if getattr(self, 'supabase', None):
-                res = self.supabase.table('job_carteirinhas').insert(payload).execute()
-                data = getattr(res, 'data', None)
-                return {'status': 'created', 'job': data[0] if data else payload}
-            # SQL fallback
-            cursor = self.connection.cursor()
-            cursor.execute(
-                "INSERT INTO job_carteirinhas (type, carteirinha, carteira, id_paciente) VALUES (%s, %s, %s, %s) RETURNING id",
-                (payload['type'], payload['carteirinha'], payload['carteira'], payload['id_paciente'])
-            )
-            job_id = cursor.fetchone()[0]
-            self.connection.commit()
-            cursor.close()
-            payload['id'] = job_id
-            return {'status': 'created', 'job': payload}
+            return {'status': 'created', 'job': self.storage.call('insert_job', payload)}
         except Exception as e:
             logger.error(f"Erro ao inserir job_carteirinha: {e}")
             raise
 
+    def enqueue_jobs(self, carteirinhas: List[str], category: str = 'adhoc', scheduled_bucket: Optional[str] = None,
+                     job_type: str = 'sgucard', skip_open: bool = True, skip_recent_hours: int = 0,
+                     force: bool = False, min_recheck_hours: Optional[int] = 6) -> Dict:
+        """Enfileira carteirinhas em lote (RPC enqueue_jobs, um único INSERT idempotente por bucket).
+        Retorna as contagens {requested, created, duplicates, skipped_open, skipped_recent}; levanta em falha."""
+        try:
+            data = self.storage.rpc('enqueue_jobs', {
+                'p_carteirinhas': list(carteirinhas),
+                'p_category': category,
+                'p_scheduled_bucket': scheduled_bucket,
+                'job_type': job_type,
+                'p_skip_open': skip_open,
+                'p_skip_recent_hours': skip_recent_hours,
+                'p_force': force,
+                'p_min_recheck_hours': min_recheck_hours,
+            })
+            return data if isinstance(data, dict) else {}
+        except Exception as e:
+            logger.error(f"Erro em enqueue_jobs: {e}")
+            raise
+
+    @tagged('claim')
     def fetch_jobs_simple(self, limit: int = 1, statuses: Optional[List[str]] = None) -> List[Dict]:
         try:
             statuses = statuses or ['pending', 'error']
@@ -562,7 +786,6 @@ class DatabaseManager:
                 except Exception as e:
                     logger.warning(f"Supabase REST fetch_jobs_simple com filtro de lock falhou: {e}")
             # Fallback SQL direto com filtro de lock
-            cursor = self.connection.cursor()
             placeholders = ','.join(['%s'] * len(statuses))
             query = (
                 f"SELECT id, type, carteirinha, carteira, id_paciente, status "
@@ -571,9 +794,9 @@ class DatabaseManager:
                 f"AND (locked_until IS NULL OR locked_until < NOW()) "
                 f"ORDER BY created_at ASC LIMIT %s"
             )
-            cursor.execute(query, (*statuses, limit))
-            rows = cursor.fetchall()
-            cursor.close()
+            with self._cursor() as cursor:
+                cursor.execute(query, (*statuses, limit))
+                rows = cursor.fetchall()
             jobs = []
             for r in rows:
                 jobs.append({'id': r[0], 'type': r[1], 'carteirinha': r[2], 'carteira': r[3], 'id_paciente': r[4], 'status': r[5]})
@@ -585,42 +808,74 @@ class DatabaseManager:
     def purge_stale_processing(self, job_type: str = 'sgucard') -> int:
         """Reabre jobs 'processing' cujo locked_until já expirou, devolvendo contagem de afetados."""
         try:
-            if getattr(self, 'supabase', None):
-                try:
-                    res = self.supabase.rpc('purge_stale_processing', {'job_type': job_type}).execute()
-                    data = getattr(res, 'data', None)
-                    if isinstance(data, dict) and 'count' in data:
-                        return int(data['count'])
-                    if isinstance(data, (int, float)):
-                        return int(data)
-                except Exception as e:
-                    logger.warning(f"Supabase RPC purge_stale_processing falhou: {e}")
-            cursor = self.connection.cursor()
-            try:
-                cursor.execute(
-                    """
-                    UPDATE job_carteirinhas
-                       SET status='pending',
-                           locked_by=NULL,
-                           locked_at=NULL,
-                           locked_until=NULL,
-                           updated_at=NOW()
-                     WHERE type=%s AND status='processing' AND locked_until < NOW()
-                    """,
-                    (job_type,)
-                )
-                count = cursor.rowcount
-                self.connection.commit()
-                cursor.close()
-                return int(count or 0)
-            except Exception as e:
-                cursor.close()
-                logger.error(f"Erro SQL fallback purge_stale_processing: {e}")
-                return 0
+            return int(self.storage.rpc('purge_stale_processing', {'job_type': job_type}) or 0)
         except Exception as e:
             logger.error(f"Falha em purge_stale_processing: {e}")
             return 0
 
+    def janitor_sweep(self, job_type: str = 'sgucard', retention_days: int = 30) -> Dict:
+        """Manutenção da fila (leases vencidos, locks órfãos, retenção) via RPC janitor_sweep."""
+        try:
+            data = self.storage.rpc('janitor_sweep', {'job_type': job_type, 'p_retention_days': retention_days})
+            return data if isinstance(data, dict) else {}
+        except Exception as e:
+            logger.error(f"Falha em janitor_sweep: {e}")
+            return {}
+
+    def age_job_priorities(self, job_type: str = 'sgucard', step_seconds: int = 1800, floor: int = 2) -> int:
+        """Aging das lanes (RPC age_job_priorities): sobe um nível de prioridade a cada step_seconds de espera."""
+        try:
+            return int(self.storage.rpc('age_job_priorities', {
+                'job_type': job_type, 'p_step_seconds': step_seconds, 'p_floor': floor
+            }) or 0)
+        except Exception as e:
+            logger.error(f"Falha em age_job_priorities: {e}")
+            return 0
+
+    def lane_latency_stats(self, job_type: str = 'sgucard', window_hours: int = 24) -> Dict:
+        """Latência (espera e ponta a ponta, p50/p95) e backlog por lane via RPC lane_latency_stats."""
+        try:
+            data = self.storage.rpc('lane_latency_stats', {'job_type': job_type, 'p_window_hours': window_hours})
+            return data if isinstance(data, dict) else {}
+        except Exception as e:
+            logger.error(f"Falha em lane_latency_stats: {e}")
+            return {}
+
+    def queue_stats(self, job_type: Optional[str] = None) -> Dict:
+        """Painel da fila em uma consulta (RPC queue_stats): status por tipo, pending mais antigo,
+        processing por worker, leases vencidos e histograma de tentativas."""
+        try:
+            data = self.storage.rpc('queue_stats', {'job_type': job_type})
+            return data if isinstance(data, dict) else {}
+        except Exception as e:
+            logger.error(f"Falha em queue_stats: {e}")
+            return {}
+
+    def archive_finished_jobs(self, job_type: str = 'sgucard', archive_after_hours: int = 24, batch_size: int = 1000) -> int:
+        """Move um lote de jobs 'success' para job_carteirinhas_archive (RPC archive_finished_jobs); retorna quantos moveu."""
+        try:
+            return int(self.storage.rpc('archive_finished_jobs', {
+                'job_type': job_type, 'p_archive_after_hours': archive_after_hours, 'p_batch_size': batch_size
+            }) or 0)
+        except Exception as e:
+            logger.error(f"Falha em archive_finished_jobs: {e}")
+            return 0
+
+    def take_portal_tokens(self, bucket: str, tokens: float, capacity: float, refill_per_second: float) -> Optional[float]:
+        """Token bucket da frota (RPC take_portal_tokens): 0 = concedido, >0 = segundos de espera, None = falha."""
+        try:
+            data = self.storage.rpc('take_portal_tokens', {
+                'p_bucket': bucket,
+                'p_tokens': tokens,
+                'p_capacity': capacity,
+                'p_refill_per_second': refill_per_second,
+            })
+            return float(data) if isinstance(data, (int, float)) else None
+        except Exception as e:
+            logger.error(f"Falha em take_portal_tokens: {e}")
+            return None
+
+    @tagged('claim')
     def start_job_processing(self, job_id: str, worker_id: str, visibility_timeout_seconds: int = 900) -> bool:
         try:
             # Tentar via Supabase REST
@@ -673,6 +928,7 @@ class DatabaseManager:
             logger.error(f"Falha em start_job_processing para job {job_id}: {e}")
             return False
 
+    @tagged('ack')
     def mark_job_processed(self, job_id: str) -> bool:
         try:
             if getattr(self, 'supabase', None):
@@ -708,6 +964,7 @@ class DatabaseManager:
             logger.error(f"Erro ao marcar job {job_id} como processado: {e}")
             return False
 
+    @tagged('ack')
     def mark_job_failed(self, job_id: str, error: str) -> bool:
         try:
             if getattr(self, 'supabase', None):
@@ -744,10 +1001,10 @@ class DatabaseManager:
             logger.error(f"Erro ao marcar job {job_id} como erro: {e}")
             return False
 
+    @tagged('carteirinhas')
     def get_carteirinhas_with_appointments(self, data):
         """Retorna carteirinhas com agendamentos para uma data específica"""
         try:
-            cursor = self.connection.cursor()
             query = """
                 SELECT DISTINCT c.carteiras as carteirinha, c.paciente 
                 FROM carteirinhas c
@@ -755,9 +1012,9 @@ class DatabaseManager:
                 WHERE a.data = %s
                 ORDER BY c.paciente
             """
-            cursor.execute(query, (data,))
-            results = cursor.fetchall()
-            cursor.close()
+            with self._cursor() as cursor:
+                cursor.execute(query, (data,))
+                results = cursor.fetchall()
             
             carteirinhas = []
             for result in results:
@@ -771,70 +1028,19 @@ class DatabaseManager:
             logger.error(f"Erro ao buscar carteirinhas com agendamentos: {str(e)}")
             return []
 
-    def mark_job_success_by_carteirinha(self, carteirinha: str) -> bool:
-        try:
-            # Tentar via Supabase REST: atualizar job em processing com carteirinha correspondente
-            if getattr(self, 'supabase', None):
-                try:
-                    res = (
-                        self.supabase
-                            .table('job_carteirinhas')
-                            .update({
-                                'status': 'success',
-                                'locked_by': None,
-                                'locked_at': None,
-                                'locked_until': None,
-                                'updated_at': datetime.now().isoformat()
-                            })
-                            .eq('carteirinha', carteirinha)
-                            .eq('status', 'processing')
-                            .execute()
-                    )
-                    data = getattr(res, 'data', None) or []
-                    if len(data) > 0:
-                        return True
-                except Exception as e:
-                    logger.warning(f"Supabase REST mark_job_success_by_carteirinha falhou: {e}")
-            # Fallback SQL direto
-            cursor = self.connection.cursor()
-            try:
-                cursor.execute(
-                    """
-                    UPDATE job_carteirinhas
-                       SET status='success',
-                           locked_by=NULL,
-                           locked_at=NULL,
-                           locked_until=NULL,
-                           updated_at=NOW()
-                     WHERE carteirinha=%s AND status='processing'
-                    """,
-                    (carteirinha,)
-                )
-                self.connection.commit()
-                rows = cursor.rowcount
-                cursor.close()
-                return rows > 0
-            except Exception as e:
-                cursor.close()
-                logger.error(f"Erro ao marcar sucesso por carteirinha {carteirinha}: {e}")
-                return False
-        except Exception as e:
-            logger.error(f"Falha mark_job_success_by_carteirinha: {e}")
-            return False
-
+    @tagged('freshness')
     def has_recent_success_for_carteirinha(self, carteirinha: str, min_hours: int = 6) -> bool:
+        """Sucesso nas últimas min_hours horas, pelo resumo carteiras_state (uma busca pela PK)."""
         try:
             cutoff_iso = (datetime.now() - timedelta(hours=min_hours)).isoformat()
             if getattr(self, 'supabase', None):
                 try:
                     res = (
                         self.supabase
-                            .table('job_carteirinhas')
-                            .select('id, updated_at')
-                            .eq('type', 'sgucard')
+                            .table('carteiras_state')
+                            .select('carteirinha')
                             .eq('carteirinha', carteirinha)
-                            .eq('status', 'success')
-                            .gte('updated_at', cutoff_iso)
+                            .gte('last_success_at', cutoff_iso)
                             .limit(1)
                             .execute()
                     )
@@ -842,31 +1048,27 @@ class DatabaseManager:
                     return len(data) > 0
                 except Exception as e:
                     logger.warning(f"Supabase REST has_recent_success_for_carteirinha falhou: {e}")
-            cursor = self.connection.cursor()
             try:
-                cursor.execute(
-                    """
-                    SELECT 1
-                      FROM job_carteirinhas
-                     WHERE type='sgucard'
-                       AND carteirinha=%s
-                       AND status='success'
-                       AND updated_at >= NOW() - (%s || ' hours')::interval
-                    LIMIT 1
-                    """,
-                    (carteirinha, str(min_hours))
-                )
-                row = cursor.fetchone()
-                cursor.close()
+                with self._cursor() as cursor:
+                    cursor.execute(
+                        """
+                        SELECT 1
+                          FROM carteiras_state
+                         WHERE carteirinha=%s
+                           AND last_success_at >= NOW() - (%s || ' hours')::interval
+                        """,
+                        (carteirinha, str(min_hours))
+                    )
+                    row = cursor.fetchone()
                 return bool(row)
             except Exception as e:
-                cursor.close()
                 logger.error(f"Erro ao verificar sucesso recente para carteirinha {carteirinha}: {e}")
                 return False
         except Exception as e:
             logger.error(f"Falha has_recent_success_for_carteirinha: {e}")
             return False
 
+    @tagged('freshness')
     def has_active_processing_for_carteirinha(self, carteirinha: str) -> bool:
         try:
             now_iso = datetime.now().isoformat()
@@ -887,31 +1089,30 @@ class DatabaseManager:
                     return len(data) > 0
                 except Exception as e:
                     logger.warning(f"Supabase REST has_active_processing_for_carteirinha falhou: {e}")
-            cursor = self.connection.cursor()
             try:
-                cursor.execute(
-                    """
-                    SELECT 1
-                      FROM job_carteirinhas
-                     WHERE type='sgucard'
-                       AND carteirinha=%s
-                       AND status='processing'
-                       AND locked_until >= NOW()
-                    LIMIT 1
-                    """,
-                    (carteirinha,)
-                )
-                row = cursor.fetchone()
-                cursor.close()
+                with self._cursor() as cursor:
+                    cursor.execute(
+                        """
+                        SELECT 1
+                          FROM job_carteirinhas
+                         WHERE type='sgucard'
+                           AND carteirinha=%s
+                           AND status='processing'
+                           AND locked_until >= NOW()
+                        LIMIT 1
+                        """,
+                        (carteirinha,)
+                    )
+                    row = cursor.fetchone()
                 return bool(row)
             except Exception as e:
-                cursor.close()
                 logger.error(f"Erro ao verificar processing ativo para carteirinha {carteirinha}: {e}")
                 return False
         except Exception as e:
             logger.error(f"Falha has_active_processing_for_carteirinha: {e}")
             return False
 
+    @tagged('ack')
     def mark_job_processed(self, job_id: str) -> bool:
         try:
             if getattr(self, 'supabase', None):
@@ -947,6 +1148,7 @@ class DatabaseManager:
             logger.error(f"Erro ao marcar job {job_id} como processado: {e}")
             return False
 
+    @tagged('ack')
     def mark_job_failed(self, job_id: str, error: str) -> bool:
         try:
             if getattr(self, 'supabase', None):
@@ -983,10 +1185,10 @@ class DatabaseManager:
             logger.error(f"Erro ao marcar job {job_id} como erro: {e}")
             return False
 
+    @tagged('carteirinhas')
     def get_carteirinhas_with_appointments(self, data):
         """Retorna carteirinhas com agendamentos para uma data específica"""
         try:
-            cursor = self.connection.cursor()
             query = """
                 SELECT DISTINCT c.carteiras as carteirinha, c.paciente 
                 FROM carteirinhas c
@@ -994,9 +1196,9 @@ class DatabaseManager:
                 WHERE a.data = %s
                 ORDER BY c.paciente
             """
-            cursor.execute(query, (data,))
-            results = cursor.fetchall()
-            cursor.close()
+            with self._cursor() as cursor:
+                cursor.execute(query, (data,))
+                results = cursor.fetchall()
             
             carteirinhas = []
             for result in results:
@@ -1011,9 +1213,19 @@ class DatabaseManager:
             return []
 
     def close(self):
-        """Fecha a conexão com o banco"""
-        if self.connection:
-            self.connection.close()
+        """Fecha as conexões com o banco (ou as devolve ao pool)"""
+        if not self._connection:
+            return
+        with self._thread_connections_lock:
+            conns = [self._connection] + self._thread_connections
+            self._thread_connections = []
+        self._connection = None
+        for conn in conns:
+            try:
+                self._release_connection(conn)
+            except Exception as e:
+                logger.warning(f"Erro ao liberar conexão: {e}")
+        if self._pool is None:
             logger.info("Conexão com banco fechada")
 
 class ExcelProcessor:
@@ -1164,8 +1376,14 @@ class CarteirinhaProcessor:
 class AutomacaoCarteirinhas:
     """Classe principal da automação"""
     
-    def __init__(self):
-        self.db_manager = DatabaseManager()
+    def __init__(self, per_thread: bool = False):
+        # Instância de vida longa: conexão própria, não ocupa o pool. Com per_thread (API, que roda
+        # várias varreduras em paralelo) cada thread usa sua própria conexão e transação, emprestada
+        # do pool do processo (limitado por DB_POOL_MAX_SIZE) e devolvida ao fim de cada operação
+        # (release_thread_connection); só a conexão da thread criadora fica com a instância
+        if per_thread:
+            get_db_pool()
+        self.db_manager = DatabaseManager(pooled=per_thread, per_thread=per_thread)
         self.processor = CarteirinhaProcessor(self.db_manager)
     
     def vasculhar_carteirinhas(self, modo_execucao: str = "manual", 
@@ -1197,7 +1415,8 @@ class AutomacaoCarteirinhas:
             if isinstance(data_final, str):
                 data_final = datetime.strptime(data_final, "%Y-%m-%d").date()
             
-            # Se usar web scraping real, delegar para automação real
+            # Se usar web scraping real, delegar para automação real. Falha ou abort terminam em erro:
+            # a simulação grava guias fictícias e só roda com usar_webscraping_real=False
             if usar_webscraping_real:
                 try:
                     from automacao_webscraping_real import WebScrapingRealAutomacao
@@ -1214,33 +1433,42 @@ class AutomacaoCarteirinhas:
                         data_inicio=data_inicio_str,
                         data_fim=data_fim_str
                     )
-                    
-                    if resultado['sucesso']:
-                        logger.info("Automação real executada com sucesso")
-                        # Marcador de conclusão: gravar success no job correspondente
-                        try:
-                            if carteirinha:
-                                self.db_manager.mark_job_success_by_carteirinha(carteirinha)
-                        except Exception as e:
-                            logger.warning(f"Falha ao marcar success por carteirinha {carteirinha}: {e}")
-                        return {
-                            'status': 'sucesso',
-                            'message': 'Web scraping real executado com sucesso',
-                            'carteirinhas_processadas': resultado['carteirinhas_processadas'],
-                            'guias_inseridas': resultado['guias_extraidas'],
-                            'guias_atualizadas': 0,
-                            'tempo_execucao': resultado['tempo_execucao']
-                        }
-                    else:
-                        logger.error(f"Falha na automação real: {resultado['erro']}")
-                        # Continuar com simulação em caso de falha
-                        
-                except ImportError:
-                    logger.warning("Módulo de automação real não disponível, usando simulação")
                 except Exception as e:
-                    logger.error(f"Erro na automação real: {e}, usando simulação")
+                    resultado = {'sucesso': False, 'erro': f"Automação real indisponível: {e}", 'abortado': False}
+                
+                if resultado.get('sucesso'):
+                    logger.info("Automação real executada com sucesso")
+                    # O success do job é gravado pelo worker (complete_jobs), com duração e carteiras_state
+                    return {
+                        'status': 'sucesso',
+                        'message': 'Web scraping real executado com sucesso',
+                        'carteirinhas_processadas': resultado['carteirinhas_processadas'],
+                        'guias_inseridas': resultado['guias_extraidas'],
+                        'guias_atualizadas': 0,
+                        'tempo_execucao': resultado['tempo_execucao']
+                    }
+                
+                erro_msg = f"Falha na automação real: {resultado.get('erro')}"
+                logger.error(erro_msg)
+                self.db_manager.log_execution(
+                    tipo_execucao=modo_execucao,
+                    status='erro',
+                    tempo_execucao=datetime.now() - inicio_execucao,
+                    carteirinhas_processadas=0,
+                    guias_inseridas=0,
+                    guias_atualizadas=0,
+                    erro=erro_msg
+                )
+                return {
+                    'status': 'erro',
+                    'message': erro_msg,
+                    'abortado': bool(resultado.get('abortado')),
+                    'carteirinhas_processadas': 0,
+                    'guias_inseridas': 0,
+                    'guias_atualizadas': 0
+                }
             
-            # Buscar carteirinhas para processamento (simulação ou fallback)
+            # Buscar carteirinhas para processamento (simulação)
             carteirinhas = self.db_manager.get_carteirinhas_for_processing(
                 modo_execucao, carteirinha, data_inicial, data_final
             )
@@ -20,6 +20,8 @@ from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.common.exceptions import TimeoutException
 from automacao_carteirinhas import DatabaseManager
+from job_storage import JobStorage, SqlJobBackend, RestJobBackend, SQL
+from portal_rate_limiter import get_portal_rate_limiter
 
 # Carregar variáveis de ambiente para suportar execução direta deste módulo
 load_dotenv()
@@ -29,7 +31,11 @@ driver = None
 Benef_cart = None
 arrterapias = [0] * 8
 db_manager = None
+_guia_storage = None
 _session_manager = None
+_session_pool = None
+# Estado por thread: com várias sessões de Chrome, cada thread processa sua própria carteirinha
+_estado = threading.local()
 
 def get_supabase_client() -> Client | None:
     """Inicializa cliente Supabase via REST para fallback de persistência."""
@@ -48,7 +54,8 @@ def get_db_manager():
     global db_manager
     if db_manager is None:
         try:
-            db_manager = DatabaseManager()
+            # Usado pelas threads das sessões de Chrome: uma conexão por thread
+            db_manager = DatabaseManager(pooled=False, per_thread=True)
         except Exception as e:
             logging.getLogger(__name__).error(f"Falha ao inicializar DatabaseManager: {e}")
             db_manager = None
@@ -114,7 +121,7 @@ def to_db_date(d):
     return None
 
 def validCode(cod_terminologia: str) -> int:
-    global arrterapias
+    arrterapias = getattr(_estado, "arrterapias", None) or [0] * 8
     if cod_terminologia == "2250005103" and arrterapias[0] < 1500:
         return 1
     if cod_terminologia == "2250005111" and arrterapias[1] < 1500:
@@ -131,61 +138,31 @@ def validCode(cod_terminologia: str) -> int:
         return 7
     return 0
 
+def get_guia_storage() -> JobStorage | None:
+    """Upsert de guias: SQL direto preferido; Supabase REST quando o circuito do SQL estiver aberto."""
+    global _guia_storage
+    if _guia_storage is not None:
+        return _guia_storage
+    manager = get_db_manager()
+    supa = (manager.supabase if manager else None) or get_supabase_client()
+    storage = JobStorage(
+        SqlJobBackend(manager) if manager else None,
+        RestJobBackend(supa) if supa else None,
+        preferred=SQL,
+    )
+    if not storage.backends:
+        return None
+    if manager:
+        # Sem DatabaseManager a próxima chamada tenta conectar de novo
+        _guia_storage = storage
+    return storage
+
 def upsert_guia_no_banco(guia_data: dict):
     try:
-        manager = get_db_manager()
-        if manager:
-            try:
-                check_query = "SELECT id FROM baseguias WHERE carteirinha = %s AND guia = %s"
-                existing = manager.execute_query(check_query, (guia_data['carteirinha'], guia_data['guia']), fetch=True)
-                if existing:
-                    update_query = (
-                        "UPDATE baseguias SET "
-                        "paciente = %s, data_autorizacao = %s, senha = %s, validade = %s, "
-                        "codigo_terapia = %s, qtde_solicitado = %s, sessoes_autorizadas = %s, "
-                        "updated_at = CURRENT_TIMESTAMP WHERE carteirinha = %s AND guia = %s"
-                    )
-                    params = (
-                        guia_data['paciente'],
-                        to_db_date(guia_data['data_autorizacao']),
-                        guia_data['senha'],
-                        to_db_date(guia_data['validade']),
-                        guia_data['codigo_terapia'],
-                        guia_data['qtde_solicitado'],
-                        guia_data['sessoes_autorizadas'],
-                        guia_data['carteirinha'],
-                        guia_data['guia']
-                    )
-                    manager.execute_query(update_query, params)
-                    return "updated"
-                else:
-                    insert_query = (
-                        "INSERT INTO baseguias (carteirinha, paciente, guia, data_autorizacao, senha, validade, "
-                        "codigo_terapia, qtde_solicitado, sessoes_autorizadas, created_at, updated_at) "
-                        "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)"
-                    )
-                    params = (
-                        guia_data['carteirinha'],
-                        guia_data['paciente'],
-                        guia_data['guia'],
-                        to_db_date(guia_data['data_autorizacao']),
-                        guia_data['senha'],
-                        to_db_date(guia_data['validade']),
-                        guia_data['codigo_terapia'],
-                        guia_data['qtde_solicitado'],
-                        guia_data['sessoes_autorizadas']
-                    )
-                    manager.execute_query(insert_query, params)
-                    return "inserted"
-            except Exception as db_err:
-                print(f"Falha no SQL direto, tentando Supabase REST: {db_err}")
-
-        # Fallback via Supabase REST (HTTP), quando conexão direta ao Postgres falhar
-        supa = get_supabase_client()
-        if not supa:
+        storage = get_guia_storage()
+        if storage is None:
             print("Banco indisponível para upsert (sem Supabase REST).")
             return "db_unavailable"
-
         payload = {
             'carteirinha': guia_data['carteirinha'],
             'paciente': guia_data['paciente'],
@@ -197,19 +174,7 @@ def upsert_guia_no_banco(guia_data: dict):
             'qtde_solicitado': guia_data['qtde_solicitado'],
             'sessoes_autorizadas': guia_data['sessoes_autorizadas']
         }
-
-        try:
-            # Verificar existência
-            sel = supa.table("baseguias").select("id").eq("carteirinha", payload['carteirinha']).eq("guia", payload['guia']).limit(1).execute()
-            if sel.data:
-                supa.table("baseguias").update(payload).eq("carteirinha", payload['carteirinha']).eq("guia", payload['guia']).execute()
-                return "updated"
-            else:
-                supa.table("baseguias").insert(payload).execute()
-                return "inserted"
-        except Exception as rest_err:
-            print(f"Erro no fallback Supabase REST: {rest_err}")
-            return "error"
+        return storage.call('upsert_guia', payload)
     except Exception as e:
         print(f"Erro ao upsert guia: {e}")
         return "error"
@@ -283,7 +248,7 @@ def importGuia(driver, lin):
             pass
 
 def captura(driver):
-    global Benef_cart, arrterapias
+    Benef_cart = getattr(_estado, "benef_cart", None)
     x1 = funccarteira(Benef_cart, 1)
     x2 = funccarteira(Benef_cart, 2)
     x3 = funccarteira(Benef_cart, 3)
@@ -441,7 +406,7 @@ def captura(driver):
             print("Erro de internet ou não foi liberado acesso às Guias do paciente")
             return
 
-    arrterapias = [0] * 8
+    _estado.arrterapias = [0] * 8
     time.sleep(2)
 
     try:
@@ -529,6 +494,9 @@ class ChromeSessionManager:
         self.driver = None
         self.lock = threading.Lock()
         self.busy = False
+        # Carteirinha em execução nesta sessão (usada por POST /abortar)
+        self.current_carteirinha = None
+        self.aborted = False
         self.last_used = 0.0
         self.idle_minutes = int((os.getenv("CHROME_IDLE_MINUTES", "30") or "30"))
         self._monitor_thread = threading.Thread(target=self._monitor_idle, daemon=True)
@@ -633,6 +601,16 @@ class ChromeSessionManager:
             self.busy = False
             self.last_used = time.time()
 
+    def abort(self):
+        """Derruba o Chrome da execução em andamento; o scrape falha e a próxima execução cria outro driver."""
+        self.aborted = True
+        driver, self.driver = self.driver, None
+        if driver:
+            try:
+                driver.quit()
+            except Exception:
+                pass
+
     def _monitor_idle(self):
         # Verifica a cada 60s; quando passar do idle, aguarda estar livre e fecha
         while True:
@@ -654,22 +632,71 @@ class ChromeSessionManager:
                 pass
 
 
+class ChromeSessionPool:
+    """Conjunto de sessões persistentes (CHROME_MAX_SESSIONS) para execuções concorrentes."""
+
+    def __init__(self, size: int):
+        self.sessions = [ChromeSessionManager() for _ in range(max(1, size))]
+        self._available = threading.BoundedSemaphore(len(self.sessions))
+        self._lock = threading.Lock()
+
+    @property
+    def capacity(self) -> int:
+        return len(self.sessions)
+
+    def acquire(self) -> ChromeSessionManager:
+        """Bloqueia até haver uma sessão livre e a reserva (o Chrome é criado fora do lock do pool)."""
+        self._available.acquire()
+        with self._lock:
+            mgr = next(m for m in self.sessions if not m.busy)
+            mgr.busy = True
+        try:
+            mgr.acquire_session()
+        except Exception:
+            self.release(mgr)
+            raise
+        return mgr
+
+    def release(self, mgr: ChromeSessionManager):
+        mgr.release_session()
+        self._available.release()
+
+    def abort(self, carteirinha: str) -> int:
+        """Aborta as sessões que estão processando a carteirinha; devolve quantas foram abortadas."""
+        aborted = 0
+        for mgr in self.sessions:
+            if mgr.busy and mgr.current_carteirinha == carteirinha:
+                logging.getLogger(__name__).warning(f"[session] Abortando execução da carteirinha {carteirinha}")
+                mgr.abort()
+                aborted += 1
+        return aborted
+
+
+def get_session_pool() -> ChromeSessionPool:
+    global _session_pool
+    if _session_pool is None:
+        _session_pool = ChromeSessionPool(int(os.getenv("CHROME_MAX_SESSIONS", "1") or "1"))
+    return _session_pool
+
+
 def get_session_manager() -> ChromeSessionManager:
     global _session_manager
     if _session_manager is None:
-        _session_manager = ChromeSessionManager()
+        _session_manager = get_session_pool().sessions[0]
     return _session_manager
 
 def ConsultGuias(driver, carteirinhas_list: List[str]):
-    global Benef_cart
     total_rows = len(carteirinhas_list)
     print("Total de carteiras a processar:", total_rows)
     for i, Benef_cart in enumerate(carteirinhas_list, start=2):
+        _estado.benef_cart = Benef_cart
         try:
             if not Benef_cart:
                 print(f"Linha {i}: Carteira vazia, pulando...")
                 continue
             print(f"\nProcessando linha {i}, carteira: {Benef_cart}")
+            # Vaga no bucket do portal compartilhado pela frota (workers, executores locais e API)
+            get_portal_rate_limiter().acquire()
             x1 = funccarteira(Benef_cart, 1)
             x2 = funccarteira(Benef_cart, 2)
             x3 = funccarteira(Benef_cart, 3)
@@ -721,7 +748,6 @@ def ConsultGuias(driver, carteirinhas_list: List[str]):
     # Não encerra o Chrome aqui; o gerenciador cuidará do ciclo de vida
 
 def SGUCARD(modo: str = 'todos', carteirinha: str = None, data_inicial: str = None, data_final: str = None):
-    global driver
     chrome_options = Options()
     chrome_options.add_argument("--disable-blink-features=AutomationControlled")
     chrome_options.add_argument("--no-sandbox")
@@ -753,6 +779,10 @@ def SGUCARD(modo: str = 'todos', carteirinha: str = None, data_inicial: str = No
     lista = obter_carteirinhas_por_modo(modo, carteirinha, data_inicial, data_final)
     ConsultGuias(driver, lista)
 
+class ExecucaoAbortada(RuntimeError):
+    """Execução derrubada a pedido do worker (deadline excedido)."""
+
+
 class WebScrapingRealAutomacao:
     def executar_automacao_completa(self, filtro_api: str = "manual", carteira: str = None, data_inicio: str = None, data_fim: str = None) -> dict:
         """Interface compatível com automacao_carteirinhas.vasculhar_carteirinhas.
@@ -778,13 +808,18 @@ class WebScrapingRealAutomacao:
 
             use_persistent = (os.getenv("PERSISTENT_CHROME", "true").strip().lower() in ("1", "true", "yes", "on"))
             if use_persistent:
-                mgr = get_session_manager()
-                drv = mgr.acquire_session()
+                pool = get_session_pool()
+                mgr = pool.acquire()
+                mgr.current_carteirinha = carteira
+                mgr.aborted = False
                 try:
-                    mgr.ensure_logged_in_and_home(drv)
-                    ConsultGuias(drv, lista)
+                    mgr.ensure_logged_in_and_home(mgr.driver)
+                    ConsultGuias(mgr.driver, lista)
+                    if mgr.aborted:
+                        raise ExecucaoAbortada("Execução abortada a pedido do worker (deadline excedido)")
                 finally:
-                    mgr.release_session()
+                    mgr.current_carteirinha = None
+                    pool.release(mgr)
             else:
                 # Fluxo antigo (abre e encerra a cada execução)
                 SGUCARD(modo=modo, carteirinha=carteira, data_inicial=data_inicio, data_final=data_fim)
@@ -803,6 +838,7 @@ class WebScrapingRealAutomacao:
             return {
                 "sucesso": False,
                 "erro": str(e),
+                "abortado": isinstance(e, ExecucaoAbortada),
                 "carteirinhas_processadas": 0,
                 "guias_extraidas": 0,
                 "tempo_execucao": "00:00:00"
@@ -0,0 +1,89 @@
+import os
+import sys
+import uuid
+from dotenv import load_dotenv
+
+from automacao_carteirinhas import DatabaseManager
+from job_storage import SqlJobBackend, RestJobBackend
+
+"""
+Verificação de que SqlJobBackend e RestJobBackend devolvem linhas no mesmo formato.
+Uma operação que muda de backend (circuito aberto) entrega as linhas a chamadas que podem ir ao
+outro: ids precisam ser texto e datas ISO 8601 nos dois. Para cada backend o script insere um job
+(insert_job) e o reivindica (claim_jobs) num tipo de job próprio (SHAPE_CHECK_JOB_TYPE, que nenhum
+worker consome), compara chaves e tipos JSON das linhas e apaga os jobs ao final.
+Sai com código 1 se os formatos divergirem.
+
+Uso:
+  python check_job_storage_shapes.py   (usa SUPABASE_URL, SUPABASE_PASSWORD e SUPABASE_SERVICE_ROLE_KEY do .env)
+Opcional: SHAPE_CHECK_JOB_TYPE (padrão shape_check).
+"""
+
+
+def json_kind(value) -> str:
+    # O PostgREST devolve double precision inteiro como int: número é número
+    if isinstance(value, bool):
+        return 'boolean'
+    if isinstance(value, (int, float)):
+        return 'number'
+    return type(value).__name__
+
+
+def compare(name: str, sql_row: dict, rest_row: dict) -> bool:
+    problems = []
+    missing = sorted(set(sql_row) ^ set(rest_row))
+    if missing:
+        problems.append(f"chaves só em um backend: {missing}")
+    for key in sorted(set(sql_row) & set(rest_row)):
+        a, b = sql_row[key], rest_row[key]
+        if a is None or b is None:
+            continue
+        if json_kind(a) != json_kind(b):
+            problems.append(f"{key}: sql={json_kind(a)} ({a!r}) rest={json_kind(b)} ({b!r})")
+    status = "OK  " if not problems else "FAIL"
+    print(f"[{status}] {name}: {len(sql_row)} colunas" + ''.join(f"\n       {p}" for p in problems))
+    return not problems
+
+
+def new_payload(job_type: str) -> dict:
+    carteirinha = f"SHAPE-{uuid.uuid4().hex[:12]}"
+    return {'type': job_type, 'carteirinha': carteirinha, 'carteira': carteirinha,
+            'id_paciente': None, 'force': False, 'category': 'adhoc'}
+
+
+def main():
+    load_dotenv()
+    job_type = os.getenv('SHAPE_CHECK_JOB_TYPE', 'shape_check')
+    db = DatabaseManager(pooled=False)
+    if db.supabase is None:
+        print("Cliente Supabase indisponível: defina SUPABASE_URL e SUPABASE_SERVICE_ROLE_KEY")
+        return 1
+    backends = (SqlJobBackend(db), RestJobBackend(db.supabase))
+    inserted, claimed = {}, {}
+    try:
+        for backend in backends:
+            inserted[backend.name] = backend.insert_job(new_payload(job_type))
+        for backend in backends:
+            rows = backend.rpc('claim_jobs', {
+                'worker_id': f'shape-check-{backend.name}', 'claim_limit': 1,
+                'p_visibility_timeout_seconds': 60, 'job_type': job_type,
+            }) or []
+            if not rows:
+                print(f"[FAIL] claim_jobs ({backend.name}) não devolveu linhas")
+                return 1
+            claimed[backend.name] = rows[0]
+        sql_name, rest_name = (b.name for b in backends)
+        results = [
+            compare("insert_job", inserted[sql_name], inserted[rest_name]),
+            compare("claim_jobs", claimed[sql_name], claimed[rest_name]),
+        ]
+    finally:
+        db.execute_query("DELETE FROM job_carteirinhas WHERE type = %s", (job_type,))
+        db.close()
+    failed = results.count(False)
+    print(f"{len(results) - failed}/{len(results)} operações com o mesmo formato nos dois backends")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
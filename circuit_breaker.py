@@ -0,0 +1,71 @@
+"""
+Circuit breaker simples (closed → open → half_open → closed).
+- closed: tudo liberado; falhas consecutivas acima do limite abrem o circuito
+- open: bloqueado até passar reset_timeout segundos
+- half_open: próxima tentativa decide; sucesso fecha, falha reabre (acquire() libera uma única
+  tentativa de teste por vez; allow() só informa o estado)
+"""
+
+import time
+import threading
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30.0):
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.reset_timeout = float(reset_timeout)
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._state = CLOSED
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def _refresh(self) -> str:
+        if self._state == OPEN and (time.monotonic() - self.opened_at) >= self.reset_timeout:
+            self._state = HALF_OPEN
+            self._trial_in_flight = False
+        return self._state
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._refresh()
+
+    def allow(self) -> bool:
+        """True se uma tentativa pode ser feita agora (closed ou half_open)."""
+        return self.state != OPEN
+
+    def acquire(self) -> bool:
+        """Reserva uma tentativa: sempre em closed; em half_open só uma por vez, até o
+        record_success/record_failure dela."""
+        with self._lock:
+            state = self._refresh()
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def release(self):
+        """Devolve a tentativa reservada sem veredito (ex.: chamada cancelada)."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self._state = CLOSED
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._trial_in_flight = False
+            self.consecutive_failures += 1
+            if self._state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                self._state = OPEN
+                self.opened_at = time.monotonic()
@@ -1,28 +1,34 @@
 import os
 import sys
 import time
-import requests
+from datetime import date
 from typing import List, Dict
 from dotenv import load_dotenv
 
 from automacao_carteirinhas import DatabaseManager
+from api_client import get_api_client
 
 """
 Script: create_jobs_all_carteirinhas.py
 
 Cria jobs para todas as carteirinhas da tabela 'carteirinhas'.
-- Usa o endpoint POST /jobs da API (api_carteirinhas.py)
-- Evita duplicidade opcionalmente (pendente/processing e sucesso recente)
+- Usa o endpoint POST /jobs/batch da API (api_carteirinhas.py, RPC enqueue_jobs) em lotes de BATCH_SIZE,
+  com conexão keep-alive (api_client.py)
+- Idempotente por rodada: jobs da mesma categoria e bucket não são duplicados ao rodar de novo
+- Evita duplicidade opcionalmente (pendente/processing e sucesso recente), filtrando no banco
 
 Variáveis de ambiente:
 - CARTEIRINHA_API_BASE_URL: Base URL da API (default: http://127.0.0.1:8002)
 - API_TOKEN: Token Bearer (default: webscraping_api_token_2025)
 - LIMIT: Limite máximo de carteirinhas a processar (default: sem limite)
 - ONLY_ATIVAS: "true" para apenas carteirinhas ativas (default: false)
-- SKIP_EXISTING: "true" para pular carteirinhas com job pendente/processing (default: true)
-- SKIP_ACTIVE_PROCESSING: "true" para pular carteirinhas com processing ativo (default: true)
+- SKIP_EXISTING: "true" para pular carteirinhas com job pendente/processing ou sucesso recente (default: true)
 - SKIP_RECENT_SUCCESS_HOURS: horas para considerar sucesso recente e pular (default: 6)
-- RATE_LIMIT_MS: atraso em ms entre requisições (default: 0)
+- BATCH_SIZE: carteirinhas por requisição a /jobs/batch (default: 1000)
+- JOB_CATEGORY: lane dos jobs (default: scheduled_weekly; scheduled_daily para rodadas diárias).
+  Varreduras em massa não devem usar 'adhoc', que fica reservada a pedidos interativos
+- JOB_BUCKET: bucket da rodada, usado na chave de idempotência (default: data de hoje, YYYY-MM-DD)
+- RATE_LIMIT_MS: atraso em ms entre lotes (default: 0)
 """
 
 load_dotenv()
@@ -33,8 +39,10 @@ API_TOKEN = os.getenv("API_TOKEN", "webscraping_api_token_2025")
 LIMIT = int(os.getenv("LIMIT", "0") or "0")
 ONLY_ATIVAS = str(os.getenv("ONLY_ATIVAS", "false")).lower() == "true"
 SKIP_EXISTING = str(os.getenv("SKIP_EXISTING", "true")).lower() == "true"
-SKIP_ACTIVE_PROCESSING = str(os.getenv("SKIP_ACTIVE_PROCESSING", "true")).lower() == "true"
 SKIP_RECENT_SUCCESS_HOURS = int(os.getenv("SKIP_RECENT_SUCCESS_HOURS", "6") or "6")
+BATCH_SIZE = max(1, int(os.getenv("BATCH_SIZE", "1000") or "1000"))
+JOB_CATEGORY = os.getenv("JOB_CATEGORY", "scheduled_weekly")
+JOB_BUCKET = os.getenv("JOB_BUCKET", date.today().isoformat())
 RATE_LIMIT_MS = int(os.getenv("RATE_LIMIT_MS", "0") or "0")
 
 headers = {
@@ -65,58 +73,19 @@ def fetch_carteirinhas(db: DatabaseManager) -> List[Dict]:
     return result
 
 
-def has_pending_job(db: DatabaseManager, carteirinha: str) -> bool:
-    try:
-        rows = db.execute_query(
-            """
-            SELECT 1
-              FROM job_carteirinhas
-             WHERE type='sgucard'
-               AND carteirinha=%s
-               AND status IN ('pending','processing')
-             LIMIT 1
-            """,
-            params=(carteirinha,),
-            fetch=True,
-        )
-        return bool(rows)
-    except Exception:
-        return False
-
-
-def should_skip(db: DatabaseManager, carteirinha: str) -> (bool, str):
-    if not SKIP_EXISTING:
-        return False, ""
-    # processing ativo
-    if SKIP_ACTIVE_PROCESSING:
-        try:
-            if db.has_active_processing_for_carteirinha(carteirinha):
-                return True, "processing_active"
-        except Exception:
-            pass
-    # sucesso recente
-    try:
-        if db.has_recent_success_for_carteirinha(carteirinha, min_hours=SKIP_RECENT_SUCCESS_HOURS):
-            return True, "recent_success"
-    except Exception:
-        pass
-    # pendente/processing existente
-    try:
-        if has_pending_job(db, carteirinha):
-            return True, "pending_or_processing_exists"
-    except Exception:
-        pass
-    return False, ""
-
-
-def create_job(carteirinha: str) -> Dict:
+def create_jobs_batch(carteirinhas: List[str]) -> Dict:
     payload = {
         "type": "sgucard",
-        "carteirinha": carteirinha,
-        "carteira": carteirinha,
+        "carteirinhas": carteirinhas,
+        "category": JOB_CATEGORY,
+        "scheduled_bucket": JOB_BUCKET or None,
+        "skip_open": SKIP_EXISTING,
+        "skip_recent_hours": SKIP_RECENT_SUCCESS_HOURS if SKIP_EXISTING else 0,
+        # Revalidado no claim: carteirinhas que ficarem frescas até lá são resolvidas sem scrape
+        "min_recheck_interval_hours": SKIP_RECENT_SUCCESS_HOURS if SKIP_EXISTING else None,
     }
-    url = f"{API_BASE.rstrip('/')}/jobs"
-    r = requests.post(url, json=payload, headers=headers, timeout=15)
+    url = f"{API_BASE.rstrip('/')}/jobs/batch"
+    r = get_api_client().post(url, json=payload, headers=headers, timeout=60)
     try:
         data = r.json()
     except Exception:
@@ -131,8 +100,10 @@ def main():
         "LIMIT": LIMIT,
         "ONLY_ATIVAS": ONLY_ATIVAS,
         "SKIP_EXISTING": SKIP_EXISTING,
-        "SKIP_ACTIVE_PROCESSING": SKIP_ACTIVE_PROCESSING,
         "SKIP_RECENT_SUCCESS_HOURS": SKIP_RECENT_SUCCESS_HOURS,
+        "BATCH_SIZE": BATCH_SIZE,
+        "JOB_CATEGORY": JOB_CATEGORY,
+        "JOB_BUCKET": JOB_BUCKET,
         "RATE_LIMIT_MS": RATE_LIMIT_MS,
     })
 
@@ -154,29 +125,26 @@ def main():
         total = len(items)
         print(f"Encontradas {total} carteirinhas únicas.")
 
-        created = 0
-        skipped = 0
+        totals = {"created": 0, "duplicates": 0, "skipped_open": 0, "skipped_recent": 0}
         errors = 0
 
         limit = LIMIT if LIMIT and LIMIT > 0 else total
-        for idx, item in enumerate(items[:limit], start=1):
-            cart = item["carteirinha"]
-            skip, reason = should_skip(db, cart)
-            if skip:
-                skipped += 1
-                print(f"[{idx}/{limit}] SKIP {cart} ({reason})")
-            else:
-                try:
-                    resp = create_job(cart)
-                    if 200 <= resp["http_status"] < 300:
-                        created += 1
-                        print(f"[{idx}/{limit}] CREATED {cart} -> {resp['data'].get('status','')} ")
-                    else:
-                        errors += 1
-                        print(f"[{idx}/{limit}] ERROR {cart} -> {resp['http_status']} {resp['data']}")
-                except Exception as e:
-                    errors += 1
-                    print(f"[{idx}/{limit}] EXCEPTION {cart} -> {e}")
+        selected = [item["carteirinha"] for item in items[:limit]]
+        for start in range(0, len(selected), BATCH_SIZE):
+            chunk = selected[start:start + BATCH_SIZE]
+            progress = f"[{start + len(chunk)}/{limit}]"
+            try:
+                resp = create_jobs_batch(chunk)
+                if 200 <= resp["http_status"] < 300:
+                    for key in totals:
+                        totals[key] += int(resp["data"].get(key, 0) or 0)
+                    print(f"{progress} BATCH {len(chunk)} -> {resp['data']}")
+                else:
+                    errors += len(chunk)
+                    print(f"{progress} ERROR -> {resp['http_status']} {resp['data']}")
+            except Exception as e:
+                errors += len(chunk)
+                print(f"{progress} EXCEPTION -> {e}")
             if RATE_LIMIT_MS > 0:
                 time.sleep(RATE_LIMIT_MS / 1000.0)
 
@@ -184,10 +152,10 @@ def main():
         print({
             "total": total,
             "processed": limit,
-            "created": created,
-            "skipped": skipped,
+            **totals,
             "errors": errors,
         })
+        print({"http_metrics": get_api_client().metrics()})
     finally:
         try:
             db.close()
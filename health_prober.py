@@ -0,0 +1,135 @@
+"""
+Prober de saúde em background para os servidores da API.
+Mantém por servidor: EWMA da latência, falhas consecutivas e estado do circuit breaker.
+O despacho apenas lê estes registros; nenhuma chamada de rede acontece no caminho de despacho.
+"""
+
+import os
+import time
+import asyncio
+import logging
+from typing import Callable, Dict, List, Optional
+
+from api_client import get_api_client
+from circuit_breaker import CircuitBreaker, CLOSED
+
+logger = logging.getLogger(__name__)
+
+
+class ServerHealth:
+    """Registro de saúde de um servidor."""
+
+    def __init__(self, url: str, alpha: float, failure_threshold: int, reset_timeout: float):
+        self.url = url
+        self.alpha = alpha
+        self.ewma_latency_ms: Optional[float] = None
+        self.reported_capacity: Optional[int] = None
+        self.last_probe_ts = 0.0
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+
+    @property
+    def state(self) -> str:
+        return self.breaker.state
+
+    @property
+    def consecutive_failures(self) -> int:
+        return self.breaker.consecutive_failures
+
+    def record_probe(self, ok: bool, latency_ms: float, capacity: Optional[int] = None):
+        if capacity:
+            self.reported_capacity = capacity
+        if self.ewma_latency_ms is None:
+            self.ewma_latency_ms = latency_ms
+        else:
+            self.ewma_latency_ms = self.alpha * latency_ms + (1 - self.alpha) * self.ewma_latency_ms
+        self.last_probe_ts = time.time()
+        if ok:
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+
+    def snapshot(self) -> Dict:
+        return {
+            "state": self.state,
+            "ewma_latency_ms": round(self.ewma_latency_ms, 2) if self.ewma_latency_ms is not None else None,
+            "consecutive_failures": self.consecutive_failures,
+            "reported_capacity": self.reported_capacity,
+            "last_probe_ts": self.last_probe_ts,
+        }
+
+
+class HealthProber:
+    """Sonda periodicamente todos os servidores em paralelo e atualiza seus registros."""
+
+    def __init__(self, servers: List[str], on_recover: Optional[Callable[[str], None]] = None):
+        self.path = os.getenv("HEALTHCHECK_PATH", "/")
+        if not self.path.startswith('/'):
+            self.path = '/' + self.path
+        self.timeout = float(os.getenv("HEALTHCHECK_TIMEOUT_SECONDS", "5"))
+        self.interval = float(os.getenv("HEALTHCHECK_INTERVAL_SECONDS", os.getenv("HEALTHCHECK_CACHE_SECONDS", "15")))
+        alpha = float(os.getenv("HEALTH_EWMA_ALPHA", "0.3"))
+        threshold = int(os.getenv("HEALTH_FAILURE_THRESHOLD", "3"))
+        reset_timeout = float(os.getenv("HEALTH_OPEN_SECONDS", "30"))
+        self.records: Dict[str, ServerHealth] = {
+            srv: ServerHealth(srv, alpha, threshold, reset_timeout) for srv in servers
+        }
+        self.on_recover = on_recover
+
+    def _probe(self, server_url: str):
+        start = time.perf_counter()
+        capacity = None
+        try:
+            resp = get_api_client().get(f"{server_url}{self.path}", timeout=self.timeout)
+            ok = 200 <= resp.status_code < 300
+            if ok:
+                # Servidores que informam "capacity" no healthcheck definem seus próprios slots
+                try:
+                    body = resp.json()
+                    if isinstance(body, dict) and body.get("capacity"):
+                        capacity = max(1, int(body["capacity"]))
+                except Exception:
+                    pass
+        except Exception:
+            ok = False
+        latency_ms = (time.perf_counter() - start) * 1000.0
+        return ok, latency_ms if ok else max(latency_ms, self.timeout * 1000.0), capacity
+
+    async def probe_all(self):
+        results = await asyncio.gather(
+            *(asyncio.to_thread(self._probe, srv) for srv in self.records),
+            return_exceptions=True,
+        )
+        for (srv, record), res in zip(self.records.items(), results):
+            ok, latency_ms, capacity = res if isinstance(res, tuple) else (False, self.timeout * 1000.0, None)
+            was_closed = record.state == CLOSED
+            record.record_probe(ok, latency_ms, capacity)
+            now_closed = record.state == CLOSED
+            if not ok:
+                logger.warning(f"[healthcheck] Servidor indisponível: {srv} (falhas={record.consecutive_failures}, estado={record.state})")
+            if now_closed and not was_closed:
+                logger.info(f"[healthcheck] Servidor recuperado: {srv}")
+                if self.on_recover:
+                    self.on_recover(srv)
+
+    async def run(self):
+        while True:
+            try:
+                await self.probe_all()
+            except Exception as e:
+                logger.error(f"[healthcheck] Erro no prober: {e}")
+            await asyncio.sleep(self.interval)
+
+    def is_available(self, server_url: str) -> bool:
+        record = self.records.get(server_url)
+        return bool(record) and record.state == CLOSED
+
+    def rank(self, servers: List[str]) -> List[str]:
+        """Ordena servidores por falhas recentes e depois pela latência EWMA (menor primeiro)."""
+        def key(srv):
+            record = self.records[srv]
+            latency = record.ewma_latency_ms if record.ewma_latency_ms is not None else float("inf")
+            return (record.consecutive_failures, latency)
+        return sorted(servers, key=key)
+
+    def snapshot(self) -> Dict[str, Dict]:
+        return {srv: record.snapshot() for srv, record in self.records.items()}
@@ -0,0 +1,78 @@
+"""
+Deadline de execução por tipo de job.
+- JOB_DEADLINE_SECONDS: teto padrão; JOB_DEADLINES ("tipo=segundos,...") sobrescreve por tipo
+- Com amostras suficientes, o deadline passa a ser p95 das durações recentes × JOB_DEADLINE_P95_FACTOR,
+  limitado entre JOB_DEADLINE_MIN_SECONDS e o teto configurado
+As amostras vêm dos jobs concluídos pelo próprio worker e são semeadas do banco (duration_seconds).
+"""
+
+import os
+import math
+import logging
+from collections import deque
+from typing import Deque, Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Classe de erro gravada no job quando o deadline estoura (distinta de falhas da API)
+DEADLINE_EXCEEDED = "DeadlineExceeded"
+
+
+def _parse_deadlines() -> Dict[str, float]:
+    deadlines: Dict[str, float] = {}
+    for item in os.getenv("JOB_DEADLINES", "").split(','):
+        if '=' not in item:
+            continue
+        job_type, _, seconds = item.partition('=')
+        try:
+            deadlines[job_type.strip()] = float(seconds)
+        except ValueError:
+            logger.warning(f"Deadline inválido em JOB_DEADLINES: {item}")
+    return deadlines
+
+
+class JobDeadlines:
+    """Mantém uma janela de durações por tipo e calcula o deadline de cada job."""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.default = float(os.getenv("JOB_DEADLINE_SECONDS", "600"))
+        self.configured = _parse_deadlines()
+        self.factor = float(os.getenv("JOB_DEADLINE_P95_FACTOR", "2.0"))
+        self.min_seconds = float(os.getenv("JOB_DEADLINE_MIN_SECONDS", "120"))
+        self.window = window
+        self.min_samples = min_samples
+        self.samples: Dict[str, Deque[float]] = {}
+
+    def _bucket(self, job_type: str) -> Deque[float]:
+        return self.samples.setdefault(job_type, deque(maxlen=self.window))
+
+    def seed(self, job_type: str, durations: Iterable[float]):
+        bucket = self._bucket(job_type)
+        for seconds in durations:
+            if seconds and seconds > 0:
+                bucket.append(float(seconds))
+        logger.info(f"[deadline] {job_type}: {len(bucket)} durações carregadas; deadline={self.deadline(job_type):.0f}s")
+
+    def record(self, job_type: str, seconds: float):
+        if seconds > 0:
+            self._bucket(job_type).append(seconds)
+
+    def p95(self, job_type: str) -> Optional[float]:
+        bucket = self.samples.get(job_type)
+        if not bucket or len(bucket) < self.min_samples:
+            return None
+        ordered = sorted(bucket)
+        return ordered[min(len(ordered) - 1, math.ceil(0.95 * len(ordered)) - 1)]
+
+    def deadline(self, job_type: str) -> float:
+        ceiling = self.configured.get(job_type, self.default)
+        p95 = self.p95(job_type)
+        if p95 is None:
+            return ceiling
+        return min(ceiling, max(self.min_seconds, p95 * self.factor))
+
+    def snapshot(self) -> Dict[str, Dict]:
+        return {
+            job_type: {"samples": len(bucket), "p95": self.p95(job_type), "deadline": self.deadline(job_type)}
+            for job_type, bucket in self.samples.items()
+        }
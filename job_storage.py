@@ -0,0 +1,350 @@
+"""
+Armazenamento da fila com roteamento por saúde entre dois backends.
+- SqlJobBackend: conexão direta ao Postgres (DatabaseManager)
+- RestJobBackend: Supabase REST/RPC (PostgREST)
+- JobStorage: escolhe o backend por operação; um CircuitBreaker por (backend, operação),
+  compartilhado pelo processo, lembra as falhas recentes. A operação vai ao backend preferido
+  enquanto o circuito dele estiver fechado; só há segunda tentativa quando a falha abre o
+  circuito, e com o circuito aberto ela vai direto ao outro backend (sem pagar as duas).
+  A segunda tentativa só acontece se a operação for idempotente (IDEMPOTENT_OPERATIONS) ou se a
+  falha foi de conexão, antes de o comando sair: um timeout depois do commit não pode reivindicar
+  nem inserir duas vezes. Em half_open, uma única chamada testa o backend. O SqlJobBackend devolve
+  as linhas no formato JSON do REST (_json_value): ids como texto, datas em ISO 8601.
+- JOB_STORAGE_PREFERRED: rest (padrão) ou sql
+- JOB_STORAGE_FAILURE_THRESHOLD: falhas consecutivas que abrem o circuito (padrão 3)
+- JOB_STORAGE_OPEN_SECONDS: tempo com o circuito aberto antes de voltar a testar (padrão 30)
+Os RPCs são as mesmas funções de sql_jobs_rpcs.sql nos dois backends. Cada operação é marcada
+em query_metrics (OPERATION_TAGS); as chamadas REST são medidas aqui.
+"""
+
+import os
+import uuid
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import date, datetime, time
+from decimal import Decimal
+from typing import Callable, Dict, List, Optional, Tuple
+
+from psycopg import sql
+from psycopg.types.json import Jsonb
+
+import query_metrics
+from circuit_breaker import CircuitBreaker, CLOSED
+
+logger = logging.getLogger(__name__)
+
+SQL = "sql"
+REST = "rest"
+
+# RPC -> (tipos dos parâmetros para a chamada SQL, devolve linhas?)
+RPC_SIGNATURES: Dict[str, Tuple[Dict[str, str], bool]] = {
+    'claim_jobs': ({'worker_id': 'text', 'claim_limit': 'integer',
+                    'p_visibility_timeout_seconds': 'integer', 'job_type': 'text'}, True),
+    'complete_job': ({'job_id': 'uuid', 'worker_id': 'text', 'result': 'jsonb'}, False),
+    'fail_job': ({'job_id': 'uuid', 'worker_id': 'text', 'p_error': 'text',
+                  'p_backoff_base_seconds': 'integer', 'p_backoff_max_seconds': 'integer'}, False),
+    'complete_jobs': ({'p_job_ids': 'uuid[]', 'p_worker_id': 'text', 'p_durations': 'double precision[]'}, False),
+    'fail_jobs': ({'p_job_ids': 'uuid[]', 'p_errors': 'text[]', 'p_worker_id': 'text',
+                   'p_backoff_base_seconds': 'integer', 'p_backoff_max_seconds': 'integer'}, False),
+    'heartbeat_job': ({'job_id': 'uuid', 'worker_id': 'text', 'p_visibility_timeout_seconds': 'integer'}, False),
+    'heartbeat_jobs': ({'p_job_ids': 'uuid[]', 'p_worker_id': 'text', 'p_visibility_timeout_seconds': 'integer'}, False),
+    'release_job': ({'job_id': 'uuid', 'worker_id': 'text'}, False),
+    'release_jobs': ({'p_job_ids': 'uuid[]', 'p_worker_id': 'text'}, False),
+    'purge_stale_processing': ({'job_type': 'text'}, False),
+    'janitor_sweep': ({'job_type': 'text', 'p_retention_days': 'integer', 'p_batch_size': 'integer'}, False),
+    'take_portal_tokens': ({'p_bucket': 'text', 'p_tokens': 'double precision', 'p_capacity': 'double precision',
+                            'p_refill_per_second': 'double precision'}, False),
+    'enqueue_jobs': ({'p_carteirinhas': 'text[]', 'p_category': 'text', 'p_scheduled_bucket': 'text',
+                      'job_type': 'text', 'p_skip_open': 'boolean', 'p_skip_recent_hours': 'integer',
+                      'p_force': 'boolean', 'p_min_recheck_hours': 'integer'}, False),
+    'age_job_priorities': ({'job_type': 'text', 'p_step_seconds': 'integer', 'p_floor': 'integer'}, False),
+    'lane_latency_stats': ({'job_type': 'text', 'p_window_hours': 'integer'}, False),
+    'queue_stats': ({'job_type': 'text'}, False),
+    'archive_finished_jobs': ({'job_type': 'text', 'p_archive_after_hours': 'integer', 'p_batch_size': 'integer'}, False),
+}
+
+# Operação -> marca lógica nas métricas de consulta (query_metrics)
+OPERATION_TAGS: Dict[str, str] = {
+    'claim_jobs': 'claim',
+    'complete_job': 'ack', 'fail_job': 'ack', 'complete_jobs': 'ack', 'fail_jobs': 'ack',
+    'heartbeat_job': 'heartbeat', 'heartbeat_jobs': 'heartbeat',
+    'release_job': 'release', 'release_jobs': 'release',
+    'purge_stale_processing': 'janitor', 'janitor_sweep': 'janitor',
+    'age_job_priorities': 'janitor', 'archive_finished_jobs': 'janitor',
+    'take_portal_tokens': 'rate_limit',
+    'enqueue_jobs': 'enqueue', 'insert_job': 'enqueue',
+    'lane_latency_stats': 'stats', 'queue_stats': 'stats',
+    'recent_job_durations': 'deadlines',
+    'upsert_guia': 'guia_upsert',
+}
+
+# Operações que podem ser repetidas no outro backend sem efeito duplicado (leituras ou UPDATEs
+# filtrados pelo próprio estado que gravam). Os acks exigem que o job ainda esteja sob o lease do
+# worker (locked_by) e o liberam: repetidos, não alteram nada. claim_jobs, insert_job e
+# take_portal_tokens ficam de fora; enqueue_jobs só com scheduled_bucket (chave de idempotência).
+IDEMPOTENT_OPERATIONS = frozenset({
+    'complete_job', 'complete_jobs', 'fail_job', 'fail_jobs',
+    'heartbeat_job', 'heartbeat_jobs', 'release_job', 'release_jobs',
+    'purge_stale_processing', 'janitor_sweep', 'age_job_priorities', 'archive_finished_jobs',
+    'lane_latency_stats', 'queue_stats', 'recent_job_durations', 'upsert_guia',
+})
+
+try:
+    import httpx
+    # Falhas do cliente REST anteriores ao envio da requisição
+    _REST_UNREACHABLE: Tuple[type, ...] = (httpx.ConnectError, httpx.ConnectTimeout)
+except ImportError:
+    _REST_UNREACHABLE = ()
+
+_breakers: Dict[Tuple[str, str], CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+class StorageUnavailable(RuntimeError):
+    """Nenhum backend apto para a operação (circuitos abertos ou backends ausentes)."""
+
+
+class BackendUnreachable(RuntimeError):
+    """O backend falhou antes de receber o comando (sem conexão): repetir no outro é seguro."""
+
+
+def _unreachable(error: Exception) -> bool:
+    return isinstance(error, BackendUnreachable) or isinstance(error, _REST_UNREACHABLE)
+
+
+def get_breaker(backend: str, operation: str) -> CircuitBreaker:
+    """Circuit breaker do processo para o par (backend, operação)."""
+    key = (backend, operation)
+    breaker = _breakers.get(key)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(key)
+            if breaker is None:
+                breaker = CircuitBreaker(
+                    failure_threshold=int(os.getenv("JOB_STORAGE_FAILURE_THRESHOLD", "3")),
+                    reset_timeout=float(os.getenv("JOB_STORAGE_OPEN_SECONDS", "30")),
+                )
+                _breakers[key] = breaker
+    return breaker
+
+
+def _json_value(value):
+    """Valor no formato em que o PostgREST o devolve (JSON): uuid e datas viram texto, numeric vira
+    float. Assim as linhas do SQL e do REST são intercambiáveis quando uma operação muda de backend."""
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, list):
+        return [_json_value(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _json_value(v) for k, v in value.items()}
+    return value
+
+
+class SqlJobBackend:
+    """Operações da fila pela conexão direta do DatabaseManager (uma transação por operação)."""
+
+    name = SQL
+
+    def __init__(self, db):
+        self.db = db
+
+    @contextmanager
+    def _cursor(self):
+        """Cursor do DatabaseManager; falha ao obter a conexão vira BackendUnreachable."""
+        try:
+            conn = self.db.connection
+        except Exception as e:
+            raise BackendUnreachable(f"Sem conexão com o Postgres: {e}") from e
+        if conn is None or conn.closed:
+            raise BackendUnreachable("Sem conexão com o Postgres")
+        with self.db._cursor() as cursor:
+            yield cursor
+
+    def rpc(self, function: str, params: Dict):
+        types, returns_rows = RPC_SIGNATURES[function]
+        args = sql.SQL(', ').join(
+            sql.SQL("{} => {}::" + types[param]).format(sql.Identifier(param), sql.Placeholder(param))
+            for param in params
+        )
+        template = "SELECT * FROM public.{}({})" if returns_rows else "SELECT public.{}({})"
+        query = sql.SQL(template).format(sql.Identifier(function), args)
+        values = {p: Jsonb(v) if types[p] == 'jsonb' and v is not None else v for p, v in params.items()}
+        with self._cursor() as cursor:
+            cursor.execute(query, values)
+            if returns_rows:
+                columns = [d.name for d in cursor.description]
+                return [{c: _json_value(v) for c, v in zip(columns, r)} for r in cursor.fetchall()]
+            row = cursor.fetchone()
+        return _json_value(row[0]) if row else None
+
+    def recent_job_durations(self, job_type: str, limit: int) -> List[float]:
+        with self._cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT duration_seconds
+                  FROM job_carteirinhas
+                 WHERE type=%s AND status='success' AND duration_seconds IS NOT NULL
+                 ORDER BY updated_at DESC
+                 LIMIT %s
+                """,
+                (job_type, limit)
+            )
+            rows = cursor.fetchall()
+        return [float(r[0]) for r in rows]
+
+    def insert_job(self, payload: Dict) -> Dict:
+        with self._cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO job_carteirinhas (type, carteirinha, carteira, id_paciente, force, category) "
+                "VALUES (%s, %s, %s, %s, %s, %s) RETURNING *",
+                (payload['type'], payload['carteirinha'], payload['carteira'], payload['id_paciente'],
+                 payload['force'], payload['category'])
+            )
+            # Linha completa, como o insert do PostgREST devolve
+            columns = [d.name for d in cursor.description]
+            row = cursor.fetchone()
+        return {c: _json_value(v) for c, v in zip(columns, row)}
+
+    def upsert_guia(self, payload: Dict) -> str:
+        with self._cursor() as cursor:
+            cursor.execute(
+                """
+                UPDATE baseguias
+                   SET paciente = %(paciente)s, data_autorizacao = %(data_autorizacao)s, senha = %(senha)s,
+                       validade = %(validade)s, codigo_terapia = %(codigo_terapia)s,
+                       qtde_solicitado = %(qtde_solicitado)s, sessoes_autorizadas = %(sessoes_autorizadas)s,
+                       updated_at = CURRENT_TIMESTAMP
+                 WHERE carteirinha = %(carteirinha)s AND guia = %(guia)s
+                """,
+                payload
+            )
+            if cursor.rowcount:
+                return "updated"
+            cursor.execute(
+                """
+                INSERT INTO baseguias (carteirinha, paciente, guia, data_autorizacao, senha, validade,
+                                       codigo_terapia, qtde_solicitado, sessoes_autorizadas, created_at, updated_at)
+                VALUES (%(carteirinha)s, %(paciente)s, %(guia)s, %(data_autorizacao)s, %(senha)s, %(validade)s,
+                        %(codigo_terapia)s, %(qtde_solicitado)s, %(sessoes_autorizadas)s,
+                        CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+                """,
+                payload
+            )
+        return "inserted"
+
+
+class RestJobBackend:
+    """Operações da fila pelo cliente Supabase (PostgREST)."""
+
+    name = REST
+
+    def __init__(self, client):
+        self.client = client
+
+    def rpc(self, function: str, params: Dict):
+        res = self.client.rpc(function, params).execute()
+        return getattr(res, 'data', None)
+
+    def recent_job_durations(self, job_type: str, limit: int) -> List[float]:
+        res = (
+            self.client
+                .table('job_carteirinhas')
+                .select('duration_seconds')
+                .eq('type', job_type)
+                .eq('status', 'success')
+                .not_.is_('duration_seconds', 'null')
+                .order('updated_at', desc=True)
+                .limit(limit)
+                .execute()
+        )
+        data = getattr(res, 'data', None) or []
+        return [float(r['duration_seconds']) for r in data if r.get('duration_seconds') is not None]
+
+    def insert_job(self, payload: Dict) -> Dict:
+        res = self.client.table('job_carteirinhas').insert(payload).execute()
+        data = getattr(res, 'data', None)
+        return data[0] if data else payload
+
+    def upsert_guia(self, payload: Dict) -> str:
+        sel = (
+            self.client.table("baseguias").select("id")
+                .eq("carteirinha", payload['carteirinha']).eq("guia", payload['guia']).limit(1).execute()
+        )
+        if sel.data:
+            (
+                self.client.table("baseguias").update(payload)
+                    .eq("carteirinha", payload['carteirinha']).eq("guia", payload['guia']).execute()
+            )
+            return "updated"
+        self.client.table("baseguias").insert(payload).execute()
+        return "inserted"
+
+
+class JobStorage:
+    """Roteia cada operação para o backend preferido ou, com o circuito dele aberto, para o outro."""
+
+    def __init__(self, sql_backend: Optional[SqlJobBackend] = None, rest_backend: Optional[RestJobBackend] = None,
+                 preferred: Optional[str] = None):
+        preferred = (preferred or os.getenv("JOB_STORAGE_PREFERRED", REST)).strip().lower()
+        ordered = [rest_backend, sql_backend] if preferred == REST else [sql_backend, rest_backend]
+        self.backends = [b for b in ordered if b is not None]
+
+    def rpc(self, function: str, params: Dict):
+        """Executa um RPC de sql_jobs_rpcs.sql (mesmos parâmetros nos dois backends)."""
+        idempotent = function in IDEMPOTENT_OPERATIONS or (
+            function == 'enqueue_jobs' and bool(params.get('p_scheduled_bucket'))
+        )
+        return self._route(function, lambda backend: backend.rpc(function, params), idempotent)
+
+    def call(self, operation: str, *args, **kwargs):
+        """Executa uma operação que os backends implementam por conta própria (tabelas)."""
+        return self._route(operation, lambda backend: getattr(backend, operation)(*args, **kwargs),
+                           operation in IDEMPOTENT_OPERATIONS)
+
+    def _route(self, operation: str, run: Callable, idempotent: bool):
+        with query_metrics.operation(OPERATION_TAGS.get(operation, operation)):
+            return self._route_tagged(operation, run, idempotent)
+
+    @staticmethod
+    def _run(backend, run: Callable):
+        if backend.name != REST:
+            # SQL: cada comando já é medido pelo TrackedCursor da conexão
+            return run(backend)
+        with query_metrics.timed(REST) as box:
+            result = run(backend)
+            box["rows"] = len(result) if isinstance(result, list) else 1
+        return result
+
+    def _route_tagged(self, operation: str, run: Callable, idempotent: bool):
+        last_error: Optional[Exception] = None
+        for backend in self.backends:
+            breaker = get_breaker(backend.name, operation)
+            # Em half_open só uma chamada por vez testa o backend; as demais seguem para o outro
+            if not breaker.acquire():
+                continue
+            try:
+                result = self._run(backend, run)
+            except Exception as e:
+                breaker.record_failure()
+                last_error = e
+                if breaker.state == CLOSED:
+                    # Circuito ainda fechado: falha isolada não justifica repetir no outro backend
+                    raise
+                logger.warning(f"[storage] Circuito {backend.name}/{operation} aberto: {e}")
+                if not idempotent and not _unreachable(e):
+                    # O comando pode ter sido gravado antes da falha (ex.: timeout após o commit)
+                    raise
+                continue
+            except BaseException:
+                breaker.release()
+                raise
+            breaker.record_success()
+            return result
+        if last_error is not None:
+            raise last_error
+        raise StorageUnavailable(f"Nenhum backend disponível para {operation}")
@@ -0,0 +1,182 @@
+"""
+Executor local do worker (WORKER_EXECUTOR_MODE=local).
+Roda a automação no próprio host, sem o salto HTTP até a API:
+- LOCAL_EXECUTOR_PROCESSES processos dedicados, cada um com uma sessão de Chrome de longa duração
+- cada processo recebe uma carteirinha por vez via Pipe e chama vasculhar_carteirinhas diretamente
+- processo que trava ou morre é encerrado e recriado, sem afetar os demais
+O resultado tem o mesmo formato da resposta de POST /verificar_carteirinha.
+"""
+
+import os
+import time
+import signal
+import logging
+import threading
+import multiprocessing
+from datetime import datetime
+from typing import Dict, List, Optional
+
+logger = logging.getLogger("local_executor")
+
+
+def _executor_main(conn):
+    """Laço do processo filho: mantém a automação (e o Chrome) vivos entre jobs."""
+    # O encerramento é coordenado pelo worker (drain); Ctrl+C no terminal não deve matar o filho no meio do job
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    os.environ["CHROME_MAX_SESSIONS"] = "1"
+    from automacao_carteirinhas import AutomacaoCarteirinhas
+
+    automacao = AutomacaoCarteirinhas()
+    while True:
+        try:
+            carteirinha = conn.recv()
+        except (EOFError, OSError):
+            break
+        if carteirinha is None:
+            break
+        try:
+            resultado = automacao.vasculhar_carteirinhas(modo_execucao="manual", carteirinha=carteirinha)
+            response = {
+                "status": "sucesso" if resultado.get("status") == "sucesso" else "erro",
+                "carteirinha": carteirinha,
+                "resultado": resultado,
+                "timestamp": datetime.now().isoformat(),
+            }
+        except Exception as e:
+            response = {"status": "erro", "carteirinha": carteirinha, "resultado": {"erro": str(e)}}
+        try:
+            conn.send(response)
+        except (EOFError, OSError):
+            break
+    try:
+        from automacao_webscraping_real import get_session_pool
+        for mgr in get_session_pool().sessions:
+            mgr.close_driver()
+    except Exception:
+        pass
+
+
+class LocalSlot:
+    """Um processo executor e o canal de comunicação com ele."""
+
+    def __init__(self, index: int, ctx):
+        self.index = index
+        self._ctx = ctx
+        self.process = None
+        self.conn = None
+        self.closed = False
+        self.current: Optional[str] = None
+        self.spawn()
+
+    def spawn(self):
+        parent_conn, child_conn = self._ctx.Pipe()
+        self.process = self._ctx.Process(
+            target=_executor_main, args=(child_conn,), name=f"local-executor-{self.index}", daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+        logger.info(f"[local] Processo executor {self.index} iniciado (pid={self.process.pid})")
+
+    def kill(self):
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+            self.process.join(5)
+            if self.process.is_alive():
+                self.process.kill()
+                self.process.join(5)
+
+    def request_stop(self):
+        """Pede ao processo que encerre após o job atual (sem recriação posterior)."""
+        self.closed = True
+        try:
+            self.conn.send(None)
+        except Exception:
+            pass
+
+    def run(self, carteirinha: str, timeout: float) -> Dict:
+        """Executa um job no processo; em timeout ou morte do processo, recria-o e propaga o erro."""
+        if self.closed:
+            raise RuntimeError(f"Executor local {self.index} encerrado")
+        if not self.process.is_alive():
+            logger.warning(f"[local] Processo executor {self.index} morto; recriando")
+            self.spawn()
+        self.current = carteirinha
+        self.conn.send(carteirinha)
+        try:
+            if not self.conn.poll(timeout):
+                raise TimeoutError(f"Executor local {self.index} excedeu {timeout:.0f}s")
+            return self.conn.recv()
+        except BaseException:
+            self.kill()
+            if not self.closed:
+                self.spawn()
+            raise
+        finally:
+            self.current = None
+
+    def abort(self):
+        """Mata o processo no meio do job; run() recebe EOF, recria o processo e propaga o erro."""
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+
+
+class LocalExecutor:
+    """Pool de processos executores; capacidade = número de processos."""
+
+    def __init__(self, processes: Optional[int] = None, timeout: Optional[float] = None):
+        count = max(1, int(processes or os.getenv("LOCAL_EXECUTOR_PROCESSES", "1")))
+        self.timeout = float(timeout or os.getenv("LOCAL_EXECUTOR_TIMEOUT_SECONDS", os.getenv("CARTEIRINHA_API_TIMEOUT", "900")))
+        # spawn: Chrome e conexões do pai não devem ser herdados via fork (e é o único modo no Windows)
+        ctx = multiprocessing.get_context("spawn")
+        self.slots: List[LocalSlot] = [LocalSlot(i + 1, ctx) for i in range(count)]
+        self._free = list(self.slots)
+        self._cond = threading.Condition()
+
+    @property
+    def capacity(self) -> int:
+        return len(self.slots)
+
+    def _acquire(self, timeout: float = 30.0) -> LocalSlot:
+        # Um processo abortado pode levar alguns segundos para ser recriado e voltar ao pool
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._free, timeout):
+                raise RuntimeError("Nenhum processo executor livre")
+            return self._free.pop()
+
+    def _release(self, slot: LocalSlot):
+        with self._cond:
+            self._free.append(slot)
+            self._cond.notify()
+
+    def run(self, carteirinha: str, timeout: Optional[float] = None) -> Dict:
+        """Bloqueante: executa a carteirinha em um processo livre (chamar fora do event loop).
+        `timeout` (ex.: o deadline do job) só reduz o LOCAL_EXECUTOR_TIMEOUT_SECONDS."""
+        slot = self._acquire()
+        try:
+            return slot.run(carteirinha, min(self.timeout, timeout) if timeout else self.timeout)
+        finally:
+            self._release(slot)
+
+    def abort(self, carteirinha: str) -> int:
+        """Aborta os processos que estão executando a carteirinha; devolve quantos foram abortados."""
+        aborted = 0
+        for slot in self.slots:
+            if slot.current == carteirinha:
+                logger.warning(f"[local] Abortando processo executor {slot.index} (carteirinha {carteirinha})")
+                slot.abort()
+                aborted += 1
+        return aborted
+
+    def close(self, timeout: float = 10.0):
+        for slot in self.slots:
+            slot.request_stop()
+        deadline = time.monotonic() + timeout
+        for slot in self.slots:
+            slot.process.join(max(0.0, deadline - time.monotonic()))
+            slot.kill()
+        logger.info("[local] Processos executores encerrados")
@@ -0,0 +1,94 @@
+"""
+Limitador de taxa do portal sgucard compartilhado pela frota.
+Token bucket guardado no Postgres (tabela portal_rate_limits, RPC take_portal_tokens):
+todos os workers, executores locais e instâncias da API consomem do mesmo bucket antes de
+abrir a consulta de uma carteirinha no portal.
+- PORTAL_RATE_PER_MINUTE: consultas por minuto para a frota inteira
+- PORTAL_RATE_BURST: rajada máxima (capacidade do bucket)
+Se o banco estiver indisponível, cai para um bucket local com a mesma taxa.
+"""
+
+import os
+import time
+import random
+import logging
+import threading
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+_portal_rate_limiter = None
+_portal_rate_limiter_lock = threading.Lock()
+
+
+class PortalRateLimiter:
+    """Token bucket distribuído com fallback local."""
+
+    def __init__(self, bucket: Optional[str] = None, per_minute: Optional[float] = None, burst: Optional[float] = None):
+        self.bucket = bucket or os.getenv("PORTAL_RATE_BUCKET", "sgucard")
+        self.enabled = os.getenv("PORTAL_RATE_LIMIT_ENABLED", "true").lower() in ("1", "true", "yes", "on")
+        self.per_minute = float(per_minute or os.getenv("PORTAL_RATE_PER_MINUTE", "12"))
+        self.burst = float(burst or os.getenv("PORTAL_RATE_BURST", "2"))
+        self.refill_per_second = self.per_minute / 60.0
+        self._db = None
+        self._db_lock = threading.Lock()
+        # Bucket local (fallback quando o RPC falha)
+        self._local_tokens = self.burst
+        self._local_ts = time.monotonic()
+        self._local_lock = threading.Lock()
+
+    def _take_remote(self, tokens: float) -> Optional[float]:
+        with self._db_lock:
+            if self._db is None:
+                from automacao_carteirinhas import DatabaseManager
+                self._db = DatabaseManager(pooled=False)
+            return self._db.take_portal_tokens(self.bucket, tokens, self.burst, self.refill_per_second)
+
+    def _take_local(self, tokens: float) -> float:
+        with self._local_lock:
+            now = time.monotonic()
+            self._local_tokens = min(self.burst, self._local_tokens + (now - self._local_ts) * self.refill_per_second)
+            self._local_ts = now
+            if self._local_tokens >= tokens:
+                self._local_tokens -= tokens
+                return 0.0
+            return (tokens - self._local_tokens) / self.refill_per_second
+
+    def try_acquire(self, tokens: float = 1.0) -> float:
+        """Tenta tirar tokens; devolve 0 se concedido ou os segundos até a próxima tentativa."""
+        try:
+            wait = self._take_remote(tokens)
+        except Exception as e:
+            logger.warning(f"[rate] Falha no bucket distribuído: {e}")
+            self._db = None
+            wait = None
+        if wait is None:
+            wait = self._take_local(tokens)
+        return wait
+
+    def acquire(self, tokens: float = 1.0, timeout: Optional[float] = None) -> bool:
+        """Bloqueia até obter os tokens (ou até timeout). Retorna True se concedido."""
+        if not self.enabled or self.per_minute <= 0:
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait <= 0:
+                return True
+            # Jitter evita que nós acordem juntos e disputem o mesmo token
+            sleep_for = wait * (1 + random.uniform(0, 0.25))
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                sleep_for = min(sleep_for, remaining)
+            time.sleep(sleep_for)
+
+
+def get_portal_rate_limiter() -> PortalRateLimiter:
+    global _portal_rate_limiter
+    if _portal_rate_limiter is None:
+        with _portal_rate_limiter_lock:
+            if _portal_rate_limiter is None:
+                _portal_rate_limiter = PortalRateLimiter()
+    return _portal_rate_limiter
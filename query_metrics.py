@@ -0,0 +1,224 @@
+"""
+Instrumentação das consultas ao Postgres (e das chamadas REST da fila).
+- Cada comando é marcado com uma operação lógica (claim, ack, guia_upsert, stats, ...) via
+  `operation(nome)` / `@tagged(nome)`; sem marca, conta como "query"
+- Por operação e backend: contagem, erros, linhas, latência média/máxima e histograma em ms
+- Comandos acima de DB_SLOW_QUERY_MS (padrão 500) vão para o logger "slow_queries", com os
+  parâmetros redigidos (só tipo e tamanho); DB_SLOW_QUERY_LOG grava também em arquivo
+- TrackedCursor / TrackedAsyncCursor: cursor_factory das conexões do DatabaseManager e do
+  AsyncDatabaseManager, então toda chamada a cursor.execute é medida sem mudar os call sites
+"""
+
+import os
+import re
+import time
+import logging
+import threading
+import functools
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+import psycopg
+
+logger = logging.getLogger(__name__)
+slow_logger = logging.getLogger("slow_queries")
+
+# Limites superiores (ms) dos buckets do histograma; o último bucket é +Inf
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+DEFAULT_OPERATION = "query"
+
+_operation: ContextVar[Optional[str]] = ContextVar("db_operation", default=None)
+_query_metrics = None
+_query_metrics_lock = threading.Lock()
+
+
+def current_operation() -> str:
+    return _operation.get() or DEFAULT_OPERATION
+
+
+@contextmanager
+def operation(name: str):
+    """Marca os comandos executados no bloco (thread ou task asyncio atual) com a operação."""
+    token = _operation.set(name)
+    try:
+        yield
+    finally:
+        _operation.reset(token)
+
+
+def tagged(name: str):
+    """Decorator: marca todos os comandos do método com a operação."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with operation(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def redact(params) -> str:
+    """Descreve os parâmetros sem os valores (tipo e tamanho), para o log de consultas lentas."""
+    def describe(value):
+        if value is None:
+            return "NULL"
+        if isinstance(value, (str, bytes)):
+            return f"<{type(value).__name__}:{len(value)}>"
+        if isinstance(value, (list, tuple, set)):
+            return f"<{type(value).__name__}:{len(value)}>"
+        return f"<{type(value).__name__}>"
+    if params is None:
+        return "-"
+    if isinstance(params, dict):
+        return "{" + ", ".join(f"{k}={describe(v)}" for k, v in params.items()) + "}"
+    if isinstance(params, (list, tuple)):
+        return "(" + ", ".join(describe(v) for v in params) + ")"
+    return describe(params)
+
+
+class QueryMetrics:
+    """Histograma de latência e contadores por (backend, operação)."""
+
+    def __init__(self, slow_ms: Optional[float] = None):
+        self.slow_ms = float(slow_ms if slow_ms is not None else os.getenv("DB_SLOW_QUERY_MS", "500"))
+        self._lock = threading.Lock()
+        self._metrics: Dict[tuple, Dict] = {}
+        log_path = os.getenv("DB_SLOW_QUERY_LOG")
+        if log_path and not slow_logger.handlers:
+            handler = logging.FileHandler(log_path, encoding="utf-8")
+            handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+            slow_logger.addHandler(handler)
+
+    def record(self, op: str, elapsed_ms: float, rows: int = 0, ok: bool = True, backend: str = "sql",
+               query=None, params=None):
+        with self._lock:
+            m = self._metrics.get((backend, op))
+            if m is None:
+                m = {"count": 0, "errors": 0, "rows": 0, "total_ms": 0.0, "max_ms": 0.0,
+                     "buckets": [0] * (len(BUCKETS_MS) + 1)}
+                self._metrics[(backend, op)] = m
+            m["count"] += 1
+            if not ok:
+                m["errors"] += 1
+            m["rows"] += max(int(rows or 0), 0)
+            m["total_ms"] += elapsed_ms
+            m["max_ms"] = max(m["max_ms"], elapsed_ms)
+            m["buckets"][self._bucket(elapsed_ms)] += 1
+        if elapsed_ms >= self.slow_ms:
+            text = re.sub(r"\s+", " ", str(query or "")).strip()[:500]
+            slow_logger.warning(
+                f"[slow] {backend}/{op} {elapsed_ms:.1f} ms rows={rows} ok={ok} params={redact(params)} sql={text or '-'}"
+            )
+
+    @staticmethod
+    def _bucket(elapsed_ms: float) -> int:
+        for i, bound in enumerate(BUCKETS_MS):
+            if elapsed_ms <= bound:
+                return i
+        return len(BUCKETS_MS)
+
+    @staticmethod
+    def _percentile(buckets, count: int, q: float) -> Optional[float]:
+        """Limite superior do bucket que contém o quantil (None no bucket +Inf)."""
+        if not count:
+            return None
+        target = q * count
+        seen = 0
+        for i, n in enumerate(buckets):
+            seen += n
+            if seen >= target:
+                return float(BUCKETS_MS[i]) if i < len(BUCKETS_MS) else None
+        return None
+
+    def snapshot(self) -> Dict[str, Dict[str, Dict]]:
+        """{backend: {operação: métricas}}, ordenado pelo tempo total (quem mais pesa primeiro)."""
+        with self._lock:
+            items = [(key, dict(m, buckets=list(m["buckets"]))) for key, m in self._metrics.items()]
+        items.sort(key=lambda item: item[1]["total_ms"], reverse=True)
+        result: Dict[str, Dict[str, Dict]] = {}
+        for (backend, op), m in items:
+            labels = [f"le_{b}ms" for b in BUCKETS_MS] + ["le_inf"]
+            result.setdefault(backend, {})[op] = {
+                "count": m["count"],
+                "errors": m["errors"],
+                "rows": m["rows"],
+                "total_ms": round(m["total_ms"], 2),
+                "avg_ms": round(m["total_ms"] / m["count"], 2) if m["count"] else 0.0,
+                "max_ms": round(m["max_ms"], 2),
+                "p50_ms": self._percentile(m["buckets"], m["count"], 0.50),
+                "p95_ms": self._percentile(m["buckets"], m["count"], 0.95),
+                "histogram": dict(zip(labels, m["buckets"])),
+            }
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._metrics.clear()
+
+
+def get_query_metrics() -> QueryMetrics:
+    global _query_metrics
+    if _query_metrics is None:
+        with _query_metrics_lock:
+            if _query_metrics is None:
+                _query_metrics = QueryMetrics()
+    return _query_metrics
+
+
+@contextmanager
+def timed(backend: str):
+    """Mede um bloco fora de cursor (ex.: chamada REST) na operação atual; o bloco pode
+    preencher box["rows"]."""
+    start = time.perf_counter()
+    box = {"rows": 0}
+    ok = False
+    try:
+        yield box
+        ok = True
+    finally:
+        get_query_metrics().record(current_operation(), (time.perf_counter() - start) * 1000.0,
+                                   rows=box["rows"], ok=ok, backend=backend)
+
+
+def _query_text(query, cursor) -> str:
+    if isinstance(query, psycopg.sql.Composable):
+        try:
+            return query.as_string(cursor)
+        except Exception:
+            return repr(query)
+    return query.decode("utf-8", "replace") if isinstance(query, bytes) else str(query)
+
+
+class TrackedCursor(psycopg.Cursor):
+    """Cursor que mede cada execute (latência, linhas, erros) na operação atual."""
+
+    def execute(self, query, params=None, **kwargs):
+        start = time.perf_counter()
+        ok = False
+        try:
+            result = super().execute(query, params, **kwargs)
+            ok = True
+            return result
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000.0
+            get_query_metrics().record(current_operation(), elapsed_ms, rows=self.rowcount if ok else 0, ok=ok,
+                                       query=_query_text(query, self) if elapsed_ms >= get_query_metrics().slow_ms else None,
+                                       params=params)
+
+
+class TrackedAsyncCursor(psycopg.AsyncCursor):
+    """Versão assíncrona do TrackedCursor."""
+
+    async def execute(self, query, params=None, **kwargs):
+        start = time.perf_counter()
+        ok = False
+        try:
+            result = await super().execute(query, params, **kwargs)
+            ok = True
+            return result
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000.0
+            get_query_metrics().record(current_operation(), elapsed_ms, rows=self.rowcount if ok else 0, ok=ok,
+                                       query=_query_text(query, self) if elapsed_ms >= get_query_metrics().slow_ms else None,
+                                       params=params)
@@ -0,0 +1,134 @@
+"""
+Janitor da fila job_carteirinhas.
+Apenas um processo da frota executa a manutenção: o que detém o advisory lock "sgucard_janitor".
+A cada JANITOR_INTERVAL_SECONDS o líder executa o RPC janitor_sweep:
+- expiração de leases vencidos (processing → pending)
+- reparo de locks órfãos
+- retenção: remove do arquivo jobs arquivados há mais de JOB_RETENTION_DAYS
+Em seguida move jobs terminais ('success' e 'error' sem tentativas restantes) mais antigos que
+JOB_ARCHIVE_AFTER_HOURS para job_carteirinhas_archive (RPC archive_finished_jobs), em lotes de
+JOB_ARCHIVE_BATCH_SIZE — cada lote é uma transação curta —
+até JOB_ARCHIVE_MAX_BATCHES lotes por ciclo. O último sucesso de cada carteirinha fica em carteiras_state.
+Aging das lanes (RPC age_job_priorities): a cada JOB_AGING_STEP_SECONDS de espera um job pendente sobe
+um nível de prioridade, até JOB_AGING_FLOOR.
+Se o líder cair, a sessão do Postgres encerra, o lock é liberado e outro processo assume.
+
+Uso isolado: python queue_janitor.py (ou embutido no worker, JANITOR_ENABLED=true).
+"""
+
+import os
+import time
+import logging
+import threading
+from typing import Dict, Optional
+from dotenv import load_dotenv
+
+from automacao_carteirinhas import DatabaseManager
+
+load_dotenv()
+
+logger = logging.getLogger("queue_janitor")
+
+JANITOR_LOCK_NAME = "sgucard_janitor"
+
+
+class QueueJanitor:
+    """Manutenção periódica da fila com eleição de líder via advisory lock."""
+
+    def __init__(self, job_type: str = 'sgucard', interval: Optional[float] = None, retention_days: Optional[int] = None):
+        self.job_type = job_type
+        self.interval = float(interval or os.getenv("JANITOR_INTERVAL_SECONDS", "60"))
+        self.retention_days = int(retention_days if retention_days is not None else os.getenv("JOB_RETENTION_DAYS", "30"))
+        self.archive_after_hours = int(os.getenv("JOB_ARCHIVE_AFTER_HOURS", "24"))
+        self.archive_batch_size = max(1, int(os.getenv("JOB_ARCHIVE_BATCH_SIZE", "1000")))
+        self.archive_max_batches = int(os.getenv("JOB_ARCHIVE_MAX_BATCHES", "10"))
+        self.aging_step_seconds = int(os.getenv("JOB_AGING_STEP_SECONDS", "1800"))
+        self.aging_floor = int(os.getenv("JOB_AGING_FLOOR", "2"))
+        self.db: Optional[DatabaseManager] = None
+        self.is_leader = False
+
+    def _ensure_db(self) -> DatabaseManager:
+        # Conexão dedicada: o advisory lock vive na sessão e não pode ser compartilhado com o hot path
+        if self.db is None or self.db.connection is None or self.db.connection.closed:
+            self.is_leader = False
+            self.db = DatabaseManager(pooled=False)
+        return self.db
+
+    def _drop_connection(self):
+        self.is_leader = False
+        if self.db is not None:
+            try:
+                self.db.close()
+            except Exception:
+                pass
+        self.db = None
+
+    def try_lead(self) -> bool:
+        """Tenta assumir a liderança; retorna True se este processo é o janitor ativo.
+
+        A manutenção roda pelo JobStorage (REST por padrão), não pela sessão do lock: sem tráfego,
+        uma queda silenciosa dessa sessão não fecharia a conexão e outro processo assumiria o lock.
+        Por isso o líder confere a cada ciclo que a sessão ainda detém o lock."""
+        db = self._ensure_db()
+        if self.is_leader and not db.holds_advisory_lock(JANITOR_LOCK_NAME):
+            logger.warning("[janitor] Sessão do advisory lock perdida; liderança abandonada")
+            self._drop_connection()
+            return False
+        if not self.is_leader:
+            self.is_leader = db.try_advisory_lock(JANITOR_LOCK_NAME)
+            if self.is_leader:
+                logger.info(f"[janitor] Liderança adquirida (intervalo={self.interval}s, retenção={self.retention_days}d)")
+        return self.is_leader
+
+    def run_once(self) -> Dict:
+        """Executa um ciclo de manutenção se for o líder; caso contrário não faz nada."""
+        try:
+            if not self.try_lead():
+                return {}
+            result = dict(self.db.janitor_sweep(self.job_type, self.retention_days))
+            result["archived"] = self.archive()
+            result["aged"] = self.db.age_job_priorities(self.job_type, self.aging_step_seconds, self.aging_floor)
+            if any(result.get(k) for k in ("expired", "repaired", "purged", "archived", "aged")):
+                logger.info(f"[janitor] Manutenção: {result}")
+            return result
+        except Exception as e:
+            logger.warning(f"[janitor] Falha no ciclo de manutenção: {e}")
+            self._drop_connection()
+            return {}
+
+    def archive(self) -> int:
+        """Arquiva jobs concluídos em lotes; para no primeiro lote incompleto (fila de arquivamento vazia)."""
+        archived = 0
+        for _ in range(max(0, self.archive_max_batches)):
+            moved = self.db.archive_finished_jobs(self.job_type, self.archive_after_hours, self.archive_batch_size)
+            archived += moved
+            if moved < self.archive_batch_size:
+                break
+        return archived
+
+    def run_forever(self, stop_event: Optional[threading.Event] = None):
+        stop_event = stop_event or threading.Event()
+        try:
+            while not stop_event.is_set():
+                self.run_once()
+                stop_event.wait(self.interval)
+        finally:
+            self.release()
+
+    def release(self):
+        """Libera a liderança e fecha a conexão dedicada."""
+        if self.is_leader and self.db is not None:
+            try:
+                self.db.advisory_unlock(JANITOR_LOCK_NAME)
+            except Exception:
+                pass
+        self._drop_connection()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+    janitor = QueueJanitor()
+    try:
+        janitor.run_forever()
+    except KeyboardInterrupt:
+        logger.info("Janitor interrompido pelo usuário")
@@ -0,0 +1,41 @@
+-- Índices parciais/cobridores de job_carteirinhas para os caminhos quentes da fila
+-- Complementam idx_job_carteirinhas_claimable e idx_job_carteirinhas_processing_carteirinha
+-- (criados em sql_jobs_rpcs.sql). Todos excluem o histórico que não interessa à consulta,
+-- para que o custo de claim/verificações não cresça com os jobs concluídos acumulados.
+-- Aplicado comando a comando fora de transação (CONCURRENTLY), por apply_jobs_rpcs.py.
+-- Se um CREATE INDEX CONCURRENTLY falhar, o índice fica INVALID: remova-o com
+-- DROP INDEX CONCURRENTLY e aplique de novo (IF NOT EXISTS não recria índice inválido).
+
+-- Jobs em aberto por carteirinha: has_pending_job (pending/processing),
+-- has_active_processing_for_carteirinha (index-only via INCLUDE) e a segunda etapa do
+-- claim_jobs, que reivindica todos os jobs elegíveis das carteirinhas escolhidas
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_job_carteirinhas_open_carteirinha
+  ON public.job_carteirinhas (type, carteirinha)
+  INCLUDE (status, locked_until)
+  WHERE status IN ('pending','error','processing');
+
+-- fetch_jobs_simple: pending/error por antiguidade, filtrando o lock sem visitar a tabela
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_job_carteirinhas_fetch
+  ON public.job_carteirinhas (type, created_at)
+  INCLUDE (locked_until)
+  WHERE status IN ('pending','error');
+
+-- has_recent_success_for_carteirinha e o fresh-skip do claim leem carteiras_state (PK): o antigo
+-- índice de último sucesso por carteirinha não tem mais leitores e só encarecia as escritas
+DROP INDEX CONCURRENTLY IF EXISTS public.idx_job_carteirinhas_success_carteirinha;
+
+-- recent_job_durations (ordem por updated_at DESC) e archive_finished_jobs (updated_at < corte)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_job_carteirinhas_success_updated
+  ON public.job_carteirinhas (type, updated_at)
+  INCLUDE (duration_seconds)
+  WHERE status = 'success';
+
+-- archive_finished_jobs: jobs mortos (error sem tentativas restantes) por antiguidade
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_job_carteirinhas_dead_updated
+  ON public.job_carteirinhas (type, updated_at)
+  WHERE status = 'error' AND attempts >= max_attempts;
+
+-- janitor_sweep: jobs com lock remanescente (normalmente só os em 'processing')
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_job_carteirinhas_locked
+  ON public.job_carteirinhas (type, status)
+  WHERE locked_by IS NOT NULL OR locked_until IS NOT NULL;
@@ -1,15 +1,121 @@
 -- RPCs de gestão de fila de jobs para job_carteirinhas
--- claim_jobs, complete_job, fail_job, heartbeat_job, release_job, purge_stale_processing
+-- claim_jobs, complete_job, complete_jobs, fail_job, fail_jobs, heartbeat_job, heartbeat_jobs, release_job, release_jobs, purge_stale_processing, janitor_sweep
+-- enqueue_jobs (enfileiramento em lote, idempotente por idempotency_key)
+-- carteiras_state: último sucesso/erro por carteirinha, mantido por complete_*/fail_* e lido pelo claim
+-- Lanes de prioridade: job_lane_priority + trigger trg_job_carteirinhas_lane, age_job_priorities (aging), lane_latency_stats
+-- queue_stats (painel da fila em uma consulta, para dashboards/autoscaling)
+-- archive_finished_jobs (move jobs terminais — success e error mortos — para job_carteirinhas_archive e resume em carteiras_state)
+-- take_portal_tokens (token bucket do portal compartilhado pela frota)
+-- Trigger de NOTIFY: trg_job_carteirinhas_enqueued
+
+-- Colunas usadas pelos RPCs (idempotente)
+ALTER TABLE public.job_carteirinhas ADD COLUMN IF NOT EXISTS last_heartbeat_at timestamptz;
+ALTER TABLE public.job_carteirinhas ADD COLUMN IF NOT EXISTS priority smallint NOT NULL DEFAULT 5;
+ALTER TABLE public.job_carteirinhas ADD COLUMN IF NOT EXISTS scheduled_for timestamptz;
+ALTER TABLE public.job_carteirinhas ADD COLUMN IF NOT EXISTS max_attempts integer NOT NULL DEFAULT 3;
+ALTER TABLE public.job_carteirinhas ADD COLUMN IF NOT EXISTS next_attempt_at timestamptz;
+ALTER TABLE public.job_carteirinhas ADD COLUMN IF NOT EXISTS duration_seconds double precision;
+ALTER TABLE public.job_carteirinhas ADD COLUMN IF NOT EXISTS category text;
+ALTER TABLE public.job_carteirinhas ADD COLUMN IF NOT EXISTS scheduled_bucket text;
+ALTER TABLE public.job_carteirinhas ADD COLUMN IF NOT EXISTS idempotency_key text;
+-- Frescor: o claim resolve sem scrape jobs cuja carteirinha teve sucesso há menos de
+-- min_recheck_interval_hours (NULL desativa), exceto com force
+ALTER TABLE public.job_carteirinhas ADD COLUMN IF NOT EXISTS force boolean NOT NULL DEFAULT false;
+ALTER TABLE public.job_carteirinhas ADD COLUMN IF NOT EXISTS min_recheck_interval_hours integer DEFAULT 6;
+ALTER TABLE public.job_carteirinhas ADD COLUMN IF NOT EXISTS result jsonb;
+-- Último passo de aging aplicado à prioridade (age_job_priorities)
+ALTER TABLE public.job_carteirinhas ADD COLUMN IF NOT EXISTS priority_aged_at timestamptz;
+ALTER TABLE public.job_carteirinhas ADD COLUMN IF NOT EXISTS attempts integer;
+UPDATE public.job_carteirinhas SET attempts = 0 WHERE attempts IS NULL;
+ALTER TABLE public.job_carteirinhas ALTER COLUMN attempts SET DEFAULT 0;
+ALTER TABLE public.job_carteirinhas ALTER COLUMN attempts SET NOT NULL;
+
+-- Índice parcial do claim: mesmo predicado e mesma ordenação de claim_jobs.
+-- Jobs concluídos e jobs mortos (attempts >= max_attempts) ficam fora do índice.
+CREATE INDEX IF NOT EXISTS idx_job_carteirinhas_claimable
+  ON public.job_carteirinhas (type, priority, created_at)
+  WHERE status IN ('pending','error') AND attempts < max_attempts;
+
+-- Carteirinhas em andamento: usado pelo claim para pular e agrupar duplicatas
+CREATE INDEX IF NOT EXISTS idx_job_carteirinhas_processing_carteirinha
+  ON public.job_carteirinhas (type, carteirinha)
+  WHERE status = 'processing';
+
+-- Idempotência do enqueue: a mesma chave (tipo:categoria:bucket:carteirinha) nunca gera dois jobs.
+-- NULLs não conflitam entre si, então jobs sem bucket (POST /jobs) não são afetados.
+CREATE UNIQUE INDEX IF NOT EXISTS uq_job_carteirinhas_idempotency_key
+  ON public.job_carteirinhas (idempotency_key);
+
+-- Token bucket do portal, compartilhado por todos os workers e instâncias da API
+CREATE TABLE IF NOT EXISTS public.portal_rate_limits (
+  bucket text PRIMARY KEY,
+  tokens double precision NOT NULL,
+  capacity double precision NOT NULL,
+  refill_per_second double precision NOT NULL,
+  updated_at timestamptz NOT NULL DEFAULT NOW()
+);
+
+-- Arquivo de jobs concluídos: a tabela quente guarda só a fila e o histórico recente.
+-- A linha completa fica em "job" (jsonb), imune a colunas novas em job_carteirinhas.
+CREATE TABLE IF NOT EXISTS public.job_carteirinhas_archive (
+  id uuid PRIMARY KEY,
+  type text NOT NULL,
+  carteirinha text,
+  status text NOT NULL,
+  attempts integer,
+  duration_seconds double precision,
+  created_at timestamptz,
+  updated_at timestamptz,
+  archived_at timestamptz NOT NULL DEFAULT NOW(),
+  job jsonb NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_job_carteirinhas_archive_carteirinha
+  ON public.job_carteirinhas_archive (carteirinha, updated_at DESC);
+CREATE INDEX IF NOT EXISTS idx_job_carteirinhas_archive_archived_at
+  ON public.job_carteirinhas_archive (archived_at);
+
+-- Resumo por carteirinha: último sucesso/erro sem varrer o histórico
+CREATE TABLE IF NOT EXISTS public.carteiras_state (
+  carteirinha text PRIMARY KEY,
+  last_success_at timestamptz,
+  last_error_at timestamptz,
+  updated_at timestamptz NOT NULL DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS idx_carteiras_state_last_success
+  ON public.carteiras_state (last_success_at);
+
+-- Carga inicial do resumo a partir dos sucessos ainda na tabela quente (idempotente)
+INSERT INTO public.carteiras_state AS c (carteirinha, last_success_at, updated_at)
+SELECT j.carteirinha, MAX(j.updated_at), NOW()
+  FROM public.job_carteirinhas j
+ WHERE j.status = 'success'
+   AND j.carteirinha IS NOT NULL
+   AND NOT COALESCE(j.result ? 'skipped', false)
+ GROUP BY j.carteirinha
+ON CONFLICT (carteirinha) DO UPDATE
+   SET last_success_at = GREATEST(c.last_success_at, EXCLUDED.last_success_at),
+       updated_at = NOW();
 
 -- Drops para permitir renomear parâmetros de funções
 DROP FUNCTION IF EXISTS public.claim_jobs(text, integer, integer, text);
 DROP FUNCTION IF EXISTS public.heartbeat_job(uuid, text, integer);
+DROP FUNCTION IF EXISTS public.fail_job(uuid, text, text);
+DROP FUNCTION IF EXISTS public.fail_jobs(uuid[], text[], text);
+DROP FUNCTION IF EXISTS public.complete_jobs(uuid[], text);
+DROP FUNCTION IF EXISTS public.enqueue_jobs(text[], text, text, text, boolean, integer);
 
 -- Função: claim_jobs
+-- Passo único: pending/error elegíveis (agendamento e backoff vencidos, tentativas restantes),
+-- por prioridade e antiguidade, via idx_job_carteirinhas_claimable.
+-- claim_limit conta carteirinhas, não linhas: todos os jobs elegíveis da mesma carteirinha são
+-- reivindicados juntos (um único scrape) e carteirinhas já em 'processing' são puladas.
+-- Frescor (carteiras_state, uma busca pela PK por candidato): jobs sem force cuja carteirinha teve
+-- sucesso há menos de min_recheck_interval_hours são resolvidos como 'success' com
+-- result = {"skipped": "fresh"} e não contam no claim_limit.
 CREATE OR REPLACE FUNCTION public.claim_jobs(
   worker_id text,
   claim_limit integer DEFAULT 1,
-  p_visibility_timeout_seconds integer DEFAULT 900,
+  p_visibility_timeout_seconds integer DEFAULT 90,
   job_type text DEFAULT 'sgucard'
 )
 RETURNS SETOF public.job_carteirinhas
@@ -18,27 +124,90 @@ SECURITY DEFINER
 AS $$
 DECLARE
   v_limit integer := GREATEST(claim_limit, 1);
+  v_carteirinhas text[] := '{}';
+  v_ids uuid[] := '{}';
+  v_fresh_ids uuid[] := '{}';
+  r record;
 BEGIN
-  RETURN QUERY
-  WITH available AS (
-    SELECT j.id
+  FOR r IN
+    SELECT j.id, j.carteirinha,
+           (NOT j.force
+            AND j.min_recheck_interval_hours IS NOT NULL
+            AND (SELECT c.last_success_at FROM public.carteiras_state c WHERE c.carteirinha = j.carteirinha)
+                >= NOW() - make_interval(hours => j.min_recheck_interval_hours)) AS fresh
       FROM public.job_carteirinhas j
      WHERE j.type = job_type
        AND j.status IN ('pending','error')
-       AND (j.locked_until IS NULL OR j.locked_until < NOW())
-     ORDER BY j.created_at ASC
-     LIMIT v_limit
+       AND j.attempts < j.max_attempts
+       AND (j.scheduled_for IS NULL OR j.scheduled_for <= NOW())
+       AND (j.next_attempt_at IS NULL OR j.next_attempt_at <= NOW())
+       AND NOT EXISTS (
+         SELECT 1 FROM public.job_carteirinhas p
+          WHERE p.type = job_type AND p.carteirinha = j.carteirinha AND p.status = 'processing'
+       )
+     ORDER BY j.priority ASC, j.created_at ASC
+     -- folga para duplicatas: várias linhas podem pertencer à mesma carteirinha
+     LIMIT v_limit * 5
      FOR UPDATE SKIP LOCKED
-  ),
-  updated AS (
+  LOOP
+    EXIT WHEN cardinality(v_carteirinhas) + cardinality(v_ids) >= v_limit;
+    IF r.fresh THEN
+      v_fresh_ids := v_fresh_ids || r.id;
+      CONTINUE;
+    END IF;
+    IF r.carteirinha IS NULL THEN
+      v_ids := v_ids || r.id;
+      CONTINUE;
+    END IF;
+    CONTINUE WHEN r.carteirinha = ANY(v_carteirinhas);
+    -- Serializa claims concorrentes da mesma carteirinha até o commit
+    CONTINUE WHEN NOT pg_try_advisory_xact_lock(hashtext('job_carteirinhas:' || r.carteirinha));
+    -- Revalida com snapshot novo: outro claim pode ter acabado de commitar esta carteirinha
+    CONTINUE WHEN EXISTS (
+      SELECT 1 FROM public.job_carteirinhas p
+       WHERE p.type = job_type AND p.carteirinha = r.carteirinha AND p.status = 'processing'
+    );
+    v_carteirinhas := v_carteirinhas || r.carteirinha;
+  END LOOP;
+
+  -- Resolve os jobs frescos antes do claim, para que a etapa abaixo não os pegue
+  IF cardinality(v_fresh_ids) > 0 THEN
+    UPDATE public.job_carteirinhas j
+       SET status = 'success',
+           result = jsonb_build_object(
+             'skipped', 'fresh',
+             'last_success_at', (SELECT c.last_success_at FROM public.carteiras_state c WHERE c.carteirinha = j.carteirinha)
+           ),
+           locked_by = NULL,
+           locked_at = NULL,
+           locked_until = NULL,
+           updated_at = NOW()
+     WHERE j.id = ANY(v_fresh_ids);
+  END IF;
+
+  RETURN QUERY
+  WITH updated AS (
     UPDATE public.job_carteirinhas j
        SET status = 'processing',
            locked_by = worker_id,
            locked_at = NOW(),
            locked_until = NOW() + (p_visibility_timeout_seconds || ' seconds')::interval,
-           attempts = COALESCE(j.attempts, 0) + 1,
+           attempts = j.attempts + 1,
            updated_at = NOW()
-     WHERE j.id IN (SELECT id FROM available)
+     WHERE j.id IN (
+       SELECT s.id
+         FROM public.job_carteirinhas s
+        WHERE s.type = job_type
+          AND (
+            s.id = ANY(v_ids)
+            OR (s.carteirinha = ANY(v_carteirinhas)
+                AND s.status IN ('pending','error')
+                AND s.attempts < s.max_attempts
+                AND (s.scheduled_for IS NULL OR s.scheduled_for <= NOW())
+                AND (s.next_attempt_at IS NULL OR s.next_attempt_at <= NOW()))
+          )
+          FOR UPDATE SKIP LOCKED
+     )
      RETURNING j.*
   )
   SELECT * FROM updated;
@@ -58,24 +227,37 @@ AS $$
 DECLARE
   updated_count integer;
 BEGIN
-  UPDATE public.job_carteirinhas j
-     SET status = 'success',
-         locked_by = NULL,
-         locked_at = NULL,
-         locked_until = NULL,
-         updated_at = NOW()
-   WHERE j.id = job_id
-     AND j.locked_by = worker_id;
-  GET DIAGNOSTICS updated_count = ROW_COUNT;
+  WITH done AS (
+    UPDATE public.job_carteirinhas j
+       SET status = 'success',
+           result = complete_job.result,
+           locked_by = NULL,
+           locked_at = NULL,
+           locked_until = NULL,
+           updated_at = NOW()
+     WHERE j.id = job_id
+       AND j.locked_by = worker_id
+    RETURNING j.carteirinha
+  ), state AS (
+    INSERT INTO public.carteiras_state AS c (carteirinha, last_success_at, updated_at)
+    SELECT DISTINCT d.carteirinha, NOW(), NOW() FROM done d WHERE d.carteirinha IS NOT NULL
+    ON CONFLICT (carteirinha) DO UPDATE SET last_success_at = EXCLUDED.last_success_at, updated_at = NOW()
+    RETURNING 1
+  )
+  SELECT count(*) INTO updated_count FROM done;
   RETURN updated_count > 0;
 END;
 $$;
 
 -- Função: fail_job
+-- Backoff exponencial: próxima tentativa em base * 2^(attempts-1), limitado a p_backoff_max_seconds.
+-- Com attempts >= max_attempts o job fica morto em 'error' e sai do conjunto reivindicável.
 CREATE OR REPLACE FUNCTION public.fail_job(
   job_id uuid,
   worker_id text,
-  p_error text
+  p_error text,
+  p_backoff_base_seconds integer DEFAULT 60,
+  p_backoff_max_seconds integer DEFAULT 3600
 )
 RETURNS boolean
 LANGUAGE plpgsql
@@ -84,20 +266,117 @@ AS $$
 DECLARE
   updated_count integer;
 BEGIN
-  UPDATE public.job_carteirinhas j
-     SET status = 'error',
-         error = p_error,
-         locked_by = NULL,
-         locked_at = NULL,
-         locked_until = NULL,
-         updated_at = NOW()
-   WHERE j.id = job_id
-     AND j.locked_by = worker_id;
-  GET DIAGNOSTICS updated_count = ROW_COUNT;
+  WITH failed AS (
+    UPDATE public.job_carteirinhas j
+       SET status = 'error',
+           error = p_error,
+           next_attempt_at = NOW() + make_interval(secs => LEAST(
+             p_backoff_max_seconds::double precision,
+             p_backoff_base_seconds * power(2, GREATEST(j.attempts - 1, 0))
+           )),
+           locked_by = NULL,
+           locked_at = NULL,
+           locked_until = NULL,
+           updated_at = NOW()
+     WHERE j.id = job_id
+       AND j.locked_by = worker_id
+    RETURNING j.carteirinha
+  ), state AS (
+    INSERT INTO public.carteiras_state AS c (carteirinha, last_error_at, updated_at)
+    SELECT DISTINCT f.carteirinha, NOW(), NOW() FROM failed f WHERE f.carteirinha IS NOT NULL
+    ON CONFLICT (carteirinha) DO UPDATE SET last_error_at = EXCLUDED.last_error_at, updated_at = NOW()
+    RETURNING 1
+  )
+  SELECT count(*) INTO updated_count FROM failed;
   RETURN updated_count > 0;
 END;
 $$;
 
+-- Função: complete_jobs (ack em lote)
+-- complete_jobs/fail_jobs só gravam jobs em 'processing' ainda sob o lease do worker: um ack atrasado
+-- ou repetido de um job que o janitor/release_jobs já devolveu à fila (ou que já terminou) não o altera.
+-- p_durations (s, alinhado com p_job_ids): duração do scrape medida pelo worker; NULL usa o tempo desde o claim
+CREATE OR REPLACE FUNCTION public.complete_jobs(
+  p_job_ids uuid[],
+  p_worker_id text,
+  p_durations double precision[] DEFAULT NULL
+)
+RETURNS integer
+LANGUAGE plpgsql
+SECURITY DEFINER
+AS $$
+DECLARE
+  updated_count integer;
+BEGIN
+  WITH done AS (
+    UPDATE public.job_carteirinhas j
+       SET status = 'success',
+           -- mesma medida que o deadline aprendido pelo worker registra em memória
+           duration_seconds = COALESCE(d.duration, EXTRACT(EPOCH FROM (NOW() - j.locked_at))),
+           locked_by = NULL,
+           locked_at = NULL,
+           locked_until = NULL,
+           updated_at = NOW()
+      FROM unnest(p_job_ids, COALESCE(p_durations, '{}'::double precision[])) AS d(id, duration)
+     WHERE j.id = d.id
+       AND j.status = 'processing'
+       AND j.locked_by = p_worker_id
+    RETURNING j.carteirinha
+  ), state AS (
+    -- DISTINCT: um grupo coalescido tem vários jobs da mesma carteirinha
+    INSERT INTO public.carteiras_state AS c (carteirinha, last_success_at, updated_at)
+    SELECT DISTINCT d.carteirinha, NOW(), NOW() FROM done d WHERE d.carteirinha IS NOT NULL
+    ON CONFLICT (carteirinha) DO UPDATE SET last_success_at = EXCLUDED.last_success_at, updated_at = NOW()
+    RETURNING 1
+  )
+  SELECT count(*) INTO updated_count FROM done;
+  RETURN updated_count;
+END;
+$$;
+
+-- Função: fail_jobs (ack de falha em lote; p_errors alinhado posicionalmente com p_job_ids; mesmo backoff de fail_job)
+CREATE OR REPLACE FUNCTION public.fail_jobs(
+  p_job_ids uuid[],
+  p_errors text[],
+  p_worker_id text,
+  p_backoff_base_seconds integer DEFAULT 60,
+  p_backoff_max_seconds integer DEFAULT 3600
+)
+RETURNS integer
+LANGUAGE plpgsql
+SECURITY DEFINER
+AS $$
+DECLARE
+  updated_count integer;
+BEGIN
+  WITH failed AS (
+    UPDATE public.job_carteirinhas j
+       SET status = 'error',
+           error = f.err,
+           next_attempt_at = NOW() + make_interval(secs => LEAST(
+             p_backoff_max_seconds::double precision,
+             p_backoff_base_seconds * power(2, GREATEST(j.attempts - 1, 0))
+           )),
+           locked_by = NULL,
+           locked_at = NULL,
+           locked_until = NULL,
+           updated_at = NOW()
+      FROM unnest(p_job_ids, p_errors) AS f(id, err)
+     WHERE j.id = f.id
+       AND j.status = 'processing'
+       AND j.locked_by = p_worker_id
+    RETURNING j.carteirinha
+  ), state AS (
+    INSERT INTO public.carteiras_state AS c (carteirinha, last_error_at, updated_at)
+    SELECT DISTINCT d.carteirinha, NOW(), NOW() FROM failed d WHERE d.carteirinha IS NOT NULL
+    ON CONFLICT (carteirinha) DO UPDATE SET last_error_at = EXCLUDED.last_error_at, updated_at = NOW()
+    RETURNING 1
+  )
+  SELECT count(*) INTO updated_count FROM failed;
+  RETURN updated_count;
+END;
+$$;
+
 -- Função: heartbeat_job (renova visibilidade)
 CREATE OR REPLACE FUNCTION public.heartbeat_job(
   job_id uuid,
@@ -113,6 +392,7 @@ DECLARE
 BEGIN
   UPDATE public.job_carteirinhas j
      SET locked_until = NOW() + (p_visibility_timeout_seconds || ' seconds')::interval,
+         last_heartbeat_at = NOW(),
          updated_at = NOW()
    WHERE j.id = job_id
      AND j.locked_by = worker_id
@@ -122,7 +402,32 @@ BEGIN
 END;
 $$;
 
--- Função: release_job (libera job para outro worker)
+-- Função: heartbeat_jobs (renova a visibilidade de vários jobs do worker em um único UPDATE)
+CREATE OR REPLACE FUNCTION public.heartbeat_jobs(
+  p_job_ids uuid[],
+  p_worker_id text,
+  p_visibility_timeout_seconds integer DEFAULT 90
+)
+RETURNS integer
+LANGUAGE plpgsql
+SECURITY DEFINER
+AS $$
+DECLARE
+  updated_count integer;
+BEGIN
+  UPDATE public.job_carteirinhas j
+     SET locked_until = NOW() + (p_visibility_timeout_seconds || ' seconds')::interval,
+         last_heartbeat_at = NOW(),
+         updated_at = NOW()
+   WHERE j.id = ANY(p_job_ids)
+     AND j.locked_by = p_worker_id
+     AND j.status = 'processing';
+  GET DIAGNOSTICS updated_count = ROW_COUNT;
+  RETURN updated_count;
+END;
+$$;
+
+-- Função: release_job (libera job para outro worker; a tentativa não conta)
 CREATE OR REPLACE FUNCTION public.release_job(
   job_id uuid,
   worker_id text
@@ -136,6 +441,7 @@ DECLARE
 BEGIN
   UPDATE public.job_carteirinhas j
      SET status = 'pending',
+         attempts = GREATEST(j.attempts - 1, 0),
          locked_by = NULL,
          locked_at = NULL,
          locked_until = NULL,
@@ -148,6 +454,33 @@ BEGIN
 END;
 $$;
 
+-- Função: release_jobs (devolve vários jobs do worker à fila em um único UPDATE; usada no drain do worker)
+CREATE OR REPLACE FUNCTION public.release_jobs(
+  p_job_ids uuid[],
+  p_worker_id text
+)
+RETURNS integer
+LANGUAGE plpgsql
+SECURITY DEFINER
+AS $$
+DECLARE
+  updated_count integer;
+BEGIN
+  UPDATE public.job_carteirinhas j
+     SET status = 'pending',
+         attempts = GREATEST(j.attempts - 1, 0),
+         locked_by = NULL,
+         locked_at = NULL,
+         locked_until = NULL,
+         updated_at = NOW()
+   WHERE j.id = ANY(p_job_ids)
+     AND j.locked_by = p_worker_id
+     AND j.status = 'processing';
+  GET DIAGNOSTICS updated_count = ROW_COUNT;
+  RETURN updated_count;
+END;
+$$;
+
 -- Função: purge_stale_processing (reabre jobs expirados)
 CREATE OR REPLACE FUNCTION public.purge_stale_processing(
   job_type text DEFAULT 'sgucard'
@@ -174,10 +507,469 @@ BEGIN
 END;
 $$;
 
+-- Função: janitor_sweep (manutenção da fila; executada apenas pelo janitor eleito)
+-- 1) expira leases vencidos, 2) repara locks órfãos, 3) aplica retenção ao arquivo de jobs concluídos (em lotes)
+CREATE OR REPLACE FUNCTION public.janitor_sweep(
+  job_type text DEFAULT 'sgucard',
+  p_retention_days integer DEFAULT 30,
+  p_batch_size integer DEFAULT 5000
+)
+RETURNS jsonb
+LANGUAGE plpgsql
+SECURITY DEFINER
+AS $$
+DECLARE
+  v_expired integer := 0;
+  v_repaired integer := 0;
+  v_count integer := 0;
+  v_purged integer := 0;
+BEGIN
+  -- Leases vencidos (worker caiu ou parou de enviar heartbeat)
+  UPDATE public.job_carteirinhas j
+     SET status = 'pending',
+         locked_by = NULL,
+         locked_at = NULL,
+         locked_until = NULL,
+         updated_at = NOW()
+   WHERE j.type = job_type
+     AND j.status = 'processing'
+     AND j.locked_until IS NOT NULL
+     AND j.locked_until < NOW();
+  GET DIAGNOSTICS v_expired = ROW_COUNT;
+
+  -- 'processing' sem lease nunca expiraria
+  UPDATE public.job_carteirinhas j
+     SET status = 'pending',
+         locked_by = NULL,
+         locked_at = NULL,
+         updated_at = NOW()
+   WHERE j.type = job_type
+     AND j.status = 'processing'
+     AND j.locked_until IS NULL;
+  GET DIAGNOSTICS v_repaired = ROW_COUNT;
+
+  -- Jobs fora de 'processing' que mantiveram o lock
+  UPDATE public.job_carteirinhas j
+     SET locked_by = NULL,
+         locked_at = NULL,
+         locked_until = NULL,
+         updated_at = NOW()
+   WHERE j.type = job_type
+     AND j.status <> 'processing'
+     AND (j.locked_by IS NOT NULL OR j.locked_until IS NOT NULL);
+  GET DIAGNOSTICS v_count = ROW_COUNT;
+  v_repaired := v_repaired + v_count;
+
+  -- Retenção do arquivo (jobs concluídos já saíram da tabela quente via archive_finished_jobs), um lote por execução
+  IF p_retention_days IS NOT NULL AND p_retention_days > 0 THEN
+    DELETE FROM public.job_carteirinhas_archive
+     WHERE id IN (
+       SELECT id
+         FROM public.job_carteirinhas_archive
+        WHERE type = job_type
+          AND archived_at < NOW() - make_interval(days => p_retention_days)
+        LIMIT GREATEST(1, p_batch_size)
+     );
+    GET DIAGNOSTICS v_purged = ROW_COUNT;
+  END IF;
+
+  RETURN jsonb_build_object('expired', v_expired, 'repaired', v_repaired, 'purged', v_purged);
+END;
+$$;
+
+-- Função: take_portal_tokens
+-- Retorna 0 quando os tokens foram concedidos; caso contrário, os segundos até haver tokens suficientes.
+-- capacity/refill vêm de quem chama (mesma configuração em toda a frota) e são gravados no bucket.
+CREATE OR REPLACE FUNCTION public.take_portal_tokens(
+  p_bucket text DEFAULT 'sgucard',
+  p_tokens double precision DEFAULT 1,
+  p_capacity double precision DEFAULT 2,
+  p_refill_per_second double precision DEFAULT 0.2
+)
+RETURNS double precision
+LANGUAGE plpgsql
+SECURITY DEFINER
+AS $$
+DECLARE
+  v_tokens double precision;
+  v_updated_at timestamptz;
+  v_available double precision;
+BEGIN
+  INSERT INTO public.portal_rate_limits (bucket, tokens, capacity, refill_per_second)
+  VALUES (p_bucket, p_capacity, p_capacity, p_refill_per_second)
+  ON CONFLICT (bucket) DO NOTHING;
+
+  SELECT tokens, updated_at INTO v_tokens, v_updated_at
+    FROM public.portal_rate_limits
+   WHERE bucket = p_bucket
+   FOR UPDATE;
+
+  v_available := LEAST(
+    p_capacity,
+    v_tokens + GREATEST(EXTRACT(EPOCH FROM (clock_timestamp() - v_updated_at)), 0) * p_refill_per_second
+  );
+
+  IF v_available >= p_tokens THEN
+    UPDATE public.portal_rate_limits
+       SET tokens = v_available - p_tokens,
+           capacity = p_capacity,
+           refill_per_second = p_refill_per_second,
+           updated_at = clock_timestamp()
+     WHERE bucket = p_bucket;
+    RETURN 0;
+  END IF;
+
+  UPDATE public.portal_rate_limits
+     SET tokens = v_available,
+         capacity = p_capacity,
+         refill_per_second = p_refill_per_second,
+         updated_at = clock_timestamp()
+   WHERE bucket = p_bucket;
+  RETURN (p_tokens - v_available) / GREATEST(p_refill_per_second, 0.0001);
+END;
+$$;
+
+-- Função: enqueue_jobs
+-- Enfileira um job por carteirinha em um único INSERT. Com p_scheduled_bucket (ex.: a data da rodada),
+-- cada job recebe idempotency_key = tipo:categoria:bucket:carteirinha e ON CONFLICT descarta repetições,
+-- então rodar o mesmo lote de novo não duplica jobs. Opcionalmente pula carteirinhas com job em aberto
+-- (pending/processing) ou com sucesso nas últimas p_skip_recent_hours horas (carteiras_state).
+-- p_force e p_min_recheck_hours vão para os jobs e valem no claim. Retorna as contagens.
+CREATE OR REPLACE FUNCTION public.enqueue_jobs(
+  p_carteirinhas text[],
+  p_category text DEFAULT 'adhoc',
+  p_scheduled_bucket text DEFAULT NULL,
+  job_type text DEFAULT 'sgucard',
+  p_skip_open boolean DEFAULT true,
+  p_skip_recent_hours integer DEFAULT 0,
+  p_force boolean DEFAULT false,
+  p_min_recheck_hours integer DEFAULT 6
+)
+RETURNS jsonb
+LANGUAGE plpgsql
+SECURITY DEFINER
+AS $$
+DECLARE
+  v_candidates text[];
+  v_requested integer;
+  v_remaining integer;
+  v_open integer := 0;
+  v_recent integer := 0;
+  v_created integer := 0;
+BEGIN
+  SELECT COALESCE(array_agg(DISTINCT btrim(c)), '{}')
+    INTO v_candidates
+    FROM unnest(p_carteirinhas) AS c
+   WHERE btrim(c) <> '';
+  v_requested := cardinality(v_candidates);
+
+  IF p_skip_open THEN
+    SELECT COALESCE(array_agg(c), '{}')
+      INTO v_candidates
+      FROM unnest(v_candidates) AS c
+     WHERE NOT EXISTS (
+       SELECT 1 FROM public.job_carteirinhas j
+        WHERE j.type = job_type AND j.carteirinha = c AND j.status IN ('pending','processing')
+     );
+    v_open := v_requested - cardinality(v_candidates);
+  END IF;
+
+  IF p_skip_recent_hours IS NOT NULL AND p_skip_recent_hours > 0 THEN
+    v_remaining := cardinality(v_candidates);
+    SELECT COALESCE(array_agg(c), '{}')
+      INTO v_candidates
+      FROM unnest(v_candidates) AS c
+     WHERE NOT EXISTS (
+       SELECT 1 FROM public.carteiras_state s
+        WHERE s.carteirinha = c
+          AND s.last_success_at >= NOW() - make_interval(hours => p_skip_recent_hours)
+     );
+    v_recent := v_remaining - cardinality(v_candidates);
+  END IF;
+
+  INSERT INTO public.job_carteirinhas
+    (type, carteirinha, carteira, category, scheduled_bucket, force, min_recheck_interval_hours, idempotency_key)
+  SELECT job_type, c, c, p_category, p_scheduled_bucket, p_force, p_min_recheck_hours,
+         CASE WHEN p_scheduled_bucket IS NULL THEN NULL
+              ELSE concat_ws(':', job_type, p_category, p_scheduled_bucket, c) END
+    FROM unnest(v_candidates) AS c
+  ON CONFLICT (idempotency_key) DO NOTHING;
+  GET DIAGNOSTICS v_created = ROW_COUNT;
+
+  RETURN jsonb_build_object(
+    'requested', v_requested,
+    'created', v_created,
+    'duplicates', cardinality(v_candidates) - v_created,
+    'skipped_open', v_open,
+    'skipped_recent', v_recent
+  );
+END;
+$$;
+
+-- Lanes de prioridade: a categoria define a prioridade inicial do job (menor = antes no claim).
+-- adhoc (pedidos interativos) = 1, scheduled_daily = 5, scheduled_weekly = 9; demais = 5.
+CREATE OR REPLACE FUNCTION public.job_lane_priority(p_category text)
+RETURNS smallint
+LANGUAGE sql
+IMMUTABLE
+AS $$
+  SELECT (CASE p_category
+            WHEN 'adhoc' THEN 1
+            WHEN 'scheduled_daily' THEN 5
+            WHEN 'scheduled_weekly' THEN 9
+            ELSE 5
+          END)::smallint;
+$$;
+
+-- Aplica a prioridade da lane em todo insert com categoria (RPC, REST ou SQL direto)
+CREATE OR REPLACE FUNCTION public.set_job_lane_priority()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  IF NEW.category IS NOT NULL THEN
+    NEW.priority := public.job_lane_priority(NEW.category);
+  END IF;
+  RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trg_job_carteirinhas_lane ON public.job_carteirinhas;
+CREATE TRIGGER trg_job_carteirinhas_lane
+BEFORE INSERT ON public.job_carteirinhas
+FOR EACH ROW
+EXECUTE FUNCTION public.set_job_lane_priority();
+
+-- Função: age_job_priorities
+-- Aging: a cada p_step_seconds de espera um job elegível sobe um nível de prioridade, até p_floor.
+-- Com p_floor = 2 um job em lote nunca passa à frente de um adhoc novo, mas também nunca fica
+-- parado atrás de lotes mais novos. Usa idx_job_carteirinhas_claimable (mesmo predicado).
+CREATE OR REPLACE FUNCTION public.age_job_priorities(
+  job_type text DEFAULT 'sgucard',
+  p_step_seconds integer DEFAULT 1800,
+  p_floor integer DEFAULT 2
+)
+RETURNS integer
+LANGUAGE plpgsql
+SECURITY DEFINER
+AS $$
+DECLARE
+  v_aged integer := 0;
+BEGIN
+  IF p_step_seconds IS NULL OR p_step_seconds <= 0 THEN
+    RETURN 0;
+  END IF;
+  UPDATE public.job_carteirinhas j
+     SET priority = j.priority - 1,
+         priority_aged_at = NOW()
+   WHERE j.type = job_type
+     AND j.status IN ('pending','error')
+     AND j.attempts < j.max_attempts
+     AND j.priority > p_floor
+     AND COALESCE(j.priority_aged_at, j.created_at) < NOW() - make_interval(secs => p_step_seconds);
+  GET DIAGNOSTICS v_aged = ROW_COUNT;
+  RETURN v_aged;
+END;
+$$;
+
+-- Função: lane_latency_stats
+-- Latência por lane (categoria) nas últimas p_window_hours: espera na fila (claim - criação),
+-- ponta a ponta (conclusão - criação), p50/p95, além de profundidade e idade do pending mais antigo.
+-- Jobs resolvidos sem scrape (result.skipped) ficam fora das latências.
+CREATE OR REPLACE FUNCTION public.lane_latency_stats(
+  job_type text DEFAULT 'sgucard',
+  p_window_hours integer DEFAULT 24
+)
+RETURNS jsonb
+LANGUAGE sql
+STABLE
+SECURITY DEFINER
+AS $$
+  WITH done AS (
+    SELECT COALESCE(j.category, 'none') AS lane,
+           EXTRACT(EPOCH FROM (j.updated_at - make_interval(secs => j.duration_seconds) - j.created_at)) AS wait_s,
+           EXTRACT(EPOCH FROM (j.updated_at - j.created_at)) AS total_s
+      FROM public.job_carteirinhas j
+     WHERE j.type = job_type
+       AND j.status = 'success'
+       AND j.updated_at >= NOW() - make_interval(hours => p_window_hours)
+       AND j.duration_seconds IS NOT NULL
+  ), latency AS (
+    SELECT lane,
+           count(*) AS completed,
+           percentile_cont(0.5) WITHIN GROUP (ORDER BY wait_s) AS wait_p50,
+           percentile_cont(0.95) WITHIN GROUP (ORDER BY wait_s) AS wait_p95,
+           percentile_cont(0.95) WITHIN GROUP (ORDER BY total_s) AS total_p95
+      FROM done
+     GROUP BY lane
+  ), backlog AS (
+    SELECT COALESCE(j.category, 'none') AS lane,
+           count(*) AS pending,
+           EXTRACT(EPOCH FROM (NOW() - MIN(j.created_at))) AS oldest_pending_s
+      FROM public.job_carteirinhas j
+     WHERE j.type = job_type
+       AND j.status IN ('pending','error')
+       AND j.attempts < j.max_attempts
+     GROUP BY 1
+  )
+  SELECT COALESCE(jsonb_object_agg(
+           COALESCE(l.lane, b.lane),
+           jsonb_build_object(
+             'completed', COALESCE(l.completed, 0),
+             'wait_p50_seconds', round(l.wait_p50::numeric, 1),
+             'wait_p95_seconds', round(l.wait_p95::numeric, 1),
+             'total_p95_seconds', round(l.total_p95::numeric, 1),
+             'pending', COALESCE(b.pending, 0),
+             'oldest_pending_seconds', round(b.oldest_pending_s::numeric, 1)
+           )
+         ), '{}'::jsonb)
+    FROM latency l
+    FULL OUTER JOIN backlog b ON b.lane = l.lane;
+$$;
+
+-- Função: queue_stats
+-- Uma única varredura da tabela quente (CTE materializada, reutilizada pelas agregações):
+-- contagens por tipo/status, idade do pending mais antigo, processing por worker, leases vencidos
+-- e histograma de tentativas dos jobs em aberto. job_type NULL = todos os tipos.
+CREATE OR REPLACE FUNCTION public.queue_stats(
+  job_type text DEFAULT NULL
+)
+RETURNS jsonb
+LANGUAGE sql
+STABLE
+SECURITY DEFINER
+AS $$
+  WITH base AS MATERIALIZED (
+    SELECT j.type, j.status, j.attempts, j.max_attempts, j.locked_by, j.locked_until, j.created_at
+      FROM public.job_carteirinhas j
+     WHERE job_type IS NULL OR j.type = job_type
+  ), by_status AS (
+    SELECT type, jsonb_object_agg(status, n) AS counts
+      FROM (SELECT type, status, count(*) AS n FROM base GROUP BY type, status) s
+     GROUP BY type
+  ), oldest AS (
+    SELECT type, EXTRACT(EPOCH FROM (NOW() - MIN(created_at))) AS oldest_pending_s
+      FROM base
+     WHERE status IN ('pending','error') AND attempts < max_attempts
+     GROUP BY type
+  ), per_type AS (
+    SELECT jsonb_object_agg(
+             b.type,
+             b.counts || jsonb_build_object('oldest_pending_seconds', round(o.oldest_pending_s::numeric, 1))
+           ) AS v
+      FROM by_status b
+      LEFT JOIN oldest o ON o.type = b.type
+  ), workers AS (
+    SELECT jsonb_object_agg(locked_by, n) AS v
+      FROM (SELECT COALESCE(locked_by, '?') AS locked_by, count(*) AS n
+              FROM base WHERE status = 'processing' GROUP BY 1) w
+  ), retries AS (
+    SELECT jsonb_object_agg(attempts::text, n) AS v
+      FROM (SELECT attempts, count(*) AS n
+              FROM base
+             WHERE status IN ('pending','error','processing')
+             GROUP BY attempts) r
+  )
+  SELECT jsonb_build_object(
+    'by_type', COALESCE((SELECT v FROM per_type), '{}'::jsonb),
+    'processing_by_worker', COALESCE((SELECT v FROM workers), '{}'::jsonb),
+    'expired_leases', (SELECT count(*) FROM base WHERE status = 'processing' AND locked_until < NOW()),
+    'dead', (SELECT count(*) FROM base WHERE status = 'error' AND attempts >= max_attempts),
+    'retry_histogram', COALESCE((SELECT v FROM retries), '{}'::jsonb),
+    'generated_at', NOW()
+  );
+$$;
+
+-- Função: archive_finished_jobs
+-- Move um lote de jobs terminais — 'success' e 'error' mortos (attempts >= max_attempts) — mais antigos
+-- que p_archive_after_hours para job_carteirinhas_archive e registra o último sucesso real (não 'skipped')
+-- de cada carteirinha em carteiras_state (o último erro já é gravado por fail_job/fail_jobs). Lotes pequenos com SKIP LOCKED:
+-- cada chamada é uma transação curta que não disputa linhas com o claim. Retorna quantos jobs moveu.
+CREATE OR REPLACE FUNCTION public.archive_finished_jobs(
+  job_type text DEFAULT 'sgucard',
+  p_archive_after_hours integer DEFAULT 24,
+  p_batch_size integer DEFAULT 1000
+)
+RETURNS integer
+LANGUAGE plpgsql
+SECURITY DEFINER
+AS $$
+DECLARE
+  v_count integer := 0;
+BEGIN
+  WITH moved AS (
+    DELETE FROM public.job_carteirinhas j
+     WHERE j.id IN (
+       SELECT s.id
+         FROM public.job_carteirinhas s
+        WHERE s.type = job_type
+          AND (s.status = 'success' OR (s.status = 'error' AND s.attempts >= s.max_attempts))
+          AND s.updated_at < NOW() - make_interval(hours => GREATEST(p_archive_after_hours, 0))
+        ORDER BY s.updated_at
+        LIMIT GREATEST(1, p_batch_size)
+        FOR UPDATE SKIP LOCKED
+     )
+    RETURNING j.*
+  ), archived AS (
+    INSERT INTO public.job_carteirinhas_archive
+      (id, type, carteirinha, status, attempts, duration_seconds, created_at, updated_at, job)
+    SELECT m.id, m.type, m.carteirinha, m.status, m.attempts, m.duration_seconds, m.created_at, m.updated_at, to_jsonb(m)
+      FROM moved m
+    ON CONFLICT (id) DO NOTHING
+    RETURNING 1
+  ), summary AS (
+    INSERT INTO public.carteiras_state AS c (carteirinha, last_success_at, updated_at)
+    SELECT m.carteirinha, MAX(m.updated_at), NOW()
+      FROM moved m
+     WHERE m.carteirinha IS NOT NULL
+       AND m.status = 'success'
+       AND NOT COALESCE(m.result ? 'skipped', false)
+     GROUP BY m.carteirinha
+    ON CONFLICT (carteirinha) DO UPDATE
+       SET last_success_at = GREATEST(c.last_success_at, EXCLUDED.last_success_at),
+           updated_at = NOW()
+    RETURNING 1
+  )
+  SELECT count(*) INTO v_count FROM moved;
+  RETURN v_count;
+END;
+$$;
+
+-- Notificação de enfileiramento: workers em LISTEN job_carteirinhas_enqueued acordam na hora.
+-- Dispara em inserts (POST /jobs, scripts) e quando um RPC devolve o job para 'pending'
+-- (release_job, release_jobs, purge_stale_processing, janitor_sweep). Notificações iguais na mesma transação são agrupadas pelo Postgres.
+CREATE OR REPLACE FUNCTION public.notify_job_enqueued()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  PERFORM pg_notify('job_carteirinhas_enqueued', NEW.type);
+  RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trg_job_carteirinhas_enqueued ON public.job_carteirinhas;
+CREATE TRIGGER trg_job_carteirinhas_enqueued
+AFTER INSERT OR UPDATE OF status ON public.job_carteirinhas
+FOR EACH ROW
+WHEN (NEW.status = 'pending')
+EXECUTE FUNCTION public.notify_job_enqueued();
+
 -- Permissões de execução das funções RPC
 GRANT EXECUTE ON FUNCTION public.claim_jobs(text, integer, integer, text) TO authenticated, service_role;
 GRANT EXECUTE ON FUNCTION public.complete_job(uuid, text, jsonb) TO authenticated, service_role;
-GRANT EXECUTE ON FUNCTION public.fail_job(uuid, text, text) TO authenticated, service_role;
+GRANT EXECUTE ON FUNCTION public.fail_job(uuid, text, text, integer, integer) TO authenticated, service_role;
+GRANT EXECUTE ON FUNCTION public.complete_jobs(uuid[], text, double precision[]) TO authenticated, service_role;
+GRANT EXECUTE ON FUNCTION public.fail_jobs(uuid[], text[], text, integer, integer) TO authenticated, service_role;
 GRANT EXECUTE ON FUNCTION public.heartbeat_job(uuid, text, integer) TO authenticated, service_role;
+GRANT EXECUTE ON FUNCTION public.heartbeat_jobs(uuid[], text, integer) TO authenticated, service_role;
 GRANT EXECUTE ON FUNCTION public.release_job(uuid, text) TO authenticated, service_role;
-GRANT EXECUTE ON FUNCTION public.purge_stale_processing(text) TO authenticated, service_role;
\ No newline at end of file
+GRANT EXECUTE ON FUNCTION public.release_jobs(uuid[], text) TO authenticated, service_role;
+GRANT EXECUTE ON FUNCTION public.purge_stale_processing(text) TO authenticated, service_role;
+GRANT EXECUTE ON FUNCTION public.janitor_sweep(text, integer, integer) TO authenticated, service_role;
+GRANT EXECUTE ON FUNCTION public.enqueue_jobs(text[], text, text, text, boolean, integer, boolean, integer) TO authenticated, service_role;
+GRANT EXECUTE ON FUNCTION public.age_job_priorities(text, integer, integer) TO authenticated, service_role;
+GRANT EXECUTE ON FUNCTION public.lane_latency_stats(text, integer) TO authenticated, service_role;
+GRANT EXECUTE ON FUNCTION public.queue_stats(text) TO authenticated, service_role;
+GRANT EXECUTE ON FUNCTION public.archive_finished_jobs(text, integer, integer) TO authenticated, service_role;
+GRANT EXECUTE ON FUNCTION public.take_portal_tokens(text, double precision, double precision, double precision) TO authenticated, service_role;
\ No newline at end of file
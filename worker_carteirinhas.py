@@ -1,19 +1,33 @@
 import os
 import time
 import logging
-import requests
 import json
-from typing import Dict, List
-from dotenv import load_dotenv
+import asyncio
+import functools
+import signal
 import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from dotenv import load_dotenv
 
-from automacao_carteirinhas import AutomacaoCarteirinhas, DatabaseManager
+from automacao_carteirinhas import DatabaseManager
+from api_client import get_api_client
+from query_metrics import get_query_metrics
+from health_prober import HealthProber
+from queue_janitor import QueueJanitor
+from local_executor import LocalExecutor
+from job_deadlines import JobDeadlines, DEADLINE_EXCEEDED
 
 load_dotenv()
 
 logger = logging.getLogger("worker_carteirinhas")
 logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
 
+# Canal emitido pelo trigger trg_job_carteirinhas_enqueued (sql_jobs_rpcs.sql)
+JOB_NOTIFY_CHANNEL = "job_carteirinhas_enqueued"
+# Pseudo-servidor que representa o pool de processos locais (WORKER_EXECUTOR_MODE=local)
+LOCAL_SERVER = "local"
+
 
 def _build_verificar_url() -> str:
     """Resolve a URL do endpoint de verificar carteirinha."""
@@ -53,7 +67,7 @@ def trigger_webscraping_real(carteirinha: str) -> Dict:
         f"-H 'Authorization: Bearer {token}'"
     )
     logger.info(f"[worker] Enviando requisição (real): {curl_cmd}")
-    resp = requests.post(url, params=params, headers=headers, timeout=int(os.getenv("CARTEIRINHA_API_TIMEOUT", "900")))
+    resp = get_api_client().post(url, params=params, headers=headers, timeout=int(os.getenv("CARTEIRINHA_API_TIMEOUT", "900")))
     resp.raise_for_status()
     try:
         return resp.json()
@@ -61,8 +75,9 @@ def trigger_webscraping_real(carteirinha: str) -> Dict:
         return {"status_code": resp.status_code}
 
 
-def trigger_verificar_carteirinha(carteirinha: str, base_url: str = None) -> Dict:
-    """Chama POST /verificar_carteirinha na API, opcionalmente usando base_url específica."""
+def trigger_verificar_carteirinha(carteirinha: str, base_url: str = None, timeout: Optional[float] = None) -> Dict:
+    """Chama POST /verificar_carteirinha na API, opcionalmente usando base_url específica.
+    `timeout` (ex.: o deadline do job) só reduz o CARTEIRINHA_API_TIMEOUT."""
     url = (f"{base_url.rstrip('/')}/verificar_carteirinha") if base_url else _build_verificar_url()
     token = os.getenv("API_TOKEN", "")
     headers = {
@@ -78,7 +93,9 @@ def trigger_verificar_carteirinha(carteirinha: str, base_url: str = None) -> Dic
         f"-d '{json.dumps(payload)}'"
     )
     logger.info(f"[worker] Enviando requisição: {curl_cmd}")
-    resp = requests.post(url, json=payload, headers=headers, timeout=int(os.getenv("CARTEIRINHA_API_TIMEOUT", "900")))
+    api_timeout = float(os.getenv("CARTEIRINHA_API_TIMEOUT", "900"))
+    resp = get_api_client().post(url, json=payload, headers=headers,
+                                 timeout=min(api_timeout, timeout) if timeout else api_timeout)
     resp.raise_for_status()
     try:
         return resp.json()
@@ -86,6 +103,35 @@ def trigger_verificar_carteirinha(carteirinha: str, base_url: str = None) -> Dic
         return {"status_code": resp.status_code}
 
 
+def _parse_server_capacities(servers: List[str]) -> Dict[str, int]:
+    """Lê API_SERVER_CAPACITIES ("url=2,url=3"); servidores sem entrada ficam de fora."""
+    capacities: Dict[str, int] = {}
+    raw = os.getenv("API_SERVER_CAPACITIES", "").strip()
+    for item in raw.split(','):
+        if '=' not in item:
+            continue
+        url, _, cap = item.rpartition('=')
+        url = url.strip().rstrip('/')
+        try:
+            if url in servers:
+                capacities[url] = max(1, int(cap))
+        except ValueError:
+            logger.warning(f"Capacidade inválida em API_SERVER_CAPACITIES: {item}")
+    return capacities
+
+
+def trigger_abortar(carteirinha: str, base_url: str) -> Dict:
+    """Chama POST /abortar no servidor para derrubar a execução em andamento da carteirinha."""
+    url = f"{base_url.rstrip('/')}/abortar"
+    headers = {
+        "Authorization": f"Bearer {os.getenv('API_TOKEN', '')}",
+        "Content-Type": "application/json",
+    }
+    resp = get_api_client().post(url, json={"carteirinha": carteirinha}, headers=headers, timeout=10)
+    resp.raise_for_status()
+    return resp.json()
+
+
 def _extract_error_from_result(result: Dict) -> str:
     """Extrai mensagem de erro amigável do payload da API."""
     if not isinstance(result, dict):
@@ -97,153 +143,566 @@ def _extract_error_from_result(result: Dict) -> str:
     return str(msg)
 
 
-def worker_loop(worker_id: str, claim_batch: int = 1, poll_interval: int = 60):
-    """Loop principal do worker: consome jobs e distribui entre múltiplos servidores com healthcheck."""
-    servers_env = os.getenv("API_SERVER_URLS", "").strip()
-    servers: List[str] = [u.strip().rstrip('/') for u in servers_env.split(',') if u.strip()]
-    if not servers:
-        base = os.getenv("CARTEIRINHA_API_BASE_URL", "http://127.0.0.1:8002").rstrip('/')
-        servers = [base]
+class AckBuffer:
+    """Write-behind dos acks: acumula conclusões/falhas e grava em lote via complete_jobs/fail_jobs.
+
+    O flush acontece ao atingir ACK_BATCH_SIZE, a cada ACK_FLUSH_SECONDS e no encerramento.
+    Enquanto o ack não é gravado o lease continua sendo renovado pelo heartbeat.
+    O sucesso leva a duração medida do scrape: é ela que vai para duration_seconds (sem o atraso
+    do stagger nem o do flush), a mesma amostra que o JobDeadlines registra em memória.
+    """
+
+    def __init__(self):
+        self.batch_size = max(1, int(os.getenv("ACK_BATCH_SIZE", "20")))
+        self.flush_seconds = float(os.getenv("ACK_FLUSH_SECONDS", "2"))
+        # (locked_by, job_id, erro ou None para sucesso, duração do scrape em s)
+        self._pending: List[Tuple[str, str, Optional[str], Optional[float]]] = []
+        self.full: asyncio.Event = None
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def _add(self, owner: str, job_id: str, error: Optional[str], duration: Optional[float] = None):
+        self._pending.append((owner, job_id, error, duration))
+        if self.full is not None and len(self._pending) >= self.batch_size:
+            self.full.set()
+
+    def success(self, job_id: str, owner: str, duration: Optional[float] = None):
+        self._add(owner, job_id, None, duration)
+
+    def failure(self, job_id: str, owner: str, error: str):
+        self._add(owner, job_id, error)
+
+    def requeue(self, owner: str, job_ids: List[str], errors: Optional[List[str]] = None,
+                durations: Optional[List[Optional[float]]] = None):
+        """Devolve ao buffer acks cuja gravação falhou; voltam no próximo flush (sem disparar `full`,
+        para não girar em falso enquanto o banco estiver fora)."""
+        for i, job_id in enumerate(job_ids):
+            self._pending.append((owner, job_id, errors[i] if errors is not None else None,
+                                  durations[i] if durations is not None else None))
+
+    def drain(self) -> Dict[str, Tuple[List[str], List[Optional[float]], List[str], List[str]]]:
+        """Esvazia o buffer agrupando por locked_by:
+        (ids com sucesso, durações desses jobs, ids com erro, mensagens de erro)."""
+        pending, self._pending = self._pending, []
+        if self.full is not None:
+            self.full.clear()
+        groups: Dict[str, Tuple[List[str], List[Optional[float]], List[str], List[str]]] = {}
+        for owner, job_id, error, duration in pending:
+            done, durations, failed, errors = groups.setdefault(owner, ([], [], [], []))
+            if error is None:
+                done.append(job_id)
+                durations.append(duration)
+            else:
+                failed.append(job_id)
+                errors.append(error)
+        return groups
+
+
+class Dispatcher:
+    """Despachante assíncrono: claim, despacho, healthcheck e ack rodam como tarefas cooperativas.
 
-    server_busy = {srv: False for srv in servers}
-    server_health = {srv: {"ok": True, "ts": 0.0} for srv in servers}
-    busy_lock = threading.Lock()
+    Um servidor que fica livre ou um NOTIFY de novo job acorda o laço de despacho imediatamente
+    (evento `wake`); o `poll_interval` fica apenas como rede de segurança.
+    """
 
-    hc_path = os.getenv("HEALTHCHECK_PATH", "/")
-    hc_timeout = int(os.getenv("HEALTHCHECK_TIMEOUT_SECONDS", "5"))
-    hc_cache = int(os.getenv("HEALTHCHECK_CACHE_SECONDS", "15"))
+    def __init__(self, worker_id: str, db: DatabaseManager, servers: List[str], poll_interval: int = 60,
+                 executor: Optional[LocalExecutor] = None):
+        self.worker_id = worker_id
+        self.db = db
+        # Com executor local não há servidores HTTP: o pool de processos é o único destino
+        self.executor = executor
+        self.servers = [LOCAL_SERVER] if executor is not None else servers
+        self.poll_interval = poll_interval
 
-    def is_server_healthy(server_url: str) -> bool:
-        now = time.time()
-        cached = server_health.get(server_url, {"ok": False, "ts": 0.0})
-        if (now - cached["ts"]) < hc_cache:
-            return cached["ok"]
+        # Jobs em andamento por servidor; capacidade vem da config, do próprio servidor ou do padrão
+        self.server_load = {srv: 0 for srv in self.servers}
+        self.default_capacity = max(1, int(os.getenv("API_SERVER_CAPACITY", "1")))
+        self.configured_capacity = _parse_server_capacities(servers)
+        # Saúde mantida em background; o despacho só lê os registros do prober
+        http_servers = [] if executor is not None else servers
+        self.prober = HealthProber(http_servers, on_recover=lambda srv: self.wake.set())
+
+        # O ritmo contra o portal é controlado pelo token bucket da frota (portal_rate_limiter.py);
+        # o stagger local fica opcional
+        self.dispatch_stagger = float(os.getenv("DISPATCH_STAGGER_SECONDS", "0"))
+        # Lease curto renovado por heartbeat: um worker que cai libera seus jobs em ~1 minuto
+        self.visibility_timeout = int(os.getenv("VISIBILITY_TIMEOUT_SECONDS", "90"))
+        self.heartbeat_interval = float(os.getenv("HEARTBEAT_INTERVAL_SECONDS", "30"))
+        # Deadline por tipo de job (configurado e aprendido do p95 das durações)
+        self.deadlines = JobDeadlines()
+
+        self.wake: asyncio.Event = None
+        self.in_flight: Dict[str, asyncio.Task] = {}
+        # job_id -> locked_by do lease (claim_jobs grava o worker_id)
+        self.leases: Dict[str, str] = {}
+        self._next_start = 0.0
+        self.acks = AckBuffer()
+        # Drain (SIGTERM/SIGINT): para de reivindicar, espera os jobs em andamento e libera os leases restantes
+        self.drain_grace = float(os.getenv("DRAIN_GRACE_SECONDS", "60"))
+        self.draining = False
+        self.stop: asyncio.Event = None
+        self._force_stop: asyncio.Event = None
+        # Cada thread do executor tem sua própria conexão (DatabaseManager per_thread): claim, acks e
+        # heartbeats não esperam um pelo outro nem dividem transação
+        self._db_executor = ThreadPoolExecutor(
+            max_workers=max(1, int(os.getenv("WORKER_DB_THREADS", "4"))), thread_name_prefix="db"
+        )
+        # Scrapes bloqueantes em executor próprio: não disputam threads com abort, prober, janitor e banco.
+        # Uma thread só volta ao pool quando a chamada termina (o timeout HTTP/local segue o deadline),
+        # por isso o despacho não ocupa mais slots do que há threads livres
+        self._scrape_threads = int(os.getenv("WORKER_SCRAPE_THREADS", "0")) or self._default_scrape_threads(servers)
+        self._scrape_executor = ThreadPoolExecutor(max_workers=self._scrape_threads, thread_name_prefix="scrape")
+        self._scrape_busy = 0
+
+    def _default_scrape_threads(self, servers: List[str]) -> int:
+        """Capacidade total de slots (configurada ou padrão) em dobro, com margem para chamadas que
+        ainda estão terminando depois do deadline."""
+        if self.executor is not None:
+            total = self.executor.capacity
+        else:
+            total = sum(self.configured_capacity.get(srv, self.default_capacity) for srv in servers)
+        return max(4, 2 * total + 2)
+
+    def _listen_forever(self, loop: asyncio.AbstractEventLoop):
+        """Mantém uma conexão em LISTEN e acorda o despacho a cada NOTIFY; reconecta em caso de falha."""
+        backoff = 1.0
+        while True:
+            conn = None
+            try:
+                conn = self.db.open_listener(JOB_NOTIFY_CHANNEL)
+                logger.info(f"[listen] Aguardando NOTIFY em {JOB_NOTIFY_CHANNEL}")
+                backoff = 1.0
+                for notify in conn.notifies():
+                    if notify.payload in ("", "sgucard"):
+                        loop.call_soon_threadsafe(self.wake.set)
+            except Exception as e:
+                logger.warning(f"[listen] Conexão LISTEN perdida: {e}; reconectando em {backoff:.0f}s")
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60.0)
+
+    async def _db(self, fn, *args, **kwargs):
+        """Executa uma chamada bloqueante do DatabaseManager fora do event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._db_executor, functools.partial(fn, *args, **kwargs))
+
+    def _capacity(self, server_url: str) -> int:
+        if server_url == LOCAL_SERVER:
+            return self.executor.capacity
+        if server_url in self.configured_capacity:
+            return self.configured_capacity[server_url]
+        reported = self.prober.records[server_url].reported_capacity
+        return reported if reported else self.default_capacity
+
+    def _available_servers(self) -> List[str]:
+        """Destinos aptos a receber jobs, do mais saudável/rápido para o menos."""
+        if self.executor is not None:
+            return [LOCAL_SERVER]
+        return self.prober.rank([srv for srv in self.servers if self.prober.is_available(srv)])
+
+    def _free_slots(self) -> int:
+        free = sum(max(0, self._capacity(srv) - self.server_load[srv]) for srv in self._available_servers())
+        # Um job que esperasse thread consumiria o próprio deadline na fila do executor
+        return min(free, max(0, self._scrape_threads - self._scrape_busy))
+
+    def _pick_server(self) -> str:
+        """Servidor disponível com menor carga relativa; empates vão para o de menor latência."""
+        candidates = [srv for srv in self._available_servers() if self.server_load[srv] < self._capacity(srv)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda srv: self.server_load[srv] / self._capacity(srv))
+
+    def _execute(self, carteirinha: str, server_url: str, timeout: float) -> Dict:
+        """Bloqueante: roda a carteirinha no pool local ou via POST no servidor escolhido.
+        A chamada não passa de `timeout` (deadline do job), então a thread não fica presa além dele."""
+        if server_url == LOCAL_SERVER:
+            return self.executor.run(carteirinha, timeout=timeout)
+        return trigger_verificar_carteirinha(carteirinha, base_url=server_url, timeout=timeout)
+
+    def _scrape(self, carteirinha: str, server_url: str, timeout: float) -> asyncio.Future:
+        """Submete o scrape ao executor dedicado; a thread conta como ocupada até a chamada terminar."""
+        self._scrape_busy += 1
+        future = self._scrape_executor.submit(self._execute, carteirinha, server_url, timeout)
+        loop = asyncio.get_running_loop()
+
+        def _done(_):
+            def _free():
+                self._scrape_busy -= 1
+                self.wake.set()
+            try:
+                loop.call_soon_threadsafe(_free)
+            except RuntimeError:
+                # Loop já encerrado (chamada terminou depois do shutdown)
+                pass
+        future.add_done_callback(_done)
+        return asyncio.wrap_future(future)
+
+    def _abort(self, carteirinha: str, server_url: str):
+        """Bloqueante: pede ao destino que derrube a execução da carteirinha (deadline excedido)."""
         try:
-            url = f"{server_url}{hc_path if hc_path.startswith('/') else '/' + hc_path}"
-            resp = requests.get(url, timeout=hc_timeout)
-            ok = 200 <= resp.status_code < 300
-        except Exception:
-            ok = False
-        server_health[server_url] = {"ok": ok, "ts": now}
-        if not ok:
-            logger.warning(f"[healthcheck] Servidor indisponível: {server_url}")
-        return ok
+            if server_url == LOCAL_SERVER:
+                self.executor.abort(carteirinha)
+            else:
+                trigger_abortar(carteirinha, server_url)
+        except Exception as e:
+            logger.warning(f"Falha ao abortar carteirinha {carteirinha} em {server_url}: {e}")
 
-    logger.info(f"Worker iniciado: {worker_id}, poll_interval={poll_interval}s, servidores={servers}")
+    async def _claim(self, limit: int) -> List[Dict]:
+        jobs: List[Dict] = []
+        try:
+            # Um único round trip: o RPC já aplica prioridade, agendamento, backoff e max_attempts
+            jobs = await self._db(self.db.claim_jobs, self.worker_id, claim_limit=limit)
+        except Exception as e:
+            logger.error(f"Erro ao reivindicar jobs: {e}")
+        return jobs or []
 
-    automacao = AutomacaoCarteirinhas()
-    db: DatabaseManager = automacao.db_manager
+    @staticmethod
+    def _group_by_carteirinha(jobs: List[Dict]) -> List[List[Dict]]:
+        """Agrupa os jobs reivindicados por carteirinha, mantendo a ordem do claim (o primeiro de cada grupo lidera)."""
+        groups: Dict[str, List[Dict]] = {}
+        ordered: List[List[Dict]] = []
+        for job in jobs:
+            carteirinha = job.get("carteirinha") or job.get("carteira")
+            if not carteirinha:
+                ordered.append([job])
+                continue
+            if carteirinha not in groups:
+                groups[carteirinha] = []
+                ordered.append(groups[carteirinha])
+            groups[carteirinha].append(job)
+        return ordered
 
-    # Garantir unicidade do worker via advisory lock
-    try:
-        if not db.acquire_worker_lock(worker_id):
-            logger.error("Worker lock não adquirido; outro worker ativo. Encerrando.")
-            return
-    except Exception as e:
-        logger.error(f"Falha ao adquirir worker lock: {e}")
-        return
+    async def _dispatch(self, jobs: List[Dict]) -> int:
+        dispatched = 0
+        groups = self._group_by_carteirinha(jobs)
+        for idx, group in enumerate(groups):
+            server_url = self._pick_server()
+            if not server_url:
+                await self._release_unassigned([job for g in groups[idx:] for job in g])
+                break
+            job = group[0]
+            job_id = job.get("id")
+            carteirinha = job.get("carteirinha") or job.get("carteira")
+            if not carteirinha:
+                logger.warning(f"Job {job_id} sem carteirinha; marcando como falho")
+                self.acks.failure(job_id, self.worker_id, "Job sem carteirinha")
+                continue
+            slot_id = f"{self.worker_id}:{self.servers.index(server_url)+1}"
+            if len(group) > 1:
+                logger.info(f"Carteirinha {carteirinha}: {len(group) - 1} jobs duplicados agrupados ao job={job_id}")
 
-    def process_job_on_server(job: Dict, server_url: str, slot_id: str):
+            # Escalonamento sem bloquear o laço: cada job aguarda sua vez dentro da própria tarefa
+            now = time.monotonic()
+            self._next_start = max(now, self._next_start)
+            delay = self._next_start - now
+            self._next_start += self.dispatch_stagger
+
+            self.server_load[server_url] += 1
+            for member in group:
+                self.leases[member.get("id")] = self.worker_id
+            task = asyncio.create_task(self._run_job(group, server_url, slot_id, delay))
+            self.in_flight[job_id] = task
+            dispatched += 1
+        return dispatched
+
+    async def _run_job(self, group: List[Dict], server_url: str, slot_id: str, delay: float = 0.0):
+        """Executa o scrape uma vez para a carteirinha e aplica o mesmo ack a todos os jobs do grupo."""
+        job = group[0]
         job_id = job.get("id")
+        job_ids = [member.get("id") for member in group]
+        owner = self.leases.get(job_id, slot_id)
         carteirinha = job.get("carteirinha") or job.get("carteira")
+        job_type = job.get("type") or "sgucard"
+        deadline = self.deadlines.deadline(job_type)
         try:
-            logger.info(f"[slot {slot_id}] Processando job={job_id} carteirinha={carteirinha} no servidor {server_url}")
-            result = trigger_verificar_carteirinha(carteirinha, base_url=server_url)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            logger.info(f"[slot {slot_id}] Processando job={job_id} carteirinha={carteirinha} no servidor {server_url} (deadline={deadline:.0f}s)")
+            started = time.monotonic()
+            try:
+                result = await asyncio.wait_for(self._scrape(carteirinha, server_url, deadline), timeout=deadline)
+            except asyncio.TimeoutError:
+                # Libera o slot já; o destino é avisado em background para derrubar o Chrome travado
+                logger.warning(f"[slot {slot_id}] Deadline de {deadline:.0f}s excedido para job={job_id}; abortando")
+                asyncio.get_running_loop().run_in_executor(None, self._abort, carteirinha, server_url)
+                for member_id in job_ids:
+                    self.acks.failure(member_id, owner, f"{DEADLINE_EXCEEDED}: execução excedeu {deadline:.0f}s")
+                return
             status_api = str(result.get("status", "")).lower()
             if status_api in ("sucesso", "success"):
                 logger.info(f"[slot {slot_id}] API retornou sucesso para job={job_id}. Marcando como success.")
-                ok = db.mark_job_processed(job_id)
-                if not ok:
-                    logger.warning(f"[slot {slot_id}] Falha ao marcar success para job {job_id}")
+                elapsed = time.monotonic() - started
+                self.deadlines.record(job_type, elapsed)
+                for member_id in job_ids:
+                    self.acks.success(member_id, owner, elapsed)
             else:
                 err_msg = _extract_error_from_result(result)
                 logger.warning(f"[slot {slot_id}] API retornou erro para job={job_id}: {err_msg}")
-                ok = db.mark_job_failed(job_id, err_msg)
-                if not ok:
-                    logger.warning(f"[slot {slot_id}] Falha ao marcar erro para job {job_id}")
+                for member_id in job_ids:
+                    self.acks.failure(member_id, owner, err_msg)
+        except asyncio.CancelledError:
+            raise
         except Exception as call_err:
             logger.warning(f"[slot {slot_id}] Falha ao chamar API para job={job_id}: {call_err}")
-            ok = db.mark_job_failed(job_id, f"API call failed: {call_err}")
-            if not ok:
-                logger.warning(f"[slot {slot_id}] Falha ao marcar erro para job {job_id}")
+            for member_id in job_ids:
+                self.acks.failure(member_id, owner, f"API call failed: {call_err}")
         finally:
-            with busy_lock:
-                server_busy[server_url] = False
+            # O lease (self.leases) só é removido quando o ack for gravado
+            self.server_load[server_url] = max(0, self.server_load[server_url] - 1)
+            self.in_flight.pop(job_id, None)
+            self.wake.set()
 
-    while True:
+    async def _write_acks(self, owner: str, job_ids: List[str], errors: Optional[List[str]] = None,
+                          durations: Optional[List[Optional[float]]] = None) -> bool:
+        """Grava um lote de acks; em falha devolve-os ao buffer e mantém os leases (o heartbeat segue renovando)."""
+        label = "success" if errors is None else "error"
         try:
-            # Reabrir jobs 'processing' com lock expirado (prioridade 3)
-            try:
-                purged = db.purge_stale_processing('sgucard')
-                if purged:
-                    logger.info(f"Reabertos {purged} jobs processing expirados")
-            except Exception as e:
-                logger.warning(f"Falha ao purgar processing expirados: {e}")
+            if errors is None:
+                updated = await self._db(self.db.complete_jobs, job_ids, owner, durations)
+            else:
+                updated = await self._db(self.db.fail_jobs, job_ids, errors, owner)
+        except Exception as e:
+            logger.warning(f"[ack] {owner}: falha ao gravar {len(job_ids)} acks ({label}): {e}")
+            updated = None
+        if updated is None:
+            self.acks.requeue(owner, job_ids, errors, durations)
+            return False
+        if updated < len(job_ids):
+            logger.warning(f"[ack] {owner}: {updated}/{len(job_ids)} jobs marcados como {label} (lease perdido?)")
+        # Gravado: o que não foi atualizado já não era deste lease
+        for job_id in job_ids:
+            self.leases.pop(job_id, None)
+        return True
 
-            with busy_lock:
-                free_servers = [srv for srv in servers if not server_busy[srv] and is_server_healthy(srv)]
-            if not free_servers:
-                time.sleep(poll_interval)
-                continue
+    async def flush_acks(self) -> bool:
+        """Grava os acks acumulados (um UPDATE por locked_by e tipo) e encerra os leases correspondentes.
+        Devolve False se algum lote ficou no buffer para a próxima tentativa."""
+        written = True
+        for owner, (done, durations, failed, errors) in self.acks.drain().items():
+            if done:
+                written &= await self._write_acks(owner, done, durations=durations)
+            if failed:
+                written &= await self._write_acks(owner, failed, errors)
+        return written
 
-            jobs: List[Dict] = []
+    async def ack_loop(self):
+        while True:
             try:
-                jobs = db.claim_jobs(worker_id, claim_limit=len(free_servers))
+                await asyncio.wait_for(self.acks.full.wait(), timeout=self.acks.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush_acks()
             except Exception as e:
-                logger.error(f"Erro ao reivindicar jobs: {e}")
-            if not jobs:
-                jobs = db.fetch_jobs_simple(limit=len(free_servers), statuses=['pending'])
-            if not jobs:
-                jobs = db.fetch_jobs_simple(limit=len(free_servers), statuses=['error'])
-            if not jobs:
-                time.sleep(poll_interval)
-                continue
+                logger.warning(f"[ack] Falha ao gravar acks: {e}")
 
-            dispatch_stagger = int(os.getenv("DISPATCH_STAGGER_SECONDS", "5"))
-            ji = 0
-            for server_url in free_servers:
-                if ji >= len(jobs):
-                    break
-                job = jobs[ji]
-                ji += 1
-                job_id = job.get("id")
-                carteirinha = job.get("carteirinha") or job.get("carteira")
-                if not carteirinha:
-                    logger.warning(f"Job {job_id} sem carteirinha; marcando como falho")
-                    ok = db.mark_job_failed(job_id, "Job sem carteirinha")
-                    if not ok:
-                        logger.warning(f"Falha ao marcar erro para job {job_id}")
-                    continue
-                status_job = str(job.get("status", "")).lower()
-                is_claimed = (status_job == "processing")
-                if status_job == "success":
-                    logger.info(f"Pulando job {job_id} status={status_job} (success).")
+    async def _release_unassigned(self, jobs: List[Dict]):
+        """Devolve à fila jobs reivindicados que ficaram sem servidor neste ciclo."""
+        job_ids = [job.get("id") for job in jobs]
+        if job_ids:
+            await self._db(self.db.release_jobs, job_ids, self.worker_id)
+
+    async def heartbeat_loop(self):
+        """Renova periodicamente o lease de todos os jobs em andamento, agrupados por locked_by."""
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            by_owner: Dict[str, List[str]] = {}
+            for job_id, owner in list(self.leases.items()):
+                by_owner.setdefault(owner, []).append(job_id)
+            for owner, job_ids in by_owner.items():
+                try:
+                    renewed = await self._db(
+                        self.db.heartbeat_jobs, job_ids, owner, visibility_timeout_seconds=self.visibility_timeout
+                    )
+                    if renewed < len(job_ids):
+                        logger.warning(f"[heartbeat] {owner}: renovados {renewed}/{len(job_ids)} leases (lease perdido?)")
+                except Exception as e:
+                    logger.warning(f"[heartbeat] Falha ao renovar leases de {owner}: {e}")
+
+    async def janitor_loop(self):
+        """Manutenção da fila fora do hot path; só o worker eleito (advisory lock) executa o sweep."""
+        janitor = QueueJanitor('sgucard')
+        try:
+            while True:
+                await asyncio.to_thread(janitor.run_once)
+                await asyncio.sleep(janitor.interval)
+        finally:
+            janitor.release()
+
+    async def _wait_wake(self, timeout: float):
+        try:
+            await asyncio.wait_for(self.wake.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def dispatch_loop(self):
+        while not self.draining:
+            self.wake.clear()
+            try:
+                free_slots = self._free_slots()
+                if not free_slots:
+                    # Acorda assim que um slot for liberado ou um servidor voltar
+                    await self._wait_wake(self.poll_interval)
                     continue
 
-                slot_id = f"{worker_id}:{servers.index(server_url)+1}"
-                vt = int(os.getenv("VISIBILITY_TIMEOUT_SECONDS", "900"))
-                started = True if is_claimed else db.start_job_processing(job_id, slot_id, visibility_timeout_seconds=vt)
-                if not started:
-                    logger.info(f"Job {job_id} não pôde ser iniciado (status mudou ou em processamento). Pulando.")
+                jobs = await self._claim(free_slots)
+                if not jobs:
+                    await self._wait_wake(self.poll_interval)
                     continue
 
-                with busy_lock:
-                    server_busy[server_url] = True
-                t = threading.Thread(target=process_job_on_server, args=(job, server_url, slot_id), daemon=True)
-                t.start()
-                time.sleep(dispatch_stagger)
+                dispatched = await self._dispatch(jobs)
+                if not dispatched:
+                    await self._wait_wake(self.poll_interval)
+            except Exception as e:
+                logger.error(f"Erro no loop do worker: {e}")
+                await self._wait_wake(self.poll_interval)
+
+    def request_drain(self, signame: str = "SIGTERM"):
+        """Primeiro sinal inicia o drain; o segundo encerra sem esperar o grace period."""
+        if self.stop.is_set():
+            logger.warning(f"[drain] {signame} recebido novamente; encerrando sem aguardar jobs em andamento")
+            self._force_stop.set()
+            return
+        logger.info(f"[drain] {signame} recebido; parando de reivindicar jobs")
+        self.draining = True
+        self.stop.set()
+        self.wake.set()
 
-            time.sleep(poll_interval)
-        except KeyboardInterrupt:
-            logger.info("Worker interrompido pelo usuário")
+    def _install_signal_handlers(self, loop: asyncio.AbstractEventLoop):
+        for sig in (signal.SIGINT, signal.SIGTERM):
             try:
-                db.release_worker_lock(worker_id)
-            except Exception:
-                pass
-            break
+                loop.add_signal_handler(sig, self.request_drain, sig.name)
+            except (NotImplementedError, RuntimeError):
+                # Windows: sem add_signal_handler; o handler roda na thread principal e agenda no loop
+                signal.signal(sig, lambda signum, frame: loop.call_soon_threadsafe(
+                    self.request_drain, signal.Signals(signum).name))
+
+    async def release_leases(self):
+        """Devolve à fila, em lote por locked_by, todos os leases ainda detidos pelo worker."""
+        by_owner: Dict[str, List[str]] = {}
+        for job_id, owner in list(self.leases.items()):
+            by_owner.setdefault(owner, []).append(job_id)
+        for owner, job_ids in by_owner.items():
+            released = await self._db(self.db.release_jobs, job_ids, owner)
+            logger.info(f"[drain] {owner}: {released}/{len(job_ids)} leases devolvidos à fila")
+            for job_id in job_ids:
+                self.leases.pop(job_id, None)
+
+    async def drain(self, tasks: List[asyncio.Task]):
+        self.draining = True
+        for t in tasks:
+            if t.get_name() == "dispatch":
+                t.cancel()
+        pending = list(self.in_flight.values())
+        if pending and self.drain_grace > 0 and not self._force_stop.is_set():
+            logger.info(f"[drain] Aguardando {len(pending)} jobs em andamento por até {self.drain_grace:.0f}s")
+            all_done = asyncio.create_task(asyncio.wait(pending))
+            force = asyncio.create_task(self._force_stop.wait())
+            await asyncio.wait([all_done, force], timeout=self.drain_grace, return_when=asyncio.FIRST_COMPLETED)
+            all_done.cancel()
+            force.cancel()
+        for t in list(self.in_flight.values()):
+            t.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if len(self.acks):
+            logger.info(f"[ack] Gravando {len(self.acks)} acks pendentes antes de encerrar")
+            if not await self.flush_acks():
+                # Os leases desses jobs são devolvidos abaixo: voltam à fila em vez de esperar o lease expirar
+                logger.warning(f"[ack] {len(self.acks)} acks não gravados no encerramento; jobs voltam à fila")
+        if self.leases:
+            await self.release_leases()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.wake = asyncio.Event()
+        self.acks.full = asyncio.Event()
+        self.stop = asyncio.Event()
+        self._force_stop = asyncio.Event()
+        self._install_signal_handlers(loop)
+        try:
+            self.deadlines.seed('sgucard', await self._db(self.db.recent_job_durations, 'sgucard'))
         except Exception as e:
-            logger.error(f"Erro no loop do worker: {e}")
-            time.sleep(poll_interval)
+            logger.warning(f"[deadline] Falha ao carregar durações recentes: {e}")
+        threading.Thread(target=self._listen_forever, args=(loop,), name="listen", daemon=True).start()
+        tasks = [
+            asyncio.create_task(self.prober.run(), name="health"),
+            asyncio.create_task(self.dispatch_loop(), name="dispatch"),
+            asyncio.create_task(self.heartbeat_loop(), name="heartbeat"),
+            asyncio.create_task(self.ack_loop(), name="ack"),
+        ]
+        if os.getenv("JANITOR_ENABLED", "true").lower() in ("1", "true", "yes"):
+            tasks.append(asyncio.create_task(self.janitor_loop(), name="janitor"))
+        try:
+            stop_wait = asyncio.create_task(self.stop.wait(), name="stop")
+            done, _ = await asyncio.wait(tasks + [stop_wait], return_when=asyncio.FIRST_COMPLETED)
+            stop_wait.cancel()
+            for t in done:
+                if t is not stop_wait and not t.cancelled() and t.exception():
+                    logger.error(f"Tarefa {t.get_name()} encerrou com erro: {t.exception()}")
+        finally:
+            # Também em caso de falha: nada fica em 'processing' esperando o lease expirar
+            try:
+                await self.drain(tasks)
+            except BaseException as e:
+                logger.warning(f"[drain] Falha ao encerrar o worker: {e}")
+            if self.executor is not None:
+                await asyncio.to_thread(self.executor.close)
+            self._db_executor.shutdown(wait=False)
+            self._scrape_executor.shutdown(wait=False)
+            logger.info(f"Métricas HTTP: {get_api_client().metrics()}")
+            logger.info(f"Métricas de banco: {get_query_metrics().snapshot()}")
+            logger.info(f"Saúde dos servidores: {self.prober.snapshot()}")
+            logger.info(f"Deadlines: {self.deadlines.snapshot()}")
+
+
+def worker_loop(worker_id: str, claim_batch: int = 1, poll_interval: int = 60):
+    """Loop principal do worker: consome jobs e distribui entre múltiplos servidores com healthcheck."""
+    servers_env = os.getenv("API_SERVER_URLS", "").strip()
+    servers: List[str] = [u.strip().rstrip('/') for u in servers_env.split(',') if u.strip()]
+    if not servers:
+        base = os.getenv("CARTEIRINHA_API_BASE_URL", "http://127.0.0.1:8002").rstrip('/')
+        servers = [base]
+
+    executor_mode = os.getenv("WORKER_EXECUTOR_MODE", "http").strip().lower()
+    if executor_mode == "local":
+        logger.info(f"Worker iniciado: {worker_id}, poll_interval={poll_interval}s, executor local")
+    else:
+        logger.info(f"Worker iniciado: {worker_id}, poll_interval={poll_interval}s, servidores={servers}")
+
+    # Conexão da thread principal guarda o advisory lock do worker; as threads do executor de
+    # banco abrem as suas no primeiro uso
+    db = DatabaseManager(pooled=False, per_thread=True)
+
+    # Garantir unicidade do worker via advisory lock
+    try:
+        if not db.acquire_worker_lock(worker_id):
+            logger.error("Worker lock não adquirido; outro worker ativo. Encerrando.")
+            return
+    except Exception as e:
+        logger.error(f"Falha ao adquirir worker lock: {e}")
+        return
+
+    executor = LocalExecutor() if executor_mode == "local" else None
+    dispatcher = Dispatcher(worker_id, db, servers, poll_interval=poll_interval, executor=executor)
+    try:
+        asyncio.run(dispatcher.run())
+    except KeyboardInterrupt:
+        logger.info("Worker interrompido pelo usuário")
+    finally:
+        try:
+            db.release_worker_lock(worker_id)
+        except Exception:
+            pass
+        db.close()
 
 
 if __name__ == "__main__":